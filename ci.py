@@ -3,17 +3,34 @@ import re
 import os
 import sys
 import time
-import urllib
+import Queue
+import select
+import signal
+import socket
+import httplib
+import SocketServer
+import BaseHTTPServer
 import urllib2
+import urlparse
+import glob
+import fcntl
+import hashlib
+import csv
 import json
+import pickle
+import math
+import heapq
+import sqlite3
+import collections
 import shutil
 import string
 import difflib
 import logging
 import optparse
 import tempfile
-import fileinput
+import threading
 import traceback
+import subprocess
 from virttest import common
 from virttest import utils_libvirtd, utils_selinux
 from virttest import data_dir
@@ -24,6 +41,8 @@ from virttest.utils_misc import mount, umount
 from autotest.client.tools import JUnit_api as api
 from autotest.client.shared import error
 from datetime import date
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
 
 
 class Report():
@@ -39,15 +58,26 @@ class Report():
             api.testcaseType.__init__(self, classname, name, time, error,
                                       failure)
             self.skip = skip
+            self.flaky = None
+            self.properties = []
             self.system_out = None
             self.system_err = None
 
         def exportChildren(self, outfile, level, namespace_='',
                            name_='testcaseType', fromsubclass_=False):
+            if self.properties:
+                outfile.write('<%sproperties>\n' % namespace_)
+                for name, value in self.properties:
+                    outfile.write('<%sproperty name=%s value=%s/>\n' % (
+                        namespace_, quoteattr(name), quoteattr(str(value))))
+                outfile.write('</%sproperties>\n' % namespace_)
             api.testcaseType.exportChildren(
                 self, outfile, level, namespace_, name_, fromsubclass_)
             if self.skip is not None:
                 self.skip.export(outfile, level, namespace_, name_='skipped')
+            if self.flaky is not None:
+                self.flaky.export(outfile, level, namespace_,
+                                  name_='flakyFailure')
             if self.system_out is not None:
                 outfile.write(
                     '<%ssystem-out><![CDATA[%s]]></%ssystem-out>\n' % (
@@ -67,7 +97,9 @@ class Report():
                 self.system_err is not None or
                 self.error is not None or
                 self.failure is not None or
-                self.skip is not None
+                self.skip is not None or
+                self.flaky is not None or
+                self.properties
             ):
                 return True
             else:
@@ -96,6 +128,9 @@ class Report():
     class skipType(api.failureType):
         pass
 
+    class flakyType(failureType):
+        pass
+
     class testsuite(api.testsuite):
 
         def __init__(self, name=None, skips=None):
@@ -129,9 +164,46 @@ class Report():
         with open(filename, 'w') as fp:
             testsuites.export(fp, 0)
 
+    def remove(self, testname, ts_name):
+        """
+        Remove an item from report if it exists.
+        """
+        ts = self.ts_dict.get(ts_name)
+        if ts is None:
+            return
+        for tc in ts.testcase:
+            if tc.name != testname:
+                continue
+            ts.testcase.remove(tc)
+            ts.tests -= 1
+            if tc.failure is not None:
+                ts.failures -= 1
+            elif tc.error is not None:
+                ts.errors -= 1
+            elif tc.skip is not None:
+                ts.skips -= 1
+            return
+
+    def set_property(self, testname, ts_name, name, value):
+        """
+        Set a property of an item in report if it exists.
+        """
+        ts = self.ts_dict.get(ts_name)
+        if ts is None:
+            return
+        for tc in ts.testcase:
+            if tc.name != testname:
+                continue
+            tc.properties = [(n, v) for n, v in tc.properties if n != name]
+            tc.properties.append((name, value))
+            return
+
     def update(self, testname, ts_name, result, log, error_msg, duration):
         """
         Insert a new item into report.
+
+        An existing item of the same test is replaced, like when a failed
+        test is retried.
         """
         def escape_str(inStr):
             """
@@ -154,6 +226,7 @@ class Report():
             ts.errors = 0
         else:
             ts = self.ts_dict[ts_name]
+            self.remove(testname, ts_name)
 
         tc = self.testcaseType()
         tc.name = testname
@@ -173,7 +246,27 @@ class Report():
         error_msg = tmp_msg
 
 
-        if 'FAIL' in result:
+        if 'QUARANTINED' in result:
+            error_msg.insert(0, 'Test %s is quarantined as flaky, result: %s'
+                             % (testname, result))
+            tc.skip = self.skipType(
+                message='&#10;'.join(error_msg),
+                type_='Quarantined')
+            ts.skips += 1
+        elif (result.startswith('PASS') and 'DIFF' in result and
+                self.fail_diff):
+            # Checked before FLAKY, which must not hide a dirty environment.
+            error_msg.insert(0, 'Test %s results dirty environment' % testname)
+            tc.failure = self.failureType(
+                message='&#10;'.join(error_msg),
+                type_='DIFF')
+            ts.failures += 1
+        elif 'FLAKY' in result:
+            error_msg.insert(0, 'Test %s has passed on retry' % testname)
+            tc.flaky = self.flakyType(
+                message='&#10;'.join(error_msg),
+                type_='Flaky')
+        elif 'FAIL' in result:
             error_msg.insert(0, 'Test %s has failed' % testname)
             tc.failure = self.failureType(
                 message='&#10;'.join(error_msg),
@@ -197,12 +290,6 @@ class Report():
                 message='&#10;'.join(error_msg),
                 type_='Skip')
             ts.skips += 1
-        elif 'DIFF' in result and self.fail_diff:
-            error_msg.insert(0, 'Test %s results dirty environment' % testname)
-            tc.failure = self.failureType(
-                message='&#10;'.join(error_msg),
-                type_='DIFF')
-            ts.failures += 1
         ts.add_testcase(tc)
         ts.tests += 1
         ts.timestamp = date.isoformat(date.today())
@@ -211,6 +298,8 @@ class Report():
 class State():
     permit_keys = []
     permit_re = []
+    # Connect URI of libvirt objects to check, default URI when empty.
+    uri = ''
 
     def get_names(self):
         raise NotImplementedError('Function get_names not implemented for %s.'
@@ -353,13 +442,14 @@ class DomainState(State):
     def remove(self, name):
         dom = name
         if dom['state'] != 'shut off':
-            res = virsh.destroy(dom['name'])
+            res = virsh.destroy(dom['name'], uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
         if dom['persistent'] == 'yes':
             # Make sure the domain is remove anyway
             res = virsh.undefine(
-                dom['name'], options='--snapshots-metadata --managed-save')
+                dom['name'], options='--snapshots-metadata --managed-save',
+                uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
@@ -377,36 +467,38 @@ class DomainState(State):
 
         try:
             if dom['persistent'] == 'yes':
-                res = virsh.define(fname)
+                res = virsh.define(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
                 if dom['state'] != 'shut off':
-                    res = virsh.start(name)
+                    res = virsh.start(name, uri=self.uri)
                     if res.exit_status:
                         raise Exception(str(res))
             else:
-                res = virsh.create(fname)
+                res = virsh.create(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
         finally:
             os.remove(fname)
 
         if dom['autostart'] == 'enable':
-            res = virsh.autostart(name, '')
+            res = virsh.autostart(name, '', uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
     def get_info(self, name):
         infos = {}
-        for line in virsh.dominfo(name).stdout.strip().splitlines():
+        res = virsh.dominfo(name, uri=self.uri)
+        for line in res.stdout.strip().splitlines():
             key, value = line.split(':', 1)
             infos[key.lower()] = value.strip()
         infos['inactive xml'] = virsh.dumpxml(
-            name, extra='--inactive').stdout.splitlines()
+            name, extra='--inactive', uri=self.uri).stdout.splitlines()
         return infos
 
     def get_names(self):
-        return virsh.dom_list(options='--all --name').stdout.splitlines()
+        return virsh.dom_list(options='--all --name',
+                              uri=self.uri).stdout.splitlines()
 
 
 class NetworkState(State):
@@ -420,11 +512,11 @@ class NetworkState(State):
         """
         net = name
         if net['active'] == 'yes':
-            res = virsh.net_destroy(net['name'])
+            res = virsh.net_destroy(net['name'], uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
         if net['persistent'] == 'yes':
-            res = virsh.net_undefine(net['name'])
+            res = virsh.net_undefine(net['name'], uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
@@ -448,40 +540,42 @@ class NetworkState(State):
 
         try:
             if net['persistent'] == 'yes':
-                res = virsh.net_define(fname)
+                res = virsh.net_define(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
                 if net['active'] == 'yes':
-                    res = virsh.net_start(name)
+                    res = virsh.net_start(name, uri=self.uri)
                     if res.exit_status:
-                        res = virsh.net_start(name)
+                        res = virsh.net_start(name, uri=self.uri)
                         if res.exit_status:
                             raise Exception(str(res))
             else:
-                res = virsh.net_create(fname)
+                res = virsh.net_create(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
         finally:
             os.remove(fname)
 
         if net['autostart'] == 'yes':
-            res = virsh.net_autostart(name)
+            res = virsh.net_autostart(name, uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
     def get_info(self, name):
         infos = {}
-        for line in virsh.net_info(name).stdout.strip().splitlines():
+        res = virsh.net_info(name, uri=self.uri)
+        for line in res.stdout.strip().splitlines():
             key, value = line.split()
             if key.endswith(':'):
                 key = key[:-1]
             infos[key.lower()] = value.strip()
         infos['inactive xml'] = virsh.net_dumpxml(
-            name, '--inactive').stdout.splitlines()
+            name, '--inactive', uri=self.uri).stdout.splitlines()
         return infos
 
     def get_names(self):
-        lines = virsh.net_list('--all').stdout.strip().splitlines()[2:]
+        res = virsh.net_list('--all', uri=self.uri)
+        lines = res.stdout.strip().splitlines()[2:]
         return [line.split()[0] for line in lines]
 
 
@@ -498,11 +592,11 @@ class PoolState(State):
         """
         pool = name
         if pool['state'] == 'running':
-            res = virsh.pool_destroy(pool['name'])
+            res = virsh.pool_destroy(pool['name'], uri=self.uri)
             if not res:
                 raise Exception(str(res))
         if pool['persistent'] == 'yes':
-            res = virsh.pool_undefine(pool['name'])
+            res = virsh.pool_undefine(pool['name'], uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
@@ -520,15 +614,15 @@ class PoolState(State):
 
         try:
             if pool['persistent'] == 'yes':
-                res = virsh.pool_define(fname)
+                res = virsh.pool_define(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
                 if pool['state'] == 'running':
-                    res = virsh.pool_start(name)
+                    res = virsh.pool_start(name, uri=self.uri)
                     if res.exit_status:
                         raise Exception(str(res))
             else:
-                res = virsh.pool_create(fname)
+                res = virsh.pool_create(fname, uri=self.uri)
                 if res.exit_status:
                     raise Exception(str(res))
         except Exception, e:
@@ -537,22 +631,25 @@ class PoolState(State):
             os.remove(fname)
 
         if pool['autostart'] == 'yes':
-            res = virsh.pool_autostart(name)
+            res = virsh.pool_autostart(name, uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
 
     def get_info(self, name):
         infos = {}
-        for line in virsh.pool_info(name).stdout.strip().splitlines():
+        res = virsh.pool_info(name, uri=self.uri)
+        for line in res.stdout.strip().splitlines():
             key, value = line.split(':', 1)
             infos[key.lower()] = value.strip()
         infos['inactive xml'] = virsh.pool_dumpxml(
-            name, '--inactive').splitlines()
-        infos['volumes'] = virsh.vol_list(name).stdout.strip().splitlines()[2:]
+            name, '--inactive', uri=self.uri).splitlines()
+        res = virsh.vol_list(name, uri=self.uri)
+        infos['volumes'] = res.stdout.strip().splitlines()[2:]
         return infos
 
     def get_names(self):
-        lines = virsh.pool_list('--all').stdout.strip().splitlines()[2:]
+        res = virsh.pool_list('--all', uri=self.uri)
+        lines = res.stdout.strip().splitlines()[2:]
         return [line.split()[0] for line in lines]
 
 
@@ -563,7 +660,7 @@ class SecretState(State):
 
     def remove(self, name):
         secret = name
-        res = virsh.secret_undefine(secret['uuid'])
+        res = virsh.secret_undefine(secret['uuid'], uri=self.uri)
         if res.exit_status:
             raise Exception(str(res))
 
@@ -581,7 +678,7 @@ class SecretState(State):
         secret_file.close()
 
         try:
-            res = virsh.secret_define(fname)
+            res = virsh.secret_define(fname, uri=self.uri)
             if res.exit_status:
                 raise Exception(str(res))
         except Exception, e:
@@ -592,19 +689,25 @@ class SecretState(State):
     def get_info(self, name):
         infos = {}
         infos['uuid'] = name
-        infos['xml'] = virsh.secret_dumpxml(name).stdout.splitlines()
+        res = virsh.secret_dumpxml(name, uri=self.uri)
+        infos['xml'] = res.stdout.splitlines()
         return infos
 
     def get_names(self):
-        lines = virsh.secret_list().stdout.strip().splitlines()[2:]
+        lines = virsh.secret_list(uri=self.uri).stdout.strip().splitlines()[2:]
         return [line.split()[0] for line in lines]
 
 
+# States of libvirt objects, which are checked through a connect URI.
+LIBVIRT_STATES = (DomainState, NetworkState, PoolState, SecretState)
+
+
 class MountState(State):
     name = 'mount'
     permit_keys = []
     permit_re = []
     info = {}
+    mtab = '/etc/mtab'
 
     def remove(self, name):
         info = name
@@ -629,7 +732,7 @@ class MountState(State):
 
         :return: A dict using mount point as keys and 6-element dict as value.
         """
-        lines = file('/etc/mtab').read().splitlines()
+        lines = file(self.mtab).read().splitlines()
         names = []
         for line in lines:
             values = line.split()
@@ -754,228 +857,3241 @@ class FileState(State):
                 '/etc/libvirt/qemu.conf']
 
 
-class LibvirtCI():
+class OutputBuffer():
 
-    def parse_args(self):
-        parser = optparse.OptionParser(
-            description='Continuouse integration of '
-            'virt-test libvirt test provider.')
-        parser.add_option('--list', dest='list', action='store_true',
-                          help='List all the test names')
-        parser.add_option('--no', dest='no', action='store', default='',
-                          help='Exclude specified tests.')
-        parser.add_option('--only', dest='only', action='store', default='',
-                          help='Run only for specified tests.')
-        parser.add_option('--no-check', dest='no_check', action='store_true',
-                          help='Disable checking state changes after each test.')
-        parser.add_option('--no-recover', dest='no_recover', action='store_true',
-                          help='Disable recover state changes after each test.')
-        parser.add_option('--connect-uri', dest='connect_uri', action='store',
-                          default='', help='Run tests using specified uri.')
-        parser.add_option('--additional-vms', dest='add_vms', action='store',
-                          default='', help='Additional VMs for testing')
-        parser.add_option('--smoke', dest='smoke', action='store_true',
-                          help='Run one test for each script.')
-        parser.add_option('--slice', dest='slice', action='store',
-                          default='', help='Specify a URL to slice tests.')
-        parser.add_option('--report', dest='report', action='store',
-                          default='xunit_result.xml',
-                          help='Exclude specified tests.')
-        parser.add_option('--white', dest='whitelist', action='store',
-                          default='', help='Whitelist file contains '
-                          'specified test cases to run.')
-        parser.add_option('--black', dest='blacklist', action='store',
-                          default='', help='Blacklist file contains '
-                          'specified test cases to be excluded.')
-        parser.add_option('--config', dest='config', action='store',
-                          default='', help='Specify a custom Cartesian cfg '
-                          'file')
-        parser.add_option('--img-url', dest='img_url', action='store',
-                          default='', help='Specify a URL to a custom image '
-                          'file')
-        parser.add_option('--os-variant', dest='os_variant', action='store',
-                          default='', help='Specify the --os-variant option '
-                          'when doing virt-install.')
-        parser.add_option('--password', dest='password', action='store',
-                          default='', help='Specify a password for logging '
-                          'into guest')
-        parser.add_option('--pull-virt-test', dest='virt_test_pull',
-                          action='store', default='',
-                          help='Merge specified virt-test pull requests. '
-                          'Multiple pull requests are separated by ",", '
-                          'example: --pull-virt-test 175,183')
-        parser.add_option('--pull-libvirt', dest='libvirt_pull',
-                          action='store', default='',
-                          help='Merge specified tp-libvirt pull requests. '
-                          'Multiple pull requests are separated by ",", '
-                          'example: --pull-libvirt 175,183')
-        parser.add_option('--with-dependence', dest='with_dependence',
-                          action='store_true',
-                          help='Merge virt-test pull requests depend on')
-        parser.add_option('--no-restore-pull', dest='no_restore_pull',
-                          action='store_true', help='Do not restore repo '
-                          'to branch master after test.')
-        parser.add_option('--only-change', dest='only_change',
-                          action='store_true', help='Only test tp-libvirt '
-                          'test cases related to changed files.')
-        parser.add_option('--fail-diff', dest='fail_diff',
-                          action='store_true', help='Report tests who do '
-                          'not clean up environment as a failure')
-        parser.add_option('--retain-vm', dest='retain_vm',
-                          action='store_true', help='Do not reinstall VM '
-                          'before tests')
-        parser.add_option('--pre-cmd', dest='pre_cmd',
-                          action='store', help='Run a command line after '
-                          'fetch the source code and before running the test.')
-        parser.add_option('--post-cmd', dest='post_cmd',
-                          action='store', help='Run a command line after '
-                          'running the test')
-        parser.add_option('--timeout', dest='timeout',
-                          action='store', default='1200',
-                          help='Maximum run time for one test case')
-        self.args, self.real_args = parser.parse_args()
+    """
+    Keep bounded head and tail lines of an output stream in memory.
+    """
 
-    def prepare_tests(self, whitelist='whitelist.test',
-                      blacklist='blacklist.test'):
-        """
-        Get all tests to be run.
+    def __init__(self, head_lines=200, tail_lines=800):
+        self.head_lines = head_lines
+        self.head = []
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.count = 0
 
-        When a whitelist is given, only tests in whitelist will be run.
-        When a blacklist is given, tests in blacklist will be excluded.
+    def append(self, line):
+        self.count += 1
+        if len(self.head) < self.head_lines:
+            self.head.append(line)
+        else:
+            self.tail.append(line)
+
+    def getvalue(self, log_path=None):
         """
-        def read_tests_from_file(file_name):
-            """
-            Read tests from a file
-            """
-            try:
-                tests = []
-                with open(file_name) as fp:
-                    for line in fp:
-                        if not line.strip().startswith('#'):
-                            tests.append(line.strip())
-                return tests
-            except IOError:
-                return None
+        Return kept lines with a mark where lines are omitted.
+        """
+        lines = list(self.head)
+        omitted = self.count - len(self.head) - len(self.tail)
+        if omitted:
+            lines.append('... %d lines omitted, full output in %s ...\n' %
+                         (omitted, log_path))
+        lines.extend(self.tail)
+        return ''.join(lines)
 
-        def get_all_tests():
-            """
-            Get all libvirt tests.
-            """
-            if type(self.onlys) == set and not self.onlys:
-                return []
 
-            cmd = './run -t libvirt --list-tests'
-            if self.args.connect_uri:
-                cmd += ' --connect-uri %s' % self.args.connect_uri
-            if self.nos:
-                cmd += ' --no %s' % ','.join(self.nos)
-            if self.onlys:
-                cmd += ' --tests %s' % ','.join(self.onlys)
-            if self.args.config:
-                cmd += ' -c %s' % self.args.config
-            res = utils.run(cmd)
-            out, err, exitcode = res.stdout, res.stderr, res.exit_status
-            tests = []
-            class_names = set()
-            for line in out.splitlines():
-                if line:
-                    if line[0].isdigit():
-                        test = re.sub(r'^[0-9]+ (.*) \(requires root\)$',
-                                      r'\1', line)
-                        if self.args.smoke:
-                            class_name, _ = self.split_name(test)
-                            if class_name in class_names:
-                                continue
-                            else:
-                                class_names.add(class_name)
-                        tests.append(test)
-            return tests
+class Watchdog():
 
-        def change_to_only(change_list):
-            """
-            Transform the content of a change file to a only set.
-            """
-            onlys = set()
-            for line in change_list:
-                filename = line.strip()
-                res = re.match('libvirt/tests/(cfg|src)/(.*).(cfg|py)',
-                               filename)
-                if res:
-                    cfg_path = 'libvirt/tests/cfg/%s.cfg' % res.groups()[1]
-                    tp_dir = data_dir.get_test_provider_dir(
-                        'io-github-autotest-libvirt')
-                    cfg_path = os.path.join(tp_dir, cfg_path)
-                    try:
-                        with open(cfg_path) as fcfg:
-                            only = fcfg.readline().strip()
-                            only = only.lstrip('-').rstrip(':').strip()
-                            onlys.add(only)
-                    except:
-                        pass
-            return onlys
+    """
+    Detect hung tests by watching test output and log files for activity.
+    """
 
-        self.nos = set(['io-github-autotest-qemu'])
-        self.onlys = None
+    check_interval = 5
 
-        if self.args.only:
-            self.onlys = set(self.args.only.split(','))
+    def __init__(self, idle_timeout, patterns=None):
+        """
+        :param idle_timeout: Seconds without activity before a test is
+                             considered hung. 0 disables the watchdog.
+        :param patterns: Glob patterns of files whose growth counts as
+                         activity, like virt-test debug and console logs.
+        """
+        self.idle_timeout = idle_timeout
+        self.patterns = patterns or []
+        self.files = {}
+        self.last_check = 0
+        self.touch()
 
-        if self.args.slice:
-            slices = {}
-            slice_opts = self.args.slice.split(',')
-            slice_url = slice_opts[0]
-            slice_opts = slice_opts[1:]
-            config = urllib2.urlopen(slice_url)
-            for line in config:
-                key, val = line.split()
-                slices[key] = val
-            for slice_opt in slice_opts:
-                if slice_opt in slices:
-                    if self.onlys is None:
-                        self.onlys = set(slices[slice_opt].split(','))
-                    else:
-                        self.onlys |= set(slices[slice_opt].split(','))
-                elif slice_opt == 'other':
-                    for key in slices:
-                        self.nos |= set(slices[key].split(','))
+    def touch(self):
+        """
+        Record activity now.
+        """
+        self.last_activity = time.time()
 
-        if self.args.no:
-            self.nos |= set(self.args.no.split(','))
-        if self.args.only_change:
-            if self.onlys is not None:
-                self.onlys &= change_to_only(self.libvirt_file_changed)
-            else:
-                self.onlys = change_to_only(self.libvirt_file_changed)
+    def scan(self):
+        """
+        Check watched files for changes since last scan.
+        """
+        files = {}
+        for pattern in self.patterns:
+            for path in glob.glob(pattern):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files[path] = (stat.st_size, stat.st_mtime)
+        if files != self.files:
+            self.files = files
+            self.touch()
 
-        if self.args.whitelist:
-            tests = read_tests_from_file(whitelist)
-        else:
-            tests = get_all_tests()
+    def is_idle(self):
+        """
+        Check whether there is no activity for more than idle_timeout.
+        """
+        if not self.idle_timeout:
+            return False
+        now = time.time()
+        if now - self.last_check >= self.check_interval:
+            self.last_check = now
+            self.scan()
+        return now - self.last_activity > self.idle_timeout
 
-        if self.args.blacklist:
-            black_tests = read_tests_from_file(blacklist)
-            tests = [t for t in tests if t not in black_tests]
 
-        with open('run.test', 'w') as fp:
-            for test in tests:
-                fp.write(test + '\n')
-        return tests
+class ResourceSampler():
 
-    def split_name(self, name):
+    """
+    Sample host CPU, memory, disk I/O and qemu memory usage from /proc on
+    a background thread while tests run.
+    """
+
+    metrics = ['cpu_percent', 'iowait_percent', 'mem_used_mb',
+               'disk_read_mbps', 'disk_write_mbps', 'qemu_rss_mb']
+
+    def __init__(self, interval):
         """
-        Try to return the module name of a test.
+        :param interval: Seconds between samples.
         """
-        if name.startswith('type_specific.io-github-autotest-libvirt'):
-            name = name.split('.', 2)[2]
+        self.interval = interval
+        try:
+            # Only physical disks, not loop, dm or md devices on top of them.
+            self.disks = [name for name in os.listdir('/sys/block')
+                          if os.path.exists('/sys/block/%s/device' % name)]
+        except OSError:
+            self.disks = []
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.totals = dict((metric, 0.0) for metric in self.metrics)
+        self.peaks = dict((metric, 0.0) for metric in self.metrics)
+
+    def read_cpu(self):
+        with open('/proc/stat') as fp:
+            values = [int(v) for v in fp.readline().split()[1:]]
+        idle, iowait = values[3], values[4]
+        return sum(values[:8]), idle + iowait, iowait
+
+    def read_disks(self):
+        read = written = 0
+        with open('/proc/diskstats') as fp:
+            for line in fp:
+                fields = line.split()
+                if fields[2] in self.disks:
+                    read += int(fields[5])
+                    written += int(fields[9])
+        return read * 512, written * 512
+
+    def read_mem_used(self):
+        info = {}
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                key, value = line.split(':', 1)
+                info[key] = int(value.split()[0])
+        available = info.get('MemAvailable', info['MemFree'])
+        return (info['MemTotal'] - available) / 1024.0
+
+    def read_qemu_rss(self):
+        rss = 0
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open('/proc/%s/comm' % pid) as fp:
+                    if not fp.read().startswith('qemu'):
+                        continue
+                with open('/proc/%s/status' % pid) as fp:
+                    for line in fp:
+                        if line.startswith('VmRSS:'):
+                            rss += int(line.split()[1])
+                            break
+            except IOError:
+                continue
+        return rss / 1024.0
 
-        if name.split('.')[0] in ['virsh']:
-            package_name, name = name.split('.', 1)
-        else:
-            package_name = ""
+    def sample(self, last):
+        """
+        Take a sample and add rates since the last sample.
 
-        names = name.split('.', 1)
-        if len(names) == 2:
-            name, test_name = names
+        :return: Counters to compute the next rates with.
+        """
+        now = time.time()
+        cpu = self.read_cpu()
+        disks = self.read_disks()
+        values = {'mem_used_mb': self.read_mem_used(),
+                  'qemu_rss_mb': self.read_qemu_rss()}
+        if last is not None:
+            last_time, last_cpu, last_disks = last
+            total = float(cpu[0] - last_cpu[0]) or 1.0
+            values['cpu_percent'] = 100 * (1 - (cpu[1] - last_cpu[1]) / total)
+            values['iowait_percent'] = 100 * (cpu[2] - last_cpu[2]) / total
+            elapsed = (now - last_time) or 1.0
+            values['disk_read_mbps'] = (
+                (disks[0] - last_disks[0]) / elapsed / 1048576)
+            values['disk_write_mbps'] = (
+                (disks[1] - last_disks[1]) / elapsed / 1048576)
+            with self.lock:
+                self.count += 1
+                for metric in self.metrics:
+                    self.totals[metric] += values[metric]
+                    self.peaks[metric] = max(self.peaks[metric],
+                                             values[metric])
+        return now, cpu, disks
+
+    def loop(self):
+        last = self.sample(None)
+        while not self.stop_event.wait(self.interval):
+            last = self.sample(last)
+        self.sample(last)
+
+    def start(self):
+        self.stop_event.clear()
+        self.reset()
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def split(self):
+        """
+        Get summary of samples since start or last split and start over.
+
+        :return: Dict of '<metric>_avg' and '<metric>_peak' figures.
+        """
+        with self.lock:
+            summary = {}
+            for metric in self.metrics:
+                average = self.totals[metric] / self.count if self.count else 0
+                summary['%s_avg' % metric] = round(average, 2)
+                summary['%s_peak' % metric] = round(self.peaks[metric], 2)
+            self.reset()
+        return summary
+
+    def stop(self):
+        """
+        Stop sampling and get the summary of the last samples.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.split()
+
+
+class TestExecutor():
+
+    """
+    Run a command and stream its output line by line.
+
+    Every line is written to a log file on disk as it arrives, while only
+    bounded head and tail buffers of stdout and stderr are kept in memory.
+    Status lines and error lines are parsed on the fly.
+    """
+
+    status_re = re.compile(
+        r'^\((\d+)/(\d+)\)\s+(\S+):\s+(\S+)(?:\s+\(([0-9.]+) s\))?')
+    max_line = 65536
+    max_errors = 100
+
+    def __init__(self, cmd, timeout, log_path=None, watchdog=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.log_path = log_path
+        self.watchdog = watchdog
+        self.log = None
+        self.timed_out = False
+        self.hung = False
+        # Time the whole command must finish by, or None.
+        self.deadline = None
+        self.start_time = self.last_progress = time.time()
+        self.new_segment()
+
+    def new_segment(self):
+        """
+        Start new output buffers and return the previous ones.
+        """
+        segment = getattr(self, 'segment', None)
+        self.segment = {'stdout': OutputBuffer(), 'stderr': OutputBuffer(),
+                        'statuses': [], 'errors': []}
+        return segment
+
+    def progress(self):
+        """
+        Reset the timeout countdown.
+        """
+        self.last_progress = time.time()
+
+    def expired(self):
+        """
+        Check whether the command is timed out or hung.
+        """
+        if self.watchdog is not None and self.watchdog.is_idle():
+            self.hung = True
+        now = time.time()
+        if self.deadline is not None and now > self.deadline:
+            return True
+        return self.hung or now - self.last_progress > self.timeout
+
+    def feed(self, source, line):
+        """
+        Process one line of output from source 'stdout' or 'stderr'.
+        """
+        if self.log is not None:
+            self.log.write(line)
+        if self.watchdog is not None:
+            self.watchdog.touch()
+        self.segment[source].append(line)
+        if source == 'stdout':
+            match = self.status_re.match(line)
+            if match:
+                self.segment['statuses'].append(match)
+                return match
+        elif 'ERROR' in line:
+            errors = self.segment['errors']
+            if len(errors) < self.max_errors:
+                errors.append(line.rstrip('\n'))
+
+    def result(self, exit_status, duration, segment=None):
+        """
+        Create a CmdResult from a segment of output.
+
+        The result carries the parsed 'statuses' and 'errors', the
+        'log_path' of full output and whether the test 'hung' as extra
+        attributes.
+        """
+        if segment is None:
+            segment = self.segment
+        res = utils.CmdResult(self.cmd,
+                              segment['stdout'].getvalue(self.log_path),
+                              segment['stderr'].getvalue(self.log_path),
+                              exit_status, duration)
+        res.statuses = segment['statuses']
+        res.errors = segment['errors']
+        res.log_path = self.log_path
+        res.hung = self.hung
+        if self.hung:
+            res.idle_timeout = self.watchdog.idle_timeout
+        return res
+
+    def open_log(self):
+        if self.log_path is not None:
+            log_dir = os.path.dirname(self.log_path)
+            if log_dir and not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+            self.log = open(self.log_path, 'w')
+
+    def close_log(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def run(self, handler=None):
+        """
+        Run the command until it exits or times out.
+
+        :param handler: A function called with (source, line, match) for
+                        each line, where match is the parsed status line.
+        :return: A CmdResult of the last output segment.
+        """
+        def read_pipe(pipe, source, queue):
+            while True:
+                line = pipe.readline(self.max_line)
+                if not line:
+                    break
+                queue.put((source, line))
+            pipe.close()
+            queue.put((source, None))
+
+        self.open_log()
+        try:
+            proc = subprocess.Popen(self.cmd, shell=True,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    preexec_fn=os.setsid)
+            queue = Queue.Queue()
+            readers = []
+            for pipe, source in ((proc.stdout, 'stdout'),
+                                 (proc.stderr, 'stderr')):
+                reader = threading.Thread(target=read_pipe,
+                                          args=(pipe, source, queue))
+                reader.daemon = True
+                reader.start()
+                readers.append(reader)
+
+            open_pipes = 2
+            while open_pipes:
+                try:
+                    source, line = queue.get(timeout=1)
+                except Queue.Empty:
+                    pass
+                else:
+                    if line is None:
+                        open_pipes -= 1
+                    else:
+                        match = self.feed(source, line)
+                        if handler is not None:
+                            handler(source, line, match)
+                # A test printing all the time must time out too.
+                if self.expired():
+                    self.timed_out = True
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    break
+            proc.wait()
+            for reader in readers:
+                reader.join(5)
+        finally:
+            self.close_log()
+        return self.result(proc.returncode, time.time() - self.start_time)
+
+
+class WarmRunner():
+
+    """
+    Run tests in a long-lived worker process which keeps virttest and
+    the parsed Cartesian config loaded between tests.
+
+    Requests and responses are JSON lines. Requests are written to the
+    worker's stdin and responses are read from a dedicated pipe, since
+    test output is redirected to per-test files by the worker.
+    """
+
+    def __init__(self, run_args, max_tests=50, script=None):
+        self.run_args = run_args
+        self.script = script or os.path.abspath(__file__)
+        self.max_tests = max_tests
+        self.proc = None
+        self.resp = None
+        self.count = 0
+        self.out_dir = tempfile.mkdtemp(prefix='virt-test-ci-warm-')
+
+    def start(self):
+        """
+        Start a new worker process.
+        """
+        rfd, wfd = os.pipe()
+        log = open(os.path.join(self.out_dir, 'worker.log'), 'a')
+        cmd = [sys.executable, self.script,
+               '--warm-worker', str(wfd)] + self.run_args
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=log, stderr=subprocess.STDOUT,
+                                         preexec_fn=os.setsid)
+        finally:
+            os.close(wfd)
+            log.close()
+        self.resp = os.fdopen(rfd, 'r')
+        self.count = 0
+
+    def stop(self):
+        """
+        Kill current worker process if any.
+        """
+        if self.proc is None:
+            return
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.wait()
+        self.resp.close()
+        self.proc, self.resp = None, None
+
+    def run(self, test, timeout, log_path=None, watchdog=None):
+        """
+        Run a test in the worker.
+
+        The worker is (re)started when it is not running or has run
+        max_tests tests, and killed when it times out, hangs or dies.
+        Output of the test is processed the same way as TestExecutor.
+
+        :return: A CmdResult of the test.
+        :raise CmdError: when the test timed out.
+        """
+        if self.proc is not None and (self.proc.poll() is not None or
+                                      self.count >= self.max_tests):
+            self.stop()
+        if self.proc is None:
+            self.start()
+        self.count += 1
+
+        out_path = os.path.join(self.out_dir, 'stdout')
+        err_path = os.path.join(self.out_dir, 'stderr')
+        request = {'test': test, 'stdout': out_path, 'stderr': err_path}
+        cmd = 'warm:%s' % test
+        if watchdog is not None:
+            watchdog.patterns = watchdog.patterns + [out_path, err_path]
+        executor = TestExecutor(cmd, timeout, log_path, watchdog)
+        start_time = time.time()
+        response = None
+        try:
+            self.proc.stdin.write(json.dumps(request) + '\n')
+            self.proc.stdin.flush()
+            while time.time() - start_time < timeout:
+                ready, _, _ = select.select([self.resp], [], [], 1)
+                if ready:
+                    line = self.resp.readline()
+                    if line:
+                        response = json.loads(line)
+                    break
+                if watchdog is not None and watchdog.is_idle():
+                    executor.hung = True
+                    break
+        except (IOError, ValueError), e:
+            print 'Warm worker failed: %s' % e
+        duration = time.time() - start_time
+
+        executor.open_log()
+        try:
+            for path, source in ((out_path, 'stdout'), (err_path, 'stderr')):
+                try:
+                    with open(path) as fp:
+                        while True:
+                            line = fp.readline(executor.max_line)
+                            if not line:
+                                break
+                            executor.feed(source, line)
+                    os.remove(path)
+                except IOError:
+                    pass
+        finally:
+            executor.close_log()
+
+        if response is None:
+            timed_out = self.proc.poll() is None
+            self.stop()
+            res = executor.result(-1, duration)
+            if timed_out:
+                raise error.CmdError(cmd, res, 'Warm worker timed out')
+            return res
+        return executor.result(response['exit_status'], duration)
+
+    def close(self):
+        """
+        Stop the worker and remove its temporary files.
+        """
+        self.stop()
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+
+
+class History():
+
+    """
+    Persistent history of test results in a SQLite database.
+
+    Each CI run is a row in table 'runs' with the host and the commit
+    SHAs of tested repos. Each finished test is a row in table 'results'.
+    """
+
+    columns = [('run_id', 'INTEGER'), ('class', 'TEXT'), ('diff', 'INTEGER')]
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.run_id = None
+        self.conn.execute('CREATE TABLE IF NOT EXISTS runs '
+                          '(id INTEGER PRIMARY KEY, host TEXT, '
+                          'virt_test_sha TEXT, libvirt_sha TEXT, '
+                          'timestamp REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results '
+                          '(test TEXT, status TEXT, duration REAL, '
+                          'timestamp REAL)')
+        # Upgrade databases created before runs were recorded.
+        existing = [row[1] for row in
+                    self.conn.execute('PRAGMA table_info(results)')]
+        for name, type_ in self.columns:
+            if name not in existing:
+                self.conn.execute('ALTER TABLE results ADD COLUMN "%s" %s' %
+                                  (name, type_))
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_test '
+                          'ON results (test)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_run '
+                          'ON results (run_id)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS passes '
+                          '(key TEXT PRIMARY KEY, test TEXT, run_id INTEGER, '
+                          'timestamp REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS signatures '
+                          '(signature TEXT PRIMARY KEY, pattern TEXT, '
+                          'first_seen REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS failures '
+                          '(signature TEXT, test TEXT, run_id INTEGER, '
+                          'message TEXT, timestamp REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS failures_signature '
+                          'ON failures (signature, run_id)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS failures_run '
+                          'ON failures (run_id)')
+        self.conn.commit()
+
+    def start_run(self, host, virt_test_sha, libvirt_sha):
+        """
+        Record a new run which following results belong to.
+        """
+        cur = self.conn.execute(
+            'INSERT INTO runs (host, virt_test_sha, libvirt_sha, timestamp) '
+            'VALUES (?, ?, ?, ?)',
+            (host, virt_test_sha, libvirt_sha, time.time()))
+        self.conn.commit()
+        self.run_id = cur.lastrowid
+        return self.run_id
+
+    def add(self, test, class_name, status, duration):
+        """
+        Record the result of a finished test.
+        """
+        self.conn.execute(
+            'INSERT INTO results (test, status, duration, timestamp, '
+            'run_id, "class", diff) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (test, status, duration, time.time(), self.run_id, class_name,
+             int('DIFF' in status)))
+        self.conn.commit()
+
+    def durations(self, test, limit=100):
+        """
+        Get durations of the latest runs of a test which did not time out.
+        """
+        cur = self.conn.execute(
+            "SELECT duration FROM results WHERE test = ? AND "
+            "status NOT LIKE '%TIMEOUT%' AND status NOT LIKE '%CACHED%' "
+            "ORDER BY timestamp DESC LIMIT ?", (test, limit))
+        return [row[0] for row in cur]
+
+    def average_durations(self):
+        """
+        Get average durations of all tests in runs which did not time out.
+        """
+        cur = self.conn.execute(
+            "SELECT test, AVG(duration) FROM results WHERE "
+            "status NOT LIKE '%TIMEOUT%' AND status NOT LIKE '%CACHED%' "
+            "GROUP BY test")
+        return dict(cur.fetchall())
+
+    def statuses(self, test, limit=2):
+        """
+        Get statuses of the latest runs of a test, newest first.
+        """
+        cur = self.conn.execute(
+            "SELECT status FROM results WHERE test = ? AND "
+            "status NOT LIKE '%CACHED%' ORDER BY timestamp DESC LIMIT ?",
+            (test, limit))
+        return [row[0] for row in cur]
+
+    def flaky_tests(self, min_runs):
+        """
+        Get tests which passed on retry in at least min_runs runs.
+        """
+        cur = self.conn.execute(
+            "SELECT test FROM results WHERE status LIKE '%FLAKY%' "
+            "GROUP BY test HAVING COUNT(DISTINCT run_id) >= ?", (min_runs,))
+        return [row[0] for row in cur]
+
+    def add_pass(self, key, test):
+        """
+        Record a clean pass of a test with inputs hashed as key.
+        """
+        self.conn.execute('INSERT OR REPLACE INTO passes VALUES (?, ?, ?, ?)',
+                          (key, test, self.run_id, time.time()))
+        self.conn.commit()
+
+    def find_pass(self, key):
+        """
+        Get (run_id, timestamp) of the clean pass recorded for key.
+        """
+        return self.conn.execute(
+            'SELECT run_id, timestamp FROM passes WHERE key = ?',
+            (key,)).fetchone()
+
+    def add_failures(self, test, signatures):
+        """
+        Record failure signatures of a test.
+
+        :param signatures: List of (signature, pattern, message) from
+                           FailureSignature.extract().
+        """
+        now = time.time()
+        for signature, pattern, message in signatures:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO signatures (signature, pattern, '
+                'first_seen) VALUES (?, ?, ?)', (signature, pattern, now))
+            self.conn.execute(
+                'INSERT INTO failures (signature, test, run_id, message, '
+                'timestamp) VALUES (?, ?, ?, ?, ?)',
+                (signature, test, self.run_id, message, now))
+        self.conn.commit()
+
+    def clusters(self, runs=1, limit=10):
+        """
+        Get the most common failure signatures in the latest runs.
+
+        :return: List of (signature, pattern, number of tests, number of
+                 failures, an example message).
+        """
+        return self.conn.execute(
+            'SELECT f.signature, s.pattern, COUNT(DISTINCT f.test), '
+            'COUNT(*), MAX(f.message) FROM failures f '
+            'JOIN signatures s ON s.signature = f.signature '
+            'WHERE f.run_id IN (SELECT id FROM runs ORDER BY id DESC '
+            'LIMIT ?) GROUP BY f.signature ORDER BY COUNT(DISTINCT f.test) '
+            'DESC, COUNT(*) DESC LIMIT ?', (runs, limit)).fetchall()
+
+    def find_signatures(self, query):
+        """
+        Get signatures whose ID starts with query or whose pattern
+        contains query normalized.
+        """
+        pattern = FailureSignature.normalize(query)
+        return self.conn.execute(
+            "SELECT signature, pattern FROM signatures WHERE signature "
+            "LIKE ? || '%' OR pattern LIKE '%' || ? || '%'",
+            (query, pattern)).fetchall()
+
+    def signature_tests(self, signature, runs=10):
+        """
+        Get tests failed with a signature in the latest runs.
+
+        :return: List of (test, number of runs, last timestamp).
+        """
+        return self.conn.execute(
+            'SELECT test, COUNT(DISTINCT run_id), MAX(timestamp) '
+            'FROM failures WHERE signature = ? AND run_id IN '
+            '(SELECT id FROM runs ORDER BY id DESC LIMIT ?) '
+            'GROUP BY test ORDER BY COUNT(DISTINCT run_id) DESC, test',
+            (signature, runs)).fetchall()
+
+    def run_results(self, runs=10):
+        """
+        Get results of the latest runs, oldest run first.
+
+        :return: List of runs, each a list of (test, status, duration) in
+                 the order they were recorded.
+        """
+        run_ids = [row[0] for row in self.conn.execute(
+            'SELECT id FROM runs ORDER BY id DESC LIMIT ?', (runs,))]
+        return [self.conn.execute(
+            'SELECT test, status, duration FROM results WHERE run_id = ? '
+            'ORDER BY rowid', (run_id,)).fetchall()
+            for run_id in reversed(run_ids)]
+
+    def close(self):
+        self.conn.close()
+
+
+# Orders of tests supported by history_order().
+ORDERS = ['listing', 'failed-first', 'shortest-first', 'changed-first']
+
+
+def history_order(tests, order, history):
+    """
+    Reorder tests by recorded history.
+
+    failed-first runs tests whose last result is not PASS first.
+    shortest-first runs tests by ascending average duration.
+    changed-first runs new tests and tests whose last two results
+    differ first. Listing order is kept between equal tests.
+
+    :param history: History, or an object with statuses() and durations()
+                    like it. Tests are not reordered when None.
+    """
+    if order == 'listing' or history is None:
+        return list(tests)
+
+    def key(test):
+        if order == 'failed-first':
+            statuses = history.statuses(test, 1)
+            return int(bool(statuses) and statuses[0] == 'PASS')
+        elif order == 'shortest-first':
+            durations = history.durations(test)
+            if not durations:
+                return 0
+            return sum(durations) / len(durations)
+        elif order == 'changed-first':
+            statuses = history.statuses(test, 2)
+            return int(len(statuses) == 2 and
+                       statuses[0] == statuses[1])
+
+    return sorted(tests, key=key)
+
+
+def history_timeout(test, timeout, history, adaptive=None):
+    """
+    Get the timeout of a test.
+
+    With adaptive timeouts, the 99th percentile of recorded durations
+    multiplied by the factor is used, bounded by the floor and ceiling.
+
+    :param history: History, or an object with durations() like it.
+    :param adaptive: Tuple of factor, floor and ceiling, or None to always
+                     use timeout.
+    """
+    if adaptive is None or history is None:
+        return timeout
+    durations = sorted(history.durations(test))
+    if len(durations) < 3:
+        return timeout
+    factor, floor, ceiling = adaptive
+    rank = int(math.ceil(len(durations) * 0.99)) - 1
+    return int(math.ceil(min(max(durations[rank] * factor, floor),
+                              ceiling)))
+
+
+class FailureSignature():
+
+    """
+    Normalize error messages to signatures which group the same failure
+    of different tests and runs.
+    """
+
+    subs = [
+        (re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                    r'[0-9a-f]{12}', re.I), '<uuid>'),
+        (re.compile(r'\b(?:[0-9a-f]{2}:){5}[0-9a-f]{2}\b', re.I), '<mac>'),
+        (re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}\b'), '<ip>'),
+        (re.compile(r'(?:[\w.@+-]*/)+[\w.@+-]+'), '<path>'),
+        (re.compile(r'\b(domain|guest|vm)\s+(?:\'[^\']*\'|"[^"]*")', re.I),
+         r'\1 <domain>'),
+        (re.compile(r'\bvirt-tests-vm\d*\b'), '<domain>'),
+        (re.compile(r'\b0x[0-9a-f]+\b|\b[0-9a-f]*\d[0-9a-f]*[a-f][0-9a-f]*\b'
+                    r'|\b[0-9a-f]*[a-f][0-9a-f]*\d[0-9a-f]*\b', re.I),
+         '<hex>'),
+        (re.compile(r'\d+(?:\.\d+)?'), '<n>'),
+        (re.compile(r'\s+'), ' '),
+    ]
+    error_re = re.compile(r'error|fail|exception|traceback|hung', re.I)
+
+    @classmethod
+    def normalize(cls, message):
+        for regex, repl in cls.subs:
+            message = regex.sub(repl, message)
+        return message.strip()
+
+    @classmethod
+    def extract(cls, status, err_msg):
+        """
+        Get distinct signatures of error messages of a failed test.
+
+        :return: List of (signature, pattern, message).
+        """
+        lines = [line.strip() for line in err_msg
+                 if line.strip() and 'Full output in' not in line]
+        if status.split()[0] in ('INVALID', 'TIMEOUT'):
+            # These messages are the whole stdout of the test.
+            lines = [line for line in lines if cls.error_re.search(line)]
+        if not lines:
+            lines = [status.split()[0]]
+        signatures = []
+        seen = set()
+        for line in lines:
+            pattern = cls.normalize(line)
+            signature = hashlib.sha1(pattern).hexdigest()[:12]
+            if signature not in seen:
+                seen.add(signature)
+                signatures.append((signature, pattern, line))
+        return signatures
+
+
+class Progress():
+
+    """
+    Progress of a run. It is updated by the test loop and read by the
+    status server thread.
+    """
+
+    flags = ('diff', 'flaky', 'quarantined', 'cached')
+
+    def __init__(self, tests, expected):
+        """
+        :param tests: Tests to run.
+        :param expected: Dict of test names to expected durations.
+        """
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.total = len(tests)
+        self.expected = expected
+        self.results = {}
+        self.counts = collections.defaultdict(int)
+        self.current = []
+        self.current_start = None
+        self.remaining = 0.0
+        self.unknown = 0
+        for test in tests:
+            if test in expected:
+                self.remaining += expected[test]
+            else:
+                self.unknown += 1
+        self.known_time = 0.0
+        self.known_count = 0
+
+    def begin(self, tests):
+        with self.lock:
+            self.current = list(tests)
+            self.current_start = time.time()
+
+    def finish(self, test, status, duration):
+        """
+        Record the result of a test. A test finished again, like on retry,
+        replaces its previous result.
+        """
+        words = status.lower().split()
+        keys = [words[0]] + [flag for flag in self.flags if flag in words]
+        with self.lock:
+            if test in self.results:
+                for key in self.results[test]:
+                    self.counts[key] -= 1
+            else:
+                if test in self.expected:
+                    self.remaining -= self.expected[test]
+                else:
+                    self.unknown -= 1
+                self.known_time += duration
+                self.known_count += 1
+            self.results[test] = keys
+            for key in keys:
+                self.counts[key] += 1
+            if test in self.current:
+                self.current.remove(test)
+
+    def status(self):
+        with self.lock:
+            now = time.time()
+            average = 0.0
+            if self.known_count:
+                average = self.known_time / self.known_count
+            elif self.expected:
+                average = sum(self.expected.values()) / len(self.expected)
+            eta = max(self.remaining, 0.0) + self.unknown * average
+            current_elapsed = None
+            if self.current and self.current_start is not None:
+                current_elapsed = now - self.current_start
+                current = sum(self.expected.get(test, average)
+                              for test in self.current)
+                eta -= current - max(current - current_elapsed, 0.0)
+            return {'total': self.total,
+                    'done': len(self.results),
+                    'current': list(self.current),
+                    'current_elapsed': current_elapsed,
+                    'elapsed': now - self.start_time,
+                    'counts': dict((key, count) for key, count
+                                   in self.counts.items() if count),
+                    'eta': eta}
+
+
+class StatusServer():
+
+    """
+    Serve progress of a run as JSON over HTTP on a local port or a Unix
+    socket.
+    """
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = json.dumps(self.server.progress.status())
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class TCPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    class UnixServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+    def __init__(self, address, progress):
+        """
+        :param address: Path of a Unix socket, or '[host:]port' to listen
+                        on. Host defaults to 127.0.0.1.
+        :param progress: Progress to serve.
+        """
+        self.address = address
+        self.progress = progress
+        self.server = None
+
+    def start(self):
+        if '/' in self.address:
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.server = self.UnixServer(self.address, self.Handler)
+        else:
+            host, _, port = self.address.rpartition(':')
+            self.server = self.TCPServer((host or '127.0.0.1', int(port)),
+                                         self.Handler)
+        self.server.progress = self.progress
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        print 'Serving progress on %s' % self.address
+
+    def close(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        if '/' in self.address and os.path.exists(self.address):
+            os.remove(self.address)
+        self.server = None
+
+
+class Journal():
+
+    """
+    Append-only journal of a run, used to resume it after a crash.
+
+    Records are pickled dicts with a 'type' key, synced to disk one
+    by one, so a crash can at most lose the record being written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+        self.valid_size = None
+
+    def load(self):
+        """
+        Load records of last run.
+
+        :return: A dict with the 'tests' to run, the 'run_id' in history,
+                 the 'states' baselines and the list of finished 'results'.
+        """
+        run = {'tests': None, 'run_id': None, 'states': None, 'results': []}
+        try:
+            fp = open(self.path, 'rb')
+        except IOError:
+            return run
+        self.valid_size = 0
+        with fp:
+            while True:
+                try:
+                    record = pickle.load(fp)
+                except EOFError:
+                    break
+                except Exception:
+                    print 'Warning: Ignoring truncated journal record'
+                    break
+                self.valid_size = fp.tell()
+                if record['type'] == 'result':
+                    run['results'].append(record)
+                else:
+                    run[record['type']] = record[record['type']]
+        return run
+
+    def start(self):
+        """
+        Truncate the journal for a new run.
+        """
+        self.close()
+        self.fp = open(self.path, 'wb')
+        self.valid_size = None
+
+    def write(self, record_type, **record):
+        if self.fp is None:
+            self.fp = open(self.path, 'ab')
+            # Drop a truncated record left by a crash before appending.
+            if self.valid_size is not None:
+                self.fp.truncate(self.valid_size)
+        record['type'] = record_type
+        pickle.dump(record, self.fp, pickle.HIGHEST_PROTOCOL)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+
+class ResultCache():
+
+    """
+    Content-addressed cache of clean passes.
+
+    The key of a test is a hash of its cfg/src files in tp-libvirt, the
+    virttest tree, shared and libvirt backend cfgs, shared provider code
+    of tp-libvirt, the Cartesian cfg file and ./run options including the
+    connect URI, libvirt and qemu package versions and the guest image
+    digest. A test whose key matches a recorded PASS without DIFF does
+    not need to run again.
+    """
+
+    packages = ['libvirt', 'qemu-kvm', 'qemu-system-x86']
+
+    def __init__(self, history, root_dir, provider_dir, image_digest,
+                 run_args=(), config=''):
+        """
+        :param run_args: ./run options shared by all tests.
+        :param config: Custom Cartesian cfg file, relative to root_dir.
+        """
+        self.history = history
+        self.test_files = self.index_test_files(provider_dir)
+        env_hash = hashlib.sha1()
+        for path in (os.path.join(root_dir, 'virttest'),
+                     os.path.join(root_dir, 'shared', 'cfg'),
+                     os.path.join(root_dir, 'backends', 'libvirt', 'cfg'),
+                     os.path.join(provider_dir, 'provider')):
+            env_hash.update(os.path.basename(path))
+            self.update_tree(env_hash, path)
+        config = os.path.join(root_dir, config)
+        if os.path.isfile(config):
+            env_hash.update(self.file_digest(config))
+        env_hash.update(' '.join(run_args))
+        cmd = 'rpm -q %s' % ' '.join(self.packages)
+        env_hash.update(utils.run(cmd, ignore_status=True).stdout)
+        env_hash.update(image_digest or '')
+        self.env_key = env_hash.hexdigest()
+
+    @staticmethod
+    def file_digest(path):
+        """
+        Get SHA1 hex digest of a file's content.
+        """
+        digest = hashlib.sha1()
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def update_tree(self, digest, top_dir):
+        """
+        Update a hash with the paths and contents of files under a dir.
+        """
+        for dirpath, dirnames, filenames in os.walk(top_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith('.pyc'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                digest.update(os.path.relpath(path, top_dir))
+                digest.update(self.file_digest(path))
+
+    def index_test_files(self, provider_dir):
+        """
+        Map the top variant name of each tp-libvirt cfg file to the cfg
+        file and its src file.
+        """
+        index = {}
+        cfg_dir = os.path.join(provider_dir, 'libvirt', 'tests', 'cfg')
+        src_dir = os.path.join(provider_dir, 'libvirt', 'tests', 'src')
+        for dirpath, _, filenames in os.walk(cfg_dir):
+            for filename in filenames:
+                if not filename.endswith('.cfg'):
+                    continue
+                cfg_path = os.path.join(dirpath, filename)
+                with open(cfg_path) as fcfg:
+                    name = fcfg.readline().strip()
+                name = name.lstrip('-').rstrip(':').strip()
+                rel_path = os.path.relpath(cfg_path, cfg_dir)[:-len('.cfg')]
+                index[name] = [cfg_path,
+                               os.path.join(src_dir, rel_path + '.py')]
+        return index
+
+    def key(self, test):
+        """
+        Get the cache key of a test.
+        """
+        name = test
+        if name.startswith('type_specific.io-github-autotest-libvirt'):
+            name = name.split('.', 2)[2]
+        parts = name.split('.')
+        files = []
+        for idx in range(len(parts), 0, -1):
+            prefix = '.'.join(parts[:idx])
+            if prefix in self.test_files:
+                files = self.test_files[prefix]
+                break
+        digest = hashlib.sha1(self.env_key)
+        digest.update(test)
+        for path in files:
+            if os.path.exists(path):
+                digest.update(self.file_digest(path))
+        return digest.hexdigest()
+
+    def lookup(self, test):
+        """
+        Find a clean pass of a test with the same key.
+
+        :return: A tuple of the key and the recorded pass or None.
+        """
+        key = self.key(test)
+        return key, self.history.find_pass(key)
+
+
+class HealthCheck():
+
+    """
+    A check of the test guest before each test.
+    """
+    name = None
+
+    def check(self, gate):
+        """
+        Check the guest from gate.xml and gate.tree.
+
+        :return: A message of the problem found, or None.
+        """
+        raise NotImplementedError('Function check not implemented for %s.'
+                                  % self.__class__.__name__)
+
+    def repair(self, gate):
+        """
+        Repair the problem found. Checks which need the domain defined
+        again set gate.define_xml.
+        """
+        raise NotImplementedError('Function repair not implemented for %s.'
+                                  % self.__class__.__name__)
+
+
+class DefinedCheck(HealthCheck):
+    name = 'defined'
+
+    def check(self, gate):
+        if gate.xml is None:
+            return 'Guest %s is not defined' % gate.vm_name
+
+    def repair(self, gate):
+        if gate.good_xml is None:
+            raise Exception('No known-good XML to define guest %s' %
+                            gate.vm_name)
+        gate.define_xml = gate.good_xml
+
+
+class NvramCheck(HealthCheck):
+    name = 'nvram'
+
+    def check(self, gate):
+        nvram = gate.tree.find('os/nvram')
+        if (nvram is not None and nvram.text and
+                not os.path.exists(nvram.text)):
+            return 'nvram in XML, but file %s do not exists' % nvram.text
+
+    def repair(self, gate):
+        xml = gate.define_xml or gate.xml
+        gate.define_xml = re.sub('<nvram.*</nvram>', '', xml)
+
+
+class DiskCheck(HealthCheck):
+    name = 'disk'
+
+    def missing(self, tree):
+        missing = []
+        for source in tree.findall("devices/disk[@device='disk']/source"):
+            path = source.get('file')
+            if path and not os.path.exists(path):
+                missing.append(path)
+        return missing
+
+    def check(self, gate):
+        missing = self.missing(gate.tree)
+        if missing:
+            return 'Disk images %s do not exist' % ', '.join(missing)
+
+    def repair(self, gate):
+        if (gate.good_xml is None or gate.good_xml == gate.xml or
+                self.missing(ElementTree.fromstring(gate.good_xml))):
+            raise Exception('No known-good XML with existing disk images '
+                            'for guest %s' % gate.vm_name)
+        gate.define_xml = gate.good_xml
+
+
+class NetworkCheck(HealthCheck):
+    name = 'network'
+    status_dir = '/var/run/libvirt/network'
+
+    @staticmethod
+    def local_system(uri):
+        """
+        Check whether uri is served by the local system libvirtd, which
+        keeps its network status in status_dir.
+        """
+        parts = urlparse.urlsplit(uri)
+        return not parts.netloc and parts.path.rstrip('/') in ('', '/system')
+
+    def networks(self, gate):
+        return set(source.get('network') for source in gate.tree.findall(
+            "devices/interface[@type='network']/source"))
+
+    def inactive(self, gate):
+        networks = self.networks(gate)
+        if not networks:
+            return []
+        if self.local_system(gate.uri) and os.path.isdir(self.status_dir):
+            # libvirtd keeps a status file for each active network.
+            return sorted(net for net in networks if not os.path.exists(
+                os.path.join(self.status_dir, '%s.xml' % net)))
+        states = virsh.net_state_dict(uri=gate.uri)
+        return sorted(net for net in networks
+                      if not states.get(net, {}).get('active'))
+
+    def check(self, gate):
+        inactive = self.inactive(gate)
+        if inactive:
+            return 'Networks %s are not active' % ', '.join(inactive)
+
+    def repair(self, gate):
+        for net in self.inactive(gate):
+            res = virsh.net_start(net, ignore_status=True, uri=gate.uri)
+            if res.exit_status:
+                raise Exception('Failed to start network %s:\n%s' % (net, res))
+
+
+class HealthGate():
+
+    """
+    Check and repair the test guest before each test.
+
+    The XML of the guest is cached when all checks pass. Dumping the XML
+    is skipped while the persistent config of the guest is unchanged, and
+    problems are repaired from the cached XML.
+    """
+
+    available = [DefinedCheck, NvramCheck, DiskCheck, NetworkCheck]
+
+    def __init__(self, vm_name, uri, names=None):
+        """
+        :param vm_name: Name of the guest.
+        :param uri: Libvirt connection URI.
+        :param names: Names of checks to run. All checks if None.
+        """
+        self.vm_name = vm_name
+        self.uri = uri
+        self.checks = []
+        for check_class in self.available:
+            if names is None or check_class.name in names:
+                self.checks.append(check_class())
+        self.good_xml = None
+        self.good_digest = None
+        self.good_stat = None
+        self.xml = None
+        self.tree = None
+        self.define_xml = None
+
+    def config_stat(self):
+        """
+        Get stat of the persistent config file of the guest, or None if
+        it is not readable. Only the local system libvirtd keeps the file
+        under /etc/libvirt, so other URIs always get None.
+        """
+        if not NetworkCheck.local_system(self.uri or ''):
+            return None
+        driver = 'lxc' if 'lxc' in (self.uri or '') else 'qemu'
+        path = '/etc/libvirt/%s/%s.xml' % (driver, self.vm_name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def load(self):
+        """
+        Get current XML of the guest, dumping it only if it may have
+        changed since the last good check.
+        """
+        stat = self.config_stat()
+        if stat is not None and stat == self.good_stat:
+            self.xml = self.good_xml
+        else:
+            res = virsh.dumpxml(self.vm_name, extra='--inactive',
+                                ignore_status=True, uri=self.uri)
+            if res.exit_status:
+                logging.warning('Failed to dumpxml from %s\n%s',
+                                self.vm_name, res)
+                self.xml = None
+            else:
+                self.xml = res.stdout
+        self.tree = None
+        if self.xml is not None:
+            self.tree = ElementTree.fromstring(self.xml)
+        return stat
+
+    def define(self, xml):
+        virsh.destroy(self.vm_name, ignore_status=True, uri=self.uri)
+        virsh.undefine(self.vm_name, '--snapshots-metadata --managed-save',
+                       ignore_status=True, uri=self.uri)
+        xmlfile = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+        try:
+            xmlfile.write(xml)
+            xmlfile.close()
+            res = virsh.define(xmlfile.name, ignore_status=True, uri=self.uri)
+        finally:
+            os.remove(xmlfile.name)
+        if res.exit_status:
+            logging.error('Define command result:\n%s', res)
+            raise Exception('Failed to define domain for XML:\n%s' % xml)
+
+    def problems(self):
+        """
+        Run all checks in one pass over the loaded XML.
+
+        :return: List of (check, message) of failed checks.
+        """
+        problems = []
+        for check in self.checks:
+            if self.tree is None and check.name != 'defined':
+                continue
+            message = check.check(self)
+            if message:
+                problems.append((check, message))
+        return problems
+
+    def run(self):
+        """
+        Check the guest and repair problems found.
+
+        :return: List of messages of problems found.
+        """
+        stat = self.load()
+        digest = None
+        if self.xml is not None:
+            digest = hashlib.sha1(self.xml).hexdigest()
+        problems = self.problems()
+        if problems:
+            self.define_xml = None
+            for check, message in problems:
+                logging.warning('%s. Repairing guest %s. XML:\n%s', message,
+                                self.vm_name, self.xml)
+                try:
+                    check.repair(self)
+                except Exception, e:
+                    logging.error('Failed to repair %s check: %s',
+                                  check.name, e)
+            if self.define_xml is not None:
+                self.define(self.define_xml)
+            stat = self.load()
+            digest = None
+            if self.xml is not None:
+                digest = hashlib.sha1(self.xml).hexdigest()
+            if self.problems():
+                return [message for _, message in problems]
+        if digest is not None and digest != self.good_digest:
+            self.good_xml, self.good_digest = self.xml, digest
+        self.good_stat = stat
+        return [message for _, message in problems]
+
+
+class GuestSnapshot():
+
+    """
+    A saved running guest to restore instead of booting it.
+
+    The memory state is saved with 'virsh save' and the disk state with
+    an internal qcow2 snapshot taken at the same time, so both can be
+    reverted together. The snapshot is invalid once the inactive domain
+    XML changes or the disk image is replaced.
+    """
+
+    tag = 'virt-test-ci-warm'
+
+    def __init__(self, vm_name, save_dir, uri='', boot_timeout=300):
+        self.vm_name = vm_name
+        self.save_path = os.path.join(save_dir, '%s.save' % vm_name)
+        self.uri = uri
+        self.boot_timeout = boot_timeout
+        self.xml_digest = None
+        self.image = None
+        self.image_inode = None
+
+    def inactive_xml(self):
+        res = virsh.dumpxml(self.vm_name, extra='--inactive',
+                            ignore_status=True, uri=self.uri)
+        if res.exit_status:
+            return None
+        return res.stdout
+
+    def booted(self):
+        """
+        Check whether the guest is running and has booted, which is when
+        its guest agent answers or its interface got an address.
+        """
+        res = virsh.domstate(self.vm_name, ignore_status=True, uri=self.uri)
+        if res.exit_status or res.stdout.strip() != 'running':
+            return False
+        res = virsh.command(
+            "qemu-agent-command %s '{\"execute\":\"guest-ping\"}'" %
+            self.vm_name, ignore_status=True, uri=self.uri)
+        if not res.exit_status:
+            return True
+        res = virsh.command('domifaddr %s' % self.vm_name,
+                            ignore_status=True, uri=self.uri)
+        return not res.exit_status and 'ipv4' in res.stdout
+
+    def wait_booted(self):
+        """
+        Wait until the guest has booted or boot_timeout passes.
+        """
+        deadline = time.time() + self.boot_timeout
+        while not self.booted():
+            if time.time() > deadline:
+                return False
+            time.sleep(2)
+        return True
+
+    def create(self):
+        """
+        Boot the guest, then save its memory and disk state.
+
+        :return: True when the snapshot is created.
+        """
+        self.discard()
+        xml = self.inactive_xml()
+        if xml is None:
+            return False
+        match = re.search(r"<disk[^>]*device=.disk.*?<source file=.([^'\"]*)",
+                          xml, re.S)
+        if not match:
+            logging.warning('No disk image found for guest snapshot')
+            return False
+        self.image = match.group(1)
+
+        print 'Creating guest snapshot of %s' % self.vm_name
+        sys.stdout.flush()
+        res = virsh.start(self.vm_name, ignore_status=True, uri=self.uri)
+        if res.exit_status:
+            logging.warning('Failed to start guest for snapshot:\n%s', res)
+            return False
+        if not self.wait_booted():
+            logging.warning('Guest did not boot in %s s for snapshot',
+                            self.boot_timeout)
+            virsh.destroy(self.vm_name, ignore_status=True, uri=self.uri)
+            return False
+        save_dir = os.path.dirname(self.save_path)
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+        res = virsh.command('save %s %s' % (self.vm_name, self.save_path),
+                            ignore_status=True, uri=self.uri)
+        if res.exit_status:
+            logging.warning('Failed to save guest:\n%s', res)
+            virsh.destroy(self.vm_name, ignore_status=True, uri=self.uri)
+            return False
+        res = utils.run('qemu-img snapshot -c %s %s' % (self.tag, self.image),
+                        ignore_status=True)
+        if res.exit_status:
+            logging.warning('Failed to snapshot guest disk:\n%s', res)
+            os.remove(self.save_path)
+            return False
+        self.xml_digest = hashlib.sha1(xml).hexdigest()
+        self.image_inode = os.stat(self.image).st_ino
+        return True
+
+    def valid(self):
+        """
+        Check whether the snapshot matches current domain XML and image.
+        """
+        if self.xml_digest is None or not os.path.exists(self.save_path):
+            return False
+        xml = self.inactive_xml()
+        if xml is None or hashlib.sha1(xml).hexdigest() != self.xml_digest:
+            return False
+        try:
+            return os.stat(self.image).st_ino == self.image_inode
+        except OSError:
+            return False
+
+    def discard(self):
+        """
+        Remove saved memory and disk state.
+        """
+        if os.path.exists(self.save_path):
+            os.remove(self.save_path)
+        if self.image is not None and os.path.exists(self.image):
+            utils.run('qemu-img snapshot -d %s %s' % (self.tag, self.image),
+                      ignore_status=True)
+        self.xml_digest = None
+
+    def restore(self):
+        """
+        Revert guest disk and restore the running guest from snapshot.
+
+        :return: True when the guest is restored.
+        """
+        virsh.destroy(self.vm_name, ignore_status=True, uri=self.uri)
+        res = utils.run('qemu-img snapshot -a %s %s' % (self.tag, self.image),
+                        ignore_status=True)
+        if res.exit_status:
+            logging.warning('Failed to revert guest disk:\n%s', res)
+            return False
+        res = virsh.command('restore %s' % self.save_path,
+                            ignore_status=True, uri=self.uri)
+        if res.exit_status:
+            logging.warning('Failed to restore guest:\n%s', res)
+            return False
+        return True
+
+
+class GoldenImageCache():
+
+    """
+    Cache of installed guest images with their domain XMLs.
+
+    Guests are defined from a cached image through qcow2 overlays, so the
+    cached image is never modified and can back several guests at once.
+    """
+
+    def __init__(self, cache_dir, vm_name, uri=''):
+        self.cache_dir = cache_dir
+        self.vm_name = vm_name
+        self.uri = uri
+
+    def key(self, image_digest, os_variant, password, cfg_files):
+        """
+        Get the cache key of an install from its inputs.
+
+        :param image_digest: Digest of the image installed from.
+        """
+        digest = hashlib.sha1()
+        for value in (image_digest, os_variant, password):
+            digest.update('%s\0' % value)
+        for path in cfg_files:
+            if os.path.exists(path):
+                with open(path) as fp:
+                    digest.update(fp.read())
+        return digest.hexdigest()
+
+    def entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def has(self, key):
+        """
+        Check whether an installed image is cached for key.
+        """
+        entry = self.entry(key)
+        return (os.path.exists(os.path.join(entry, 'image.qcow2')) and
+                os.path.exists(os.path.join(entry, 'domain.xml')))
+
+    @staticmethod
+    def backing_file(path):
+        """
+        Get the backing file of a qcow2 image, or None.
+        """
+        res = utils.run('qemu-img info --output=json %s' % path,
+                        ignore_status=True)
+        if res.exit_status:
+            return None
+        try:
+            info = json.loads(res.stdout)
+        except ValueError:
+            return None
+        return info.get('full-backing-filename', info.get('backing-filename'))
+
+    def image_digest(self, path):
+        """
+        Get the digest of the image a golden overlay at path was installed
+        from, or None when path is not an overlay of this cache.
+        """
+        backing = self.backing_file(path)
+        if backing is None:
+            return None
+        entry = os.path.dirname(os.path.realpath(backing))
+        if os.path.dirname(entry) != os.path.realpath(self.cache_dir):
+            return None
+        try:
+            with open(os.path.join(entry, 'image.digest')) as fp:
+                return fp.read().strip() or None
+        except IOError:
+            return None
+
+    def store(self, key, image_path, image_digest):
+        """
+        Cache the installed image and inactive domain XML of the guest.
+
+        The image is flattened, so an entry never depends on another one,
+        and the digest of the image installed from is recorded with it.
+        """
+        res = virsh.dumpxml(self.vm_name, extra='--inactive',
+                            ignore_status=True, uri=self.uri)
+        if res.exit_status:
+            logging.warning('Failed to dumpxml of installed guest:\n%s', res)
+            return
+        entry = self.entry(key)
+        tmp_entry = entry + '.tmp'
+        if os.path.exists(tmp_entry):
+            shutil.rmtree(tmp_entry)
+        os.makedirs(tmp_entry)
+        with open(os.path.join(tmp_entry, 'domain.xml'), 'w') as fp:
+            fp.write(res.stdout)
+        with open(os.path.join(tmp_entry, 'image.digest'), 'w') as fp:
+            fp.write(image_digest)
+        utils.run('qemu-img convert -O qcow2 %s %s' %
+                  (image_path, os.path.join(tmp_entry, 'image.qcow2')))
+        os.rename(tmp_entry, entry)
+
+    def create_overlay(self, key, path):
+        """
+        Create a qcow2 image at path backed by the cached image.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        utils.run('qemu-img create -f qcow2 -o backing_file=%s,'
+                  'backing_fmt=qcow2 %s' %
+                  (os.path.join(self.entry(key), 'image.qcow2'), path))
+
+    def define(self, xml):
+        xml_file = tempfile.NamedTemporaryFile(delete=False)
+        fname = xml_file.name
+        xml_file.write(xml)
+        xml_file.close()
+        try:
+            res = virsh.define(fname, uri=self.uri)
+            if res.exit_status:
+                raise Exception(str(res))
+        finally:
+            os.remove(fname)
+
+    def restore(self, key, image_path):
+        """
+        Define the guest from cache on an overlay at image_path.
+        """
+        self.create_overlay(key, image_path)
+        with open(os.path.join(self.entry(key), 'domain.xml')) as fp:
+            self.define(fp.read())
+
+    def linked_clone(self, key, image_path, name):
+        """
+        Define a guest named name on a new overlay of the cached image.
+
+        The clone gets the cached domain XML with a new name and disk,
+        while UUID and MAC addresses are left for libvirt to generate.
+        """
+        clone_path = os.path.join(os.path.dirname(image_path),
+                                  '%s.qcow2' % name)
+        tree = ElementTree.parse(os.path.join(self.entry(key), 'domain.xml'))
+        domain = tree.getroot()
+        domain.find('name').text = name
+        for parent, tag in [(domain, 'uuid')] + [
+                (iface, 'mac') for iface in domain.findall(
+                    'devices/interface')]:
+            element = parent.find(tag)
+            if element is not None:
+                parent.remove(element)
+        # Compare real paths, the XML may name the image another way.
+        image = os.path.realpath(image_path)
+        replaced = 0
+        for source in domain.findall('devices/disk/source'):
+            path = source.get('file')
+            if path and os.path.realpath(path) == image:
+                source.set('file', clone_path)
+                replaced += 1
+        if not replaced:
+            raise Exception('No disk of cached guest %s uses image %s' %
+                            (self.vm_name, image_path))
+        self.create_overlay(key, clone_path)
+        self.define(ElementTree.tostring(domain))
+
+
+class ImageDownloader():
+
+    """
+    Download a file with parallel HTTP range requests.
+
+    Partial downloads are kept with a state file and resumed on the next
+    attempt. Completed files are verified against an optional checksum
+    and kept in a content-addressed cache, from which they are copied
+    into place with a reflink when the filesystem supports it.
+    """
+
+    block_size = 1024 * 1024
+    save_interval = 8
+
+    def __init__(self, url, cache_dir='', checksum='', chunks=4,
+                 part_dir=''):
+        """
+        :param checksum: Expected digest as 'algorithm:hex', like
+                         'sha256:...'. A bare hex digest means sha256.
+        :param part_dir: Directory to keep partial downloads in without a
+                         cache dir. Next to target when not given.
+        """
+        self.url = url
+        self.cache_dir = cache_dir
+        self.part_dir = part_dir
+        self.chunks = max(1, chunks)
+        self.algorithm, self.checksum = 'sha256', None
+        if checksum:
+            if ':' in checksum:
+                self.algorithm, self.checksum = checksum.split(':', 1)
+            else:
+                self.checksum = checksum
+            self.checksum = self.checksum.lower()
+
+    def head(self):
+        """
+        Get length, range support and version tag of remote file.
+        """
+        request = urllib2.Request(self.url)
+        request.get_method = lambda: 'HEAD'
+        try:
+            resp = urllib2.urlopen(request)
+        except urllib2.URLError, e:
+            print 'Warning: HEAD request of %s failed: %s' % (self.url, e)
+            return {'length': None, 'ranges': False, 'etag': None}
+        info = resp.info()
+        resp.close()
+        length = info.getheader('Content-Length')
+        return {'length': int(length) if length else None,
+                'ranges': info.getheader('Accept-Ranges') == 'bytes',
+                'etag': (info.getheader('ETag') or
+                         info.getheader('Last-Modified'))}
+
+    def load_json(self, path):
+        try:
+            with open(path) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def save_json(self, path, data):
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(data, fp)
+        os.rename(path + '.tmp', path)
+
+    def file_digest(self, path):
+        digest = hashlib.new(self.algorithm)
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(self.block_size), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def cache_path(self, digest):
+        return os.path.join(self.cache_dir, '%s-%s' % (self.algorithm, digest))
+
+    def copy(self, src, target):
+        """
+        Copy a cached file into place, sharing blocks when possible.
+        """
+        if os.path.exists(target):
+            os.remove(target)
+        res = utils.run('cp --reflink=always %s %s' % (src, target),
+                        ignore_status=True)
+        if res.exit_status:
+            utils.run('cp --sparse=always %s %s' % (src, target))
+
+    def download_ranges(self, part, meta):
+        """
+        Download into part with one range request per chunk in parallel.
+        """
+        length = meta['length']
+        state_path = part + '.json'
+        state = self.load_json(state_path)
+        if (state is None or state['etag'] != meta['etag'] or
+                state['length'] != length or not os.path.exists(part)):
+            size = int(math.ceil(float(length) / self.chunks)) or 1
+            chunks = [[start, min(start + size, length)]
+                      for start in range(0, length, size)]
+            state = {'etag': meta['etag'], 'length': length,
+                     'chunks': chunks, 'done': [0] * len(chunks)}
+            with open(part, 'wb') as fp:
+                fp.truncate(length)
+            self.save_json(state_path, state)
+        else:
+            print 'Resuming download with %d of %d bytes done' % (
+                sum(state['done']), length)
+        lock = threading.Lock()
+        errors = []
+
+        def fetch_chunk(idx):
+            start, end = state['chunks'][idx]
+            offset = start + state['done'][idx]
+            if offset >= end:
+                return
+            request = urllib2.Request(self.url, headers={
+                'Range': 'bytes=%d-%d' % (offset, end - 1)})
+            try:
+                resp = urllib2.urlopen(request)
+                if resp.getcode() != 206:
+                    raise Exception('Range request is not honored')
+                with open(part, 'r+b') as fp:
+                    fp.seek(offset)
+                    blocks = 0
+                    while offset < end:
+                        data = resp.read(min(self.block_size, end - offset))
+                        if not data:
+                            raise Exception('Connection closed at %d' % offset)
+                        fp.write(data)
+                        fp.flush()
+                        offset += len(data)
+                        blocks += 1
+                        with lock:
+                            state['done'][idx] = offset - start
+                            if blocks % self.save_interval == 0:
+                                self.save_json(state_path, state)
+            except Exception, e:
+                with lock:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=fetch_chunk, args=(idx,))
+                   for idx in range(len(state['chunks']))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.save_json(state_path, state)
+        if errors:
+            raise Exception('Download of %s is incomplete and will be '
+                            'resumed next time: %s' % (self.url, errors[0]))
+        os.remove(state_path)
+
+    def download_stream(self, part, meta):
+        """
+        Download into part with a single request, resuming from the end
+        of part when the server supports ranges.
+        """
+        state_path = part + '.json'
+        state = self.load_json(state_path)
+        offset = 0
+        if (meta['ranges'] and state is not None and
+                state['etag'] == meta['etag'] and os.path.exists(part)):
+            offset = os.path.getsize(part)
+        self.save_json(state_path, {'etag': meta['etag']})
+        request = urllib2.Request(self.url)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        resp = urllib2.urlopen(request)
+        mode = 'ab' if offset and resp.getcode() == 206 else 'wb'
+        with open(part, mode) as fp:
+            for data in iter(lambda: resp.read(self.block_size), ''):
+                fp.write(data)
+        os.remove(state_path)
+
+    def fetch(self, target):
+        """
+        Get the file at target from cache or by downloading it.
+        """
+        for path in (self.cache_dir, self.part_dir):
+            if path and not os.path.isdir(path):
+                os.makedirs(path)
+        index_path = os.path.join(self.cache_dir, 'index.json')
+
+        if self.cache_dir and self.checksum:
+            cached = self.cache_path(self.checksum)
+            if os.path.exists(cached):
+                print 'Using cached image %s' % cached
+                self.copy(cached, target)
+                return
+
+        meta = self.head()
+        index = {}
+        if self.cache_dir:
+            index = self.load_json(index_path) or {}
+            entry = index.get(self.url)
+            if (entry and not self.checksum and meta['etag'] and
+                    entry['etag'] == meta['etag'] and
+                    entry['length'] == meta['length'] and
+                    entry['algorithm'] == self.algorithm):
+                cached = self.cache_path(entry['digest'])
+                if os.path.exists(cached):
+                    print 'Using cached image %s' % cached
+                    self.copy(cached, target)
+                    return
+        part_dir = self.cache_dir or self.part_dir
+        if part_dir:
+            part = os.path.join(part_dir, '%s.part' %
+                                hashlib.sha1(self.url).hexdigest())
+        else:
+            part = target + '.part'
+
+        if meta['ranges'] and meta['length']:
+            self.download_ranges(part, meta)
+        else:
+            self.download_stream(part, meta)
+
+        digest = self.file_digest(part)
+        if self.checksum and digest != self.checksum:
+            os.remove(part)
+            raise Exception('Checksum mismatch for %s: expected %s:%s, '
+                            'got %s:%s' % (self.url, self.algorithm,
+                                           self.checksum, self.algorithm,
+                                           digest))
+        if self.cache_dir:
+            cached = self.cache_path(digest)
+            os.rename(part, cached)
+            index[self.url] = {'etag': meta['etag'], 'length': meta['length'],
+                               'algorithm': self.algorithm, 'digest': digest}
+            self.save_json(index_path, index)
+            self.copy(cached, target)
+        else:
+            if os.path.exists(target):
+                os.remove(target)
+            shutil.move(part, target)
+
+
+class BootstrapManifest():
+
+    """
+    Record of what virt-test bootstrap produced and from which inputs.
+
+    Bootstrap has two steps which can be skipped separately: generating
+    cfg files from samples and setting up SELinux labels of the data dir.
+    The layout of the data dir after bootstrap is recorded too, so files
+    created later can be cleaned without wiping the whole data dir. The
+    record is kept in the data dir, which a full bootstrap wipes with it.
+    """
+
+    name = '.ci_bootstrap.json'
+    keep_re = r'^(?:images/jeos-19-64\.qcow2|%s$)' % re.escape(name)
+
+    def __init__(self, root_dir, base_dir):
+        self.path = os.path.join(base_dir, self.name)
+        self.root_dir = root_dir
+        self.base_dir = base_dir
+        try:
+            with open(self.path) as fp:
+                self.data = json.load(fp)
+        except (IOError, ValueError):
+            self.data = {}
+
+    def samples(self):
+        samples = []
+        for top_dir in ('shared', 'backends'):
+            for dirpath, _, filenames in os.walk(
+                    os.path.join(self.root_dir, top_dir)):
+                for filename in filenames:
+                    if filename.endswith('.cfg.sample'):
+                        samples.append(os.path.join(dirpath, filename))
+        return sorted(samples)
+
+    def file_digest(self, path):
+        with open(path, 'rb') as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+
+    def cfg_inputs(self):
+        """
+        Get digest of cfg samples and the bootstrap code using them.
+        """
+        digest = hashlib.sha1()
+        for path in [os.path.join(self.root_dir, 'virttest', 'bootstrap.py')
+                     ] + self.samples():
+            if os.path.exists(path):
+                digest.update(path)
+                digest.update(self.file_digest(path))
+        return digest.hexdigest()
+
+    def cfg_outputs(self):
+        """
+        Get digests of cfg files generated from samples.
+        """
+        outputs = {}
+        for sample in self.samples():
+            path = sample[:-len('.sample')]
+            if os.path.exists(path):
+                outputs[path] = self.file_digest(path)
+        return outputs
+
+    def selinux(self):
+        """
+        Get SELinux status and context of the data dir.
+        """
+        res = utils.run('stat -c %%C %s' % self.base_dir, ignore_status=True)
+        return '%s %s' % (utils_selinux.get_status(), res.stdout.strip())
+
+    def layout(self):
+        """
+        Get relative paths of all entries in the data dir.
+        """
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.base_dir):
+            for name in dirnames + filenames:
+                paths.append(os.path.relpath(os.path.join(dirpath, name),
+                                             self.base_dir))
+        return sorted(paths)
+
+    def cfg_valid(self):
+        return (self.data.get('cfg_inputs') == self.cfg_inputs() and
+                self.data.get('cfg_outputs') == self.cfg_outputs())
+
+    def selinux_valid(self):
+        return self.data.get('selinux') == self.selinux()
+
+    def layout_valid(self):
+        if 'layout' not in self.data:
+            return False
+        for path in self.data['layout']:
+            if not os.path.exists(os.path.join(self.base_dir, path)):
+                return False
+        return True
+
+    def clean(self):
+        """
+        Remove entries of the data dir which bootstrap did not produce,
+        except the guest image and the manifest. Directories are removed
+        only when nothing kept is left in them, and nothing is removed
+        before a layout is recorded.
+
+        :return: Number of removed entries.
+        """
+        if not os.path.isdir(self.base_dir):
+            if os.path.lexists(self.base_dir):
+                os.unlink(self.base_dir)
+            os.makedirs(self.base_dir)
+            return 0
+        if 'layout' not in self.data:
+            return 0
+        layout = set(self.data['layout'])
+        removed = 0
+        stale_dirs = []
+        for dirpath, dirnames, filenames in os.walk(self.base_dir):
+            for name in list(dirnames) + filenames:
+                path = os.path.join(dirpath, name)
+                rel_path = os.path.relpath(path, self.base_dir)
+                if rel_path in layout or re.match(self.keep_re, rel_path):
+                    continue
+                if name in dirnames and not os.path.islink(path):
+                    # Kept entries may be inside, check them first.
+                    stale_dirs.append(path)
+                    continue
+                if name in dirnames:
+                    dirnames.remove(name)
+                os.unlink(path)
+                removed += 1
+        for path in reversed(stale_dirs):
+            if not os.listdir(path):
+                os.rmdir(path)
+                removed += 1
+        return removed
+
+    def update(self):
+        """
+        Record current inputs and outputs of bootstrap.
+        """
+        self.data = {'cfg_inputs': self.cfg_inputs(),
+                     'cfg_outputs': self.cfg_outputs(),
+                     'selinux': self.selinux(),
+                     'layout': [path for path in self.layout()
+                                if not re.match(self.keep_re, path)]}
+        with open(self.path, 'w') as fp:
+            json.dump(self.data, fp)
+
+
+class GithubClient():
+
+    """
+    Fetch GitHub resources concurrently over pooled keep-alive connections.
+    Responses are cached on disk and revalidated with If-None-Match.
+    """
+
+    max_redirects = 5
+
+    def __init__(self, cache_dir='', workers=8):
+        """
+        :param cache_dir: Directory to cache responses. No cache if empty.
+        :param workers: Maximum number of concurrent requests.
+        """
+        self.cache_dir = cache_dir
+        self.workers = max(1, workers)
+        self.idle = {}
+        self.lock = threading.Lock()
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def connection(self, scheme, netloc):
+        """
+        Get an idle connection to a host or open a new one.
+
+        :return: A tuple of the connection and whether it was reused.
+        """
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=60), False
+        return httplib.HTTPConnection(netloc, timeout=60), False
+
+    def release(self, scheme, netloc, conn):
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(conn)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+    def request(self, url, headers):
+        """
+        Send a GET request and follow redirects.
+
+        :return: A tuple of the response and its body.
+        """
+        for _ in range(self.max_redirects):
+            parts = urlparse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            for attempt in range(2):
+                conn, reused = self.connection(parts.scheme, parts.netloc)
+                try:
+                    conn.request('GET', path, headers=headers)
+                    resp = conn.getresponse()
+                    body = resp.read()
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    # Server may have closed an idle connection.
+                    if reused and not attempt:
+                        continue
+                    raise
+                break
+            if resp.will_close:
+                conn.close()
+            else:
+                self.release(parts.scheme, parts.netloc, conn)
+            if resp.status in (301, 302, 303, 307, 308):
+                url = urlparse.urljoin(url, resp.getheader('location'))
+                continue
+            return resp, body
+        raise Exception('Too many redirects fetching %s' % url)
+
+    def cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+
+    def get(self, url):
+        """
+        Get content of an URL, using cached content if it did not change.
+        """
+        headers = {'User-Agent': 'virt-test-ci',
+                   'Accept-Encoding': 'identity'}
+        etag = None
+        if self.cache_dir:
+            path = self.cache_path(url)
+            if os.path.exists(path + '.etag') and os.path.exists(path):
+                with open(path + '.etag') as fp:
+                    etag = fp.read().strip()
+                headers['If-None-Match'] = etag
+        resp, body = self.request(url, headers)
+        if resp.status == 304 and etag:
+            with open(path) as fp:
+                return fp.read()
+        if resp.status != 200:
+            raise Exception('Failed to get %s: %s %s' %
+                            (url, resp.status, resp.reason))
+        new_etag = resp.getheader('etag')
+        if self.cache_dir and new_etag:
+            # Write body before its tag, so a tag always matches the body.
+            for suffix, content in (('', body), ('.etag', new_etag)):
+                fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+                with os.fdopen(fd, 'w') as fp:
+                    fp.write(content)
+                os.rename(tmp_path, path + suffix)
+        return body
+
+    def map(self, func, items):
+        """
+        Call a function on items concurrently.
+
+        :return: List of results in the order of items.
+        """
+        items = list(items)
+        results = [None] * len(items)
+        errors = []
+        work = Queue.Queue()
+        for idx, item in enumerate(items):
+            work.put((idx, item))
+
+        def worker():
+            while True:
+                try:
+                    idx, item = work.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[idx] = func(item)
+                except Exception, e:
+                    errors.append(e)
+
+        threads = []
+        for _ in range(min(self.workers, len(items))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+
+class PullResolver():
+
+    """
+    Resolve pull requests to merge and the pull requests they depend on.
+    """
+
+    repos = ('virt-test', 'tp-libvirt')
+    oauth = ('?client_id=b6578298435c3eaa1e3d&client_secret'
+             '=59a1c828c6002ed4e8a9205486cf3fa86467a609')
+
+    def __init__(self, client, api_url='https://api.github.com',
+                 web_url='https://github.com', owner='autotest'):
+        """
+        :param client: GithubClient to fetch with.
+        :param api_url: Base URL of GitHub API.
+        :param web_url: Base URL of GitHub to download patches from.
+        :param owner: Owner of the repos.
+        """
+        self.client = client
+        self.api_url = api_url.rstrip('/')
+        self.web_url = web_url.rstrip('/')
+        self.owner = owner
+        self.issues = {}
+        repos = '|'.join(re.escape(repo) for repo in self.repos)
+        # Links to pull requests are on the host of web_url, which may be
+        # a GitHub Enterprise server.
+        parts = urlparse.urlsplit(self.web_url)
+        host = re.escape(parts.netloc + parts.path)
+        self.dep_res = [
+            re.compile(r'%s/(%s)#([0-9]+)' % (owner, repos)),
+            re.compile(r'https?://%s/%s/(%s)/(?:pull|issues)/([0-9]+)'
+                       % (host, owner, repos))]
+
+    def issue_url(self, repo, number):
+        return '%s/repos/%s/%s/issues/%s' % (self.api_url, self.owner,
+                                             repo, number)
+
+    def issue(self, repo, number):
+        url = self.issue_url(repo, number) + self.oauth
+        return json.loads(self.client.get(url))
+
+    def comments(self, repo, number):
+        url = self.issue_url(repo, number) + '/comments' + self.oauth
+        return json.loads(self.client.get(url))
+
+    def patch(self, pull):
+        repo, number = pull
+        return self.client.get('%s/%s/%s/pull/%s.patch' % (
+            self.web_url, self.owner, repo, number))
+
+    def head_sha(self, pull):
+        repo, number = pull
+        url = '%s/repos/%s/%s/pulls/%s%s' % (self.api_url, self.owner, repo,
+                                             number, self.oauth)
+        return json.loads(self.client.get(url))['head']['sha']
+
+    def is_open(self, repo, number):
+        return self.issues[(repo, number)]['state'] == 'open'
+
+    def search_dep(self, text):
+        deps = set()
+        for line in (text or '').splitlines():
+            for dep_re in self.dep_res:
+                deps |= set((str(repo), str(number)) for repo, number
+                            in dep_re.findall(line))
+        return deps
+
+    def fetch(self, pull, follow):
+        """
+        Get issue of a pull request and pull requests it refers to.
+        """
+        issue = self.issue(*pull)
+        deps = set()
+        if (follow and issue['state'] == 'open' and
+                'pull_request' in issue):
+            deps = self.search_dep(issue.get('body'))
+            for comment in self.comments(*pull):
+                deps |= self.search_dep(comment.get('body'))
+            deps.discard(pull)
+        return issue, deps
+
+    def resolve(self, pulls, follow=True):
+        """
+        Find pull requests to merge in each repo.
+
+        Dependencies of open pull requests are followed transitively,
+        closed ones and issues which are not pull requests are dropped.
+        Pull requests are ordered with dependencies first.
+
+        :param pulls: List of (repo, number) tuples requested.
+        :param follow: Whether to follow dependencies.
+        :return: Dict of repo name to ordered list of numbers.
+        """
+        pulls = list(pulls)
+        requested = set(pulls)
+        graph = {}
+        level = pulls
+        while level:
+            fetched = self.client.map(lambda p: self.fetch(p, follow), level)
+            next_level = set()
+            for pull, (issue, deps) in zip(level, fetched):
+                self.issues[pull] = issue
+                graph[pull] = deps
+                next_level |= deps
+            level = sorted(p for p in next_level if p not in graph)
+
+        order = []
+        marks = {}
+
+        def visit(pull, path):
+            marks[pull] = 'visiting'
+            for dep in sorted(graph[pull]):
+                if marks.get(dep) == 'visiting':
+                    cycle = path[path.index(dep):] + [pull, dep]
+                    print 'WARNING: dependency cycle %s' % ' -> '.join(
+                        '%s#%s' % p for p in cycle)
+                elif dep not in marks:
+                    visit(dep, path + [pull])
+            marks[pull] = 'done'
+            if pull in requested or (self.is_open(*pull) and
+                                     'pull_request' in self.issues[pull]):
+                order.append(pull)
+
+        for pull in sorted(graph):
+            if pull in requested and pull not in marks:
+                visit(pull, [])
+
+        self.order = order
+        result = dict((repo, []) for repo in self.repos)
+        for repo, number in order:
+            result.setdefault(repo, []).append(number)
+        return result
+
+
+class WorktreeCache():
+
+    """
+    Trees with pull requests merged, built in git worktrees and reused
+    for the same base commit and pull request heads.
+    """
+
+    def __init__(self, cache_dir, keep=10):
+        """
+        :param cache_dir: Directory to create worktrees in.
+        :param keep: Number of worktrees to keep for each repo.
+        """
+        self.cache_dir = cache_dir
+        self.keep = keep
+        self.locks = {}
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def key(base_sha, head_shas, extra=''):
+        content = '\n'.join([base_sha] + list(head_shas) + [extra])
+        return hashlib.sha1(content).hexdigest()[:16]
+
+    def path(self, name, key):
+        return os.path.join(self.cache_dir, '%s-%s' % (name, key))
+
+    def remove(self, repo_dir, path):
+        shutil.rmtree(path, ignore_errors=True)
+        for suffix in ('.ready', '.lock'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        utils.run('git -C %s worktree prune' % repo_dir, ignore_status=True)
+
+    def get(self, repo_dir, name, key, base_sha, patches):
+        """
+        Get a worktree, building it if it is not cached.
+
+        :param repo_dir: Checkout of the repo.
+        :param name: Name of the repo.
+        :param key: Key of the tree from key().
+        :param base_sha: Commit to apply patches on.
+        :param patches: List of (label, content) of patches in order.
+        :return: Path of the worktree.
+        """
+        path = self.path(name, key)
+        if path in self.locks:
+            return path
+        lock = open(path + '.lock', 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path + '.ready') and os.path.isdir(path):
+                print 'Reusing %s worktree %s' % (name, path)
+                os.utime(path + '.ready', None)
+            else:
+                self.build(repo_dir, name, path, base_sha, patches)
+            # Keep a shared lock while the tree is used so it is not pruned.
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        except:
+            lock.close()
+            raise
+        self.locks[path] = lock
+        self.prune(repo_dir, name)
+        return path
+
+    def build(self, repo_dir, name, path, base_sha, patches):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+            utils.run('git -C %s worktree prune' % repo_dir, ignore_status=True)
+        print 'Creating %s worktree %s' % (name, path)
+        utils.run('git -C %s worktree add --detach %s %s' %
+                  (repo_dir, path, base_sha))
+        for label, content in patches:
+            if not content.strip():
+                print 'WARING: empty content for %s' % label
+            fd, patch_file = tempfile.mkstemp(suffix='.patch')
+            with os.fdopen(fd, 'w') as pf:
+                pf.write(content)
+            try:
+                print 'Patching %s' % label
+                utils.run('git -C %s am -3 %s' % (path, patch_file))
+            except error.CmdError, e:
+                print e
+                shutil.rmtree(path, ignore_errors=True)
+                utils.run('git -C %s worktree prune' % repo_dir,
+                          ignore_status=True)
+                raise Exception('Failed applying patch %s.' % label)
+            finally:
+                os.remove(patch_file)
+        open(path + '.ready', 'w').close()
+
+    def close(self):
+        for lock in self.locks.values():
+            lock.close()
+        self.locks = {}
+
+    def prune(self, repo_dir, name):
+        """
+        Remove least recently used worktrees of a repo beyond keep.
+        """
+        ready = glob.glob(os.path.join(self.cache_dir, '%s-*.ready' % name))
+        ready.sort(key=os.path.getmtime, reverse=True)
+        for marker in ready[self.keep:]:
+            path = marker[:-len('.ready')]
+            lock = open(path + '.lock', 'a')
+            try:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue
+                print 'Removing %s worktree %s' % (name, path)
+                self.remove(repo_dir, path)
+            finally:
+                lock.close()
+
+
+class StepGraph():
+
+    """
+    Run named steps concurrently as soon as the steps they depend on
+    are done, and summarize where the time went.
+    """
+
+    def __init__(self):
+        self.steps = []
+        self.names = {}
+
+    def add(self, name, func, deps=()):
+        """
+        Declare a step.
+
+        :param name: Unique name of the step.
+        :param func: Function to call without arguments.
+        :param deps: Names of steps which must finish before this one.
+        """
+        for dep in deps:
+            if dep not in self.names:
+                raise Exception('Step %s depends on unknown step %s' %
+                                (name, dep))
+        step = {'name': name, 'func': func, 'deps': list(deps),
+                'start': None, 'duration': None}
+        self.steps.append(step)
+        self.names[name] = step
+
+    def run(self):
+        """
+        Run all steps. No new step is started after a step fails, and the
+        first failure is raised once running steps are finished.
+        """
+        cond = threading.Condition()
+        finished = []
+
+        def run_step(step):
+            error = None
+            step['start'] = time.time() - self.start_time
+            try:
+                step['func']()
+            except Exception, e:
+                traceback.print_exc()
+                error = e
+            step['duration'] = time.time() - self.start_time - step['start']
+            with cond:
+                finished.append((step, error))
+                cond.notify()
+
+        self.start_time = time.time()
+        pending = list(self.steps)
+        done = set()
+        running = 0
+        errors = []
+        with cond:
+            while True:
+                if not errors:
+                    for step in list(pending):
+                        if set(step['deps']) <= done:
+                            pending.remove(step)
+                            thread = threading.Thread(target=run_step,
+                                                      args=(step,))
+                            thread.daemon = True
+                            thread.start()
+                            running += 1
+                if not running:
+                    break
+                while not finished:
+                    cond.wait(1)
+                while finished:
+                    step, error = finished.pop(0)
+                    running -= 1
+                    if error is None:
+                        done.add(step['name'])
+                    else:
+                        errors.append((step, error))
+        self.summary()
+        if errors:
+            step, error = errors[0]
+            print 'Setup step %s failed' % step['name']
+            raise error
+
+    def critical_path(self):
+        """
+        Get the chain of dependent steps which took the longest.
+        """
+        paths = {}
+        for step in self.steps:
+            if step['duration'] is None:
+                continue
+            best = []
+            for dep in step['deps']:
+                path = paths.get(dep, [])
+                if (sum(self.names[n]['duration'] for n in path) >
+                        sum(self.names[n]['duration'] for n in best)):
+                    best = path
+            paths[step['name']] = best + [step['name']]
+        longest = []
+        for path in paths.values():
+            if (sum(self.names[n]['duration'] for n in path) >
+                    sum(self.names[n]['duration'] for n in longest)):
+                longest = path
+        return longest
+
+    def summary(self):
+        print 'Setup steps:'
+        for step in self.steps:
+            if step['duration'] is None:
+                print '    %-16s not run' % step['name']
+            else:
+                print '    %-16s started at %7.2f s, took %7.2f s' % (
+                    step['name'], step['start'], step['duration'])
+        print 'Setup took %.2f s, critical path: %s' % (
+            time.time() - self.start_time, ' -> '.join(self.critical_path()))
+        sys.stdout.flush()
+
+
+class Simulator():
+
+    """
+    Replay a recorded run under different scheduling policies.
+
+    The last of the loaded runs is replayed, and the earlier ones serve as
+    history to order tests and compute adaptive timeouts with the same
+    functions as ci.py, through statuses() and durations() queried like
+    History. A single run serves as its own history. Tests are assumed
+    not to slow each other down when run concurrently.
+    """
+
+    # Statuses of Report types in xunit reports.
+    report_types = {'Failure': 'FAIL', 'Timeout': 'TIMEOUT',
+                    'DIFF': 'PASS DIFF', 'Error': 'ERROR', 'Skip': 'SKIP',
+                    'Quarantined': 'FAIL QUARANTINED', 'Flaky': 'PASS FLAKY'}
+
+    def __init__(self, runs):
+        """
+        :param runs: List of runs, oldest first, each a list of
+                     (test, status, duration) in the order they ran.
+        """
+        # A retried test keeps its place and its last result.
+        self.results = collections.OrderedDict()
+        for test, status, duration in runs[-1]:
+            self.results[test] = (status, duration)
+        # Earlier results of each test, newest first.
+        self.history = collections.defaultdict(list)
+        for run in reversed(runs[:-1] or runs):
+            for test, status, duration in reversed(run):
+                self.history[test].append((status, duration))
+
+    @classmethod
+    def load_report(cls, path):
+        """
+        Load results from an xunit report saved by Report.
+
+        :return: List of (test, status, duration) where test is the suite
+                 name and test name joined by a dot.
+        """
+        results = []
+        for ts in ElementTree.parse(path).getroot().iter('testsuite'):
+            for tc in ts.findall('testcase'):
+                status = 'PASS'
+                for child in tc:
+                    status = cls.report_types.get(child.get('type'), status)
+                results.append(('%s.%s' % (ts.get('name'), tc.get('name')),
+                                status, float(tc.get('time') or 0)))
+        return results
+
+    def statuses(self, test, limit=2):
+        """
+        Get statuses of the latest runs of a test like History.statuses().
+        """
+        return [status for status, _ in self.history.get(test, [])
+                if 'CACHED' not in status][:limit]
+
+    def durations(self, test, limit=100):
+        """
+        Get durations of the latest runs of a test like
+        History.durations().
+        """
+        return [duration for status, duration in self.history.get(test, [])
+                if 'TIMEOUT' not in status and
+                'CACHED' not in status][:limit]
+
+    def average(self, test):
+        durations = self.durations(test)
+        if not durations:
+            return 0
+        return sum(durations) / len(durations)
+
+    def shard(self, tests, shards, method):
+        """
+        Split tests into shards, keeping their order in each shard.
+
+        :param method: 'round-robin', 'contiguous' or 'balanced', which
+                       assigns the longest tests first to the shard with
+                       least expected time.
+        """
+        if method == 'round-robin':
+            return [tests[idx::shards] for idx in range(shards)]
+        elif method == 'contiguous':
+            size = int(math.ceil(len(tests) / float(shards)))
+            return [tests[idx * size:(idx + 1) * size]
+                    for idx in range(shards)]
+        loads = [(0, idx) for idx in range(shards)]
+        assigned = [[] for _ in range(shards)]
+        for pos in sorted(range(len(tests)),
+                          key=lambda pos: -self.average(tests[pos])):
+            load, idx = heapq.heappop(loads)
+            assigned[idx].append(pos)
+            heapq.heappush(loads, (load + self.average(tests[pos]), idx))
+        return [[tests[pos] for pos in sorted(positions)]
+                for positions in assigned]
+
+    def replay(self, tests, workers, timeout, adaptive=None, check_every=1,
+               check_cost=0):
+        """
+        Replay tests of a shard on workers taking the next test when free.
+
+        A test recorded as timed out is assumed to hang until its timeout,
+        and a test recorded longer than its timeout is killed at it. States
+        are checked after every check_every tests of a worker and after
+        its last test.
+
+        :return: Dict of the wall time, busy and idle time and number of
+                 tests of each worker, timed out tests, seconds wasted on
+                 timeouts and the time the first failure was known.
+        """
+        free = [(0.0, idx) for idx in range(workers)]
+        busy = [0.0] * workers
+        count = [0] * workers
+        result = {'timeouts': 0, 'new_timeouts': 0, 'wasted': 0.0,
+                  'first_failure': None}
+        for test in tests:
+            start, idx = heapq.heappop(free)
+            status, duration = self.results[test]
+            limit = history_timeout(test, timeout, self, adaptive)
+            failed = status.split()[0] in ('FAIL', 'ERROR', 'INVALID')
+            if 'TIMEOUT' in status or duration > limit:
+                if 'TIMEOUT' not in status:
+                    result['new_timeouts'] += 1
+                result['timeouts'] += 1
+                result['wasted'] += limit
+                duration = limit
+                failed = True
+            end = start + duration
+            if failed and 'QUARANTINED' not in status:
+                if (result['first_failure'] is None or
+                        end < result['first_failure']):
+                    result['first_failure'] = end
+            count[idx] += 1
+            if count[idx] % check_every == 0:
+                end += check_cost
+            busy[idx] += end - start
+            heapq.heappush(free, (end, idx))
+        # Workers are only idle after their last test.
+        for idx in range(workers):
+            if count[idx] % check_every:
+                busy[idx] += check_cost
+        wall = max(busy)
+        result['wall'] = wall
+        result['workers'] = [(count[idx], busy[idx], wall - busy[idx])
+                             for idx in range(workers)]
+        return result
+
+    def simulate(self, order='listing', shards=1, shard_by='round-robin',
+                 workers=1, timeout=1200, adaptive=None, check_every=1,
+                 check_cost=0):
+        """
+        Replay the run ordered, sharded and run on workers as specified.
+
+        :return: Dict of the wall time of the slowest shard, results of
+                 each shard from replay() and totals of timeouts.
+        """
+        tests = history_order(self.results.keys(), order, self)
+        results = [self.replay(shard, workers, timeout, adaptive,
+                               check_every, check_cost)
+                   for shard in self.shard(tests, shards, shard_by)]
+        failures = [res['first_failure'] for res in results
+                    if res['first_failure'] is not None]
+        return {'wall': max(res['wall'] for res in results),
+                'shards': results,
+                'timeouts': sum(res['timeouts'] for res in results),
+                'new_timeouts': sum(res['new_timeouts'] for res in results),
+                'wasted': sum(res['wasted'] for res in results),
+                'first_failure': min(failures) if failures else None}
+
+
+class LibvirtCI():
+
+    def parse_args(self, argv=None):
+        parser = optparse.OptionParser(
+            description='Continuouse integration of '
+            'virt-test libvirt test provider.')
+        parser.add_option('--list', dest='list', action='store_true',
+                          help='List all the test names')
+        parser.add_option('--no', dest='no', action='store', default='',
+                          help='Exclude specified tests.')
+        parser.add_option('--only', dest='only', action='store', default='',
+                          help='Run only for specified tests.')
+        parser.add_option('--no-check', dest='no_check', action='store_true',
+                          help='Disable checking state changes after each test.')
+        parser.add_option('--no-recover', dest='no_recover', action='store_true',
+                          help='Disable recover state changes after each test.')
+        parser.add_option('--connect-uri', dest='connect_uri', action='store',
+                          default='', help='Run tests using specified uri.')
+        parser.add_option('--additional-vms', dest='add_vms', action='store',
+                          default='', help='Additional VMs for testing')
+        parser.add_option('--smoke', dest='smoke', action='store_true',
+                          help='Run one test for each script.')
+        parser.add_option('--slice', dest='slice', action='store',
+                          default='', help='Specify a URL to slice tests.')
+        parser.add_option('--report', dest='report', action='store',
+                          default='xunit_result.xml',
+                          help='Exclude specified tests.')
+        parser.add_option('--white', dest='whitelist', action='store',
+                          default='', help='Whitelist file contains '
+                          'specified test cases to run.')
+        parser.add_option('--black', dest='blacklist', action='store',
+                          default='', help='Blacklist file contains '
+                          'specified test cases to be excluded.')
+        parser.add_option('--config', dest='config', action='store',
+                          default='', help='Specify a custom Cartesian cfg '
+                          'file')
+        parser.add_option('--img-url', dest='img_url', action='store',
+                          default='', help='Specify a URL to a custom image '
+                          'file')
+        parser.add_option('--incremental-bootstrap',
+                          dest='incremental_bootstrap', action='store_true',
+                          help='Only clean files bootstrap did not produce '
+                          'and skip bootstrap steps whose inputs did not '
+                          'change, instead of wiping the data dir.')
+        parser.add_option('--img-checksum', dest='img_checksum',
+                          action='store', default='', help='Verify image '
+                          'downloaded from --img-url against a checksum like '
+                          'sha256:<hex>.')
+        parser.add_option('--img-cache', dest='img_cache', action='store',
+                          default='', help='Directory to cache images '
+                          'downloaded from --img-url by content.')
+        parser.add_option('--download-dir', dest='download_dir',
+                          action='store', default='ci_downloads',
+                          help='Directory to keep partial downloads of '
+                          '--img-url in to resume them, when --img-cache '
+                          'is not given.')
+        parser.add_option('--download-chunks', dest='download_chunks',
+                          action='store', default='4', help='Number of '
+                          'parallel range requests to download image.')
+        parser.add_option('--os-variant', dest='os_variant', action='store',
+                          default='', help='Specify the --os-variant option '
+                          'when doing virt-install.')
+        parser.add_option('--password', dest='password', action='store',
+                          default='', help='Specify a password for logging '
+                          'into guest')
+        parser.add_option('--pull-virt-test', dest='virt_test_pull',
+                          action='store', default='',
+                          help='Merge specified virt-test pull requests. '
+                          'Multiple pull requests are separated by ",", '
+                          'example: --pull-virt-test 175,183')
+        parser.add_option('--pull-libvirt', dest='libvirt_pull',
+                          action='store', default='',
+                          help='Merge specified tp-libvirt pull requests. '
+                          'Multiple pull requests are separated by ",", '
+                          'example: --pull-libvirt 175,183')
+        parser.add_option('--with-dependence', dest='with_dependence',
+                          action='store_true',
+                          help='Merge pull requests that the merged pull '
+                          'requests depend on, transitively.')
+        parser.add_option('--github-api', dest='github_api', action='store',
+                          default='https://api.github.com',
+                          help='Base URL of GitHub API.')
+        parser.add_option('--github-url', dest='github_url', action='store',
+                          default='https://github.com',
+                          help='Base URL of GitHub to download patches from.')
+        parser.add_option('--github-cache', dest='github_cache',
+                          action='store', default='ci_github_cache',
+                          help='Directory to cache GitHub responses, '
+                          'revalidated with ETags. Empty to disable.')
+        parser.add_option('--github-workers', dest='github_workers',
+                          action='store', default='8',
+                          help='Number of concurrent GitHub requests.')
+        parser.add_option('--uri-matrix', dest='uri_matrix', action='store',
+                          default='', help='Run tests with each of '
+                          'specified connect URIs separated by ",". Repos, '
+                          'bootstrap and the test listing are shared. URIs '
+                          'of different drivers served by different '
+                          'libvirtd, like qemu:///system and '
+                          'lxc:///session, run concurrently, with host wide '
+                          'states checked around them instead of around '
+                          'each test and without --idle-timeout, since '
+                          'they share virt-test logs.')
+        parser.add_option('--matrix-child', dest='matrix_child',
+                          action='store', default='',
+                          help=optparse.SUPPRESS_HELP)
+        parser.add_option('--matrix-concurrent', dest='matrix_concurrent',
+                          action='store_true', help=optparse.SUPPRESS_HELP)
+        parser.add_option('--sample-interval', dest='sample_interval',
+                          action='store', default='0',
+                          help='Sample host CPU, memory, disk I/O and qemu '
+                          'memory usage every specified seconds while tests '
+                          'run. 0 means disabled.')
+        parser.add_option('--resource-csv', dest='resource_csv',
+                          action='store', default='ci_resources.csv',
+                          help='CSV file to append sampled resource usage '
+                          'of each test to.')
+        parser.add_option('--status-address', dest='status_address',
+                          action='store', default='', help='Serve progress '
+                          'of the run as JSON over HTTP on specified '
+                          '[host:]port, or on a Unix socket if specified '
+                          'address is a path.')
+        parser.add_option('--health-checks', dest='health_checks',
+                          action='store', default='defined,nvram,disk,network',
+                          help='Checks of the guest before each test, '
+                          'repaired from its last known-good XML. '
+                          'Available checks are defined, nvram, disk and '
+                          'network. Empty to disable.')
+        parser.add_option('--bisect-prs', dest='bisect_prs',
+                          action='store_true', help='Find the merged pull '
+                          'request causing each failure of a test which '
+                          'passes on master, by running failed tests again '
+                          'with subsets of merged pull requests.')
+        parser.add_option('--worktrees', dest='worktrees', action='store',
+                          default='', help='Directory to build merged pull '
+                          'requests in cached git worktrees. Tests run in '
+                          'the worktree and the checkouts are not changed.')
+        parser.add_option('--worktree-keep', dest='worktree_keep',
+                          action='store', default='10',
+                          help='Number of cached worktrees to keep per repo.')
+        parser.add_option('--no-restore-pull', dest='no_restore_pull',
+                          action='store_true', help='Do not restore repo '
+                          'to branch master after test.')
+        parser.add_option('--only-change', dest='only_change',
+                          action='store_true', help='Only test tp-libvirt '
+                          'test cases related to changed files.')
+        parser.add_option('--fail-diff', dest='fail_diff',
+                          action='store_true', help='Report tests who do '
+                          'not clean up environment as a failure')
+        parser.add_option('--retain-vm', dest='retain_vm',
+                          action='store_true', help='Do not reinstall VM '
+                          'before tests')
+        parser.add_option('--pre-cmd', dest='pre_cmd',
+                          action='store', help='Run a command line after '
+                          'fetch the source code and before running the test.')
+        parser.add_option('--post-cmd', dest='post_cmd',
+                          action='store', help='Run a command line after '
+                          'running the test')
+        parser.add_option('--timeout', dest='timeout',
+                          action='store', default='1200',
+                          help='Maximum run time for one test case')
+        parser.add_option('--history', dest='history', action='store',
+                          default='ci_history.db', help='SQLite database '
+                          'to record test results across runs.')
+        parser.add_option('--adaptive-timeout', dest='adaptive_timeout',
+                          action='store_true', help='Compute timeout of each '
+                          'test from the 99th percentile of its recorded '
+                          'durations. Tests with less than 3 records use '
+                          '--timeout.')
+        parser.add_option('--timeout-factor', dest='timeout_factor',
+                          action='store', default='3',
+                          help='Multiply recorded duration percentile by '
+                          'specified factor for adaptive timeouts.')
+        parser.add_option('--timeout-floor', dest='timeout_floor',
+                          action='store', default='60',
+                          help='Minimum adaptive timeout for one test case')
+        parser.add_option('--timeout-ceiling', dest='timeout_ceiling',
+                          action='store', default='7200',
+                          help='Maximum adaptive timeout for one test case')
+        parser.add_option('--order', dest='order', action='store',
+                          type='choice', default='listing', choices=ORDERS,
+                          help='Order tests by history: failed-first, '
+                          'shortest-first, changed-first or listing.')
+        parser.add_option('--order-vm-state', dest='order_vm_state',
+                          action='store_true', help='Group tests by the '
+                          'guest state they require to minimize guest boots '
+                          'and shutdowns between tests.')
+        parser.add_option('--order-constraints', dest='order_constraints',
+                          action='store', default='', help='File of test '
+                          'pairs, one per line, where the first test must '
+                          'run before the second one.')
+        parser.add_option('--guest-snapshot', dest='guest_snapshot',
+                          action='store_true', help='Boot the guest once '
+                          'after preparing the environment and save it. Tests '
+                          'requiring a running guest restore it from the '
+                          'saved state instead of booting it.')
+        parser.add_option('--snapshot-boot-timeout',
+                          dest='snapshot_boot_timeout', action='store',
+                          default='300', help='Maximum seconds to wait for '
+                          'the guest to boot before saving it.')
+        parser.add_option('--snapshot-dir', dest='snapshot_dir',
+                          action='store', default='ci_snapshot',
+                          help='Directory to save the guest snapshot in.')
+        parser.add_option('--golden-cache', dest='golden_cache',
+                          action='store', default='', help='Directory to '
+                          'cache installed guest images. A guest installed '
+                          'with the same image, os variant, password and '
+                          'install cfgs is defined from cache on an overlay, '
+                          'and additional VMs are linked clones.')
+        parser.add_option('--journal', dest='journal', action='store',
+                          default='run.journal', help='File to record '
+                          'tests, state baselines and results of the run.')
+        parser.add_option('--resume', dest='resume', action='store_true',
+                          help='Resume the run recorded in journal. '
+                          'Finished tests are skipped and the environment '
+                          'is not prepared again.')
+        parser.add_option('--cache', dest='cache', action='store_true',
+                          help='Skip tests whose inputs did not change since '
+                          'a recorded clean pass and report them as cached '
+                          'passes. Implies --record-cache.')
+        parser.add_option('--record-cache', dest='record_cache',
+                          action='store_true', help='Record clean passes '
+                          'with a hash of their inputs in --history for '
+                          'later runs with --cache, without skipping any '
+                          'test.')
+        parser.add_option('--image-digest', dest='image_digest',
+                          action='store', default='',
+                          help=optparse.SUPPRESS_HELP)
+        parser.add_option('--retry-budget', dest='retry_budget',
+                          action='store', default='0',
+                          help='Maximum number of failed or timed out tests '
+                          'to re-run at the end. Tests passing on retry are '
+                          'reported as flaky.')
+        parser.add_option('--quarantine', dest='quarantine', action='store',
+                          default='', help='File of flaky tests whose '
+                          'failures are reported as skipped. Tests flaky in '
+                          'at least --quarantine-runs runs are added to it.')
+        parser.add_option('--quarantine-runs', dest='quarantine_runs',
+                          action='store', default='3',
+                          help='Number of flaky runs to quarantine a test.')
+        parser.add_option('--batch-size', dest='batch_size',
+                          action='store', default='1',
+                          help='Run tests in groups of specified size with '
+                          'one ./run invocation per group. States are only '
+                          'checked at group boundaries.')
+        parser.add_option('--warm', dest='warm', action='store_true',
+                          help='Run tests in a long-lived worker process '
+                          'which keeps virttest and the Cartesian config '
+                          'loaded between tests.')
+        parser.add_option('--warm-max-tests', dest='warm_max_tests',
+                          action='store', default='50',
+                          help='Restart the warm worker after running '
+                          'specified number of tests.')
+        parser.add_option('--idle-timeout', dest='idle_timeout',
+                          action='store', default='0',
+                          help='Kill a test as hung when it has no output and '
+                          'no guest or console log activity for specified '
+                          'seconds. 0 means disabled.')
+        parser.add_option('--log-dir', dest='log_dir', action='store',
+                          default='ci_logs', help='Directory to save full '
+                          'output of each test.')
+        self.parser = parser
+        self.args, self.real_args = parser.parse_args(argv)
+        if self.args.uri_matrix:
+            # Tests are listed with the first URI of the matrix.
+            self.args.connect_uri = self.args.uri_matrix.split(',')[0]
+
+    def prepare_tests(self, whitelist='whitelist.test',
+                      blacklist='blacklist.test'):
+        """
+        Get all tests to be run.
+
+        When a whitelist is given, only tests in whitelist will be run.
+        When a blacklist is given, tests in blacklist will be excluded.
+        """
+        def read_tests_from_file(file_name):
+            """
+            Read tests from a file
+            """
+            try:
+                tests = []
+                with open(file_name) as fp:
+                    for line in fp:
+                        if not line.strip().startswith('#'):
+                            tests.append(line.strip())
+                return tests
+            except IOError:
+                return None
+
+        def get_all_tests():
+            """
+            Get all libvirt tests.
+            """
+            if type(self.onlys) == set and not self.onlys:
+                return []
+
+            cmd = './run -t libvirt --list-tests'
+            if self.args.connect_uri:
+                cmd += ' --connect-uri %s' % self.args.connect_uri
+            if self.nos:
+                cmd += ' --no %s' % ','.join(self.nos)
+            if self.onlys:
+                cmd += ' --tests %s' % ','.join(self.onlys)
+            if self.args.config:
+                cmd += ' -c %s' % self.args.config
+            res = utils.run(cmd)
+            out, err, exitcode = res.stdout, res.stderr, res.exit_status
+            tests = []
+            class_names = set()
+            for line in out.splitlines():
+                if line:
+                    if line[0].isdigit():
+                        test = re.sub(r'^[0-9]+ (.*) \(requires root\)$',
+                                      r'\1', line)
+                        if self.args.smoke:
+                            class_name, _ = self.split_name(test)
+                            if class_name in class_names:
+                                continue
+                            else:
+                                class_names.add(class_name)
+                        tests.append(test)
+            return tests
+
+        def change_to_only(change_list):
+            """
+            Transform the content of a change file to a only set.
+            """
+            onlys = set()
+            for line in change_list:
+                filename = line.strip()
+                res = re.match('libvirt/tests/(cfg|src)/(.*).(cfg|py)',
+                               filename)
+                if res:
+                    cfg_path = 'libvirt/tests/cfg/%s.cfg' % res.groups()[1]
+                    cfg_path = os.path.join(self.provider_dir, cfg_path)
+                    try:
+                        with open(cfg_path) as fcfg:
+                            only = fcfg.readline().strip()
+                            only = only.lstrip('-').rstrip(':').strip()
+                            onlys.add(only)
+                    except:
+                        pass
+            return onlys
+
+        self.nos = set(['io-github-autotest-qemu'])
+        self.onlys = None
+
+        if self.args.only:
+            self.onlys = set(self.args.only.split(','))
+
+        if self.args.slice:
+            slices = {}
+            slice_opts = self.args.slice.split(',')
+            slice_url = slice_opts[0]
+            slice_opts = slice_opts[1:]
+            config = urllib2.urlopen(slice_url)
+            for line in config:
+                key, val = line.split()
+                slices[key] = val
+            for slice_opt in slice_opts:
+                if slice_opt in slices:
+                    if self.onlys is None:
+                        self.onlys = set(slices[slice_opt].split(','))
+                    else:
+                        self.onlys |= set(slices[slice_opt].split(','))
+                elif slice_opt == 'other':
+                    for key in slices:
+                        self.nos |= set(slices[key].split(','))
+
+        if self.args.no:
+            self.nos |= set(self.args.no.split(','))
+        if self.args.only_change:
+            if self.onlys is not None:
+                self.onlys &= change_to_only(self.libvirt_file_changed)
+            else:
+                self.onlys = change_to_only(self.libvirt_file_changed)
+
+        self.read_quarantine()
+
+        if self.args.whitelist:
+            tests = read_tests_from_file(whitelist)
+        else:
+            tests = get_all_tests()
+
+        if self.args.blacklist:
+            black_tests = read_tests_from_file(blacklist)
+            tests = [t for t in tests if t not in black_tests]
+
+        with open('run.test', 'w') as fp:
+            for test in tests:
+                fp.write(test + '\n')
+        return tests
+
+    def read_quarantine(self):
+        """
+        Read tests whose failures are non-blocking from quarantine file.
+        """
+        self.quarantine = set()
+        if self.quarantine_path and os.path.exists(self.quarantine_path):
+            with open(self.quarantine_path) as fp:
+                for line in fp:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        self.quarantine.add(line)
+
+    def update_quarantine(self):
+        """
+        Add tests which are flaky in many runs to quarantine file.
+        """
+        if not self.quarantine_path or self.history is None:
+            return
+        flaky = set(self.history.flaky_tests(int(self.args.quarantine_runs)))
+        if flaky <= self.quarantine:
+            return
+        print 'Quarantining flaky tests:'
+        for test in sorted(flaky - self.quarantine):
+            print '    %s' % test
+        self.quarantine |= flaky
+        with open(self.quarantine_path, 'w') as fp:
+            fp.write('# Tests whose failures are reported as skipped.\n')
+            for test in sorted(self.quarantine):
+                fp.write(test + '\n')
+
+    def split_name(self, name):
+        """
+        Try to return the module name of a test.
+        """
+        if name.startswith('type_specific.io-github-autotest-libvirt'):
+            name = name.split('.', 2)[2]
+
+        if name.split('.')[0] in ['virsh']:
+            package_name, name = name.split('.', 1)
+        else:
+            package_name = ""
+
+        names = name.split('.', 1)
+        if len(names) == 2:
+            name, test_name = names
         else:
             name = names[0]
             test_name = name
@@ -986,223 +4102,672 @@ class LibvirtCI():
 
         return class_name, test_name
 
+    def clean_data_dir(self):
+        """
+        Remove entries of the data dir which incremental bootstrap did not
+        produce.
+        """
+        base_dir = data_dir.get_data_dir()
+        manifest = BootstrapManifest(data_dir.get_root_dir(), base_dir)
+        removed = manifest.clean()
+        print 'Removed %d stale entries from %s' % (removed, base_dir)
+
     def bootstrap(self):
         class _Options(object):
             pass
 
-        from virttest import bootstrap
+        from virttest import bootstrap
+
+        logging.info('Bootstrapping')
+        sys.stdout.flush()
+        base_dir = data_dir.get_data_dir()
+        update_config, selinux_setup = True, True
+        manifest = None
+        if self.args.incremental_bootstrap:
+            # Stale entries are removed by clean_data_dir() before.
+            manifest = BootstrapManifest(data_dir.get_root_dir(), base_dir)
+            update_config = not manifest.cfg_valid()
+            selinux_setup = not manifest.selinux_valid()
+            if (not update_config and not selinux_setup and
+                    manifest.layout_valid()):
+                print 'Bootstrap is up to date'
+                os.chdir(data_dir.get_root_dir())
+                return
+        else:
+            if os.path.exists(base_dir):
+                if os.path.islink(base_dir) or os.path.isfile(base_dir):
+                    os.unlink(base_dir)
+                elif os.path.isdir(base_dir):
+                    shutil.rmtree(base_dir)
+            os.mkdir(base_dir)
+
+        options = _Options()
+        options.vt_type = 'libvirt'
+        options.vt_selinux_setup = selinux_setup
+        options.vt_no_downloads = True
+        options.vt_keep_image = True
+        options.vt_verbose = True
+        options.vt_update_providers = False
+        options.vt_update_config = update_config
+        options.vt_guest_os = None
+        options.vt_config = None
+
+        bootstrap.bootstrap(options=options, interactive=False)
+        os.chdir(data_dir.get_root_dir())
+        if manifest is not None:
+            manifest.update()
+
+    def prepare_env(self, shared=True):
+        """
+        Prepare the environment before all tests.
+
+        Setup is declared as a graph of steps. Independent steps, like
+        bootstrap and image download, run concurrently.
+
+        :param shared: Whether to prepare cfgs, bootstrap and the image
+                       too, or only the guests of current connect URI.
+        """
+
+        def replace_pattern_in_file(file, search_exp, replace_exp):
+            # Do not use fileinput in place, which redirects sys.stdout
+            # while other steps are printing.
+            prog = re.compile(search_exp)
+            with open(file) as fp:
+                lines = fp.readlines()
+            with open(file, 'w') as fp:
+                for line in lines:
+                    match = prog.search(line)
+                    if match:
+                        line = prog.sub(replace_exp, line)
+                    fp.write(line)
+
+        img_path = os.path.join(
+            os.path.realpath(data_dir.get_data_dir()), 'images/jeos-19-64.qcow2')
+        env = {'golden': None, 'golden_key': None, 'golden_hit': False,
+               'restore_image': True}
+
+        def restart_libvirtd():
+            utils_libvirtd.Libvirtd().restart()
+
+        def restart_nfs():
+            service.Factory.create_service("nfs").restart()
+
+        def rewrite_cfgs():
+            if self.args.password:
+                replace_pattern_in_file(
+                    "shared/cfg/guest-os/Linux.cfg",
+                    r'password = \S*',
+                    r'password = %s' % self.args.password)
+
+            if self.args.os_variant:
+                replace_pattern_in_file(
+                    "shared/cfg/guest-os/Linux/JeOS/19.x86_64.cfg",
+                    r'os_variant = \S*',
+                    r'os_variant = %s' % self.args.os_variant)
+
+            if self.args.add_vms:
+                vms_string = "virt-tests-vm1 " + " ".join(self.args.add_vms.split(','))
+                replace_pattern_in_file(
+                    "shared/cfg/base.cfg",
+                    r'^\s*vms = .*\n',
+                    r'vms = %s\n' % vms_string)
+
+        def run_bootstrap():
+            print 'Running bootstrap'
+            sys.stdout.flush()
+            self.bootstrap()
+            if self.worktrees is not None:
+                self.link_worktree()
+
+        def check_golden():
+            if self.image_digest is None:
+                print 'Warning: No image to install from, not using golden cache'
+                return
+            golden = GoldenImageCache(os.path.abspath(self.args.golden_cache),
+                                      'virt-tests-vm1', self.args.connect_uri)
+            golden_key = golden.key(
+                self.image_digest, self.args.os_variant, self.args.password,
+                ['shared/cfg/base.cfg',
+                 'shared/cfg/guest-os/Linux.cfg',
+                 'shared/cfg/guest-os/Linux/JeOS/19.x86_64.cfg',
+                 'shared/cfg/unattended_install.cfg'])
+            env['golden'], env['golden_key'] = golden, golden_key
+            env['golden_hit'] = golden.has(golden_key)
+            if not env['golden_hit']:
+                print 'Golden image %s is not cached' % golden_key
+
+        def download_image():
+            print 'Downloading image from %s.' % self.args.img_url
+            sys.stdout.flush()
+            if not os.path.isdir(os.path.dirname(img_path)):
+                os.makedirs(os.path.dirname(img_path))
+            cache_dir = ''
+            if self.args.img_cache:
+                cache_dir = os.path.abspath(self.args.img_cache)
+            # Not in the data dir, which a full bootstrap wipes.
+            downloader = ImageDownloader(self.args.img_url, cache_dir,
+                                         self.args.img_checksum,
+                                         int(self.args.download_chunks),
+                                         self.download_dir)
+            downloader.fetch(img_path)
+            env['restore_image'] = False
+
+        def digest_image():
+            # A guest defined from golden cache leaves an overlay at
+            # img_path, so prefer the pristine compressed image.
+            paths = [img_path + '.xz', img_path + '.7z', img_path]
+            if self.args.img_url:
+                paths = [img_path]
+            self.image_digest = None
+            for path in paths:
+                if not os.path.exists(path):
+                    continue
+                if (path == img_path and
+                        GoldenImageCache.backing_file(path) is not None):
+                    # Never digest an overlay, which changes every run, but
+                    # use the digest recorded with its golden image.
+                    if self.args.golden_cache:
+                        golden = GoldenImageCache(
+                            os.path.abspath(self.args.golden_cache),
+                            'virt-tests-vm1', self.args.connect_uri)
+                        self.image_digest = golden.image_digest(path)
+                    break
+                self.image_digest = ResultCache.file_digest(path)
+                break
+
+        def remove_vms():
+            print 'Removing VM\n',  # TODO: use virt-test api remove VM
+            sys.stdout.flush()
+            if self.args.connect_uri:
+                virsh.destroy('virt-tests-vm1',
+                              ignore_status=True,
+                              uri=self.args.connect_uri)
+                virsh.undefine('virt-tests-vm1',
+                               '--snapshots-metadata --managed-save',
+                               ignore_status=True,
+                               uri=self.args.connect_uri)
+            else:
+                virsh.destroy('virt-tests-vm1', ignore_status=True)
+                virsh.undefine('virt-tests-vm1', '--snapshots-metadata', ignore_status=True)
+            if self.args.add_vms:
+                for vm in self.args.add_vms.split(','):
+                    virsh.destroy(vm, ignore_status=True)
+                    virsh.undefine(vm, '--snapshots-metadata', ignore_status=True)
+
+        def install_vm():
+            golden, golden_key = env['golden'], env['golden_key']
+            if env['golden_hit']:
+                print 'Defining VM from golden image %s' % golden_key
+                sys.stdout.flush()
+                golden.restore(golden_key, img_path)
+                return
+            print 'Installing VM',
+            sys.stdout.flush()
+            if 'lxc' in self.args.connect_uri:
+                cmd = 'virt-install --connect=lxc:/// --name virt-tests-vm1 --ram 500 --noautoconsole'
+                try:
+                    utils.run(cmd)
+                except error.CmdError, e:
+                    raise Exception('   ERROR: Failed to install guest \n %s' % e)
+            else:
+                status, res, err_msg = self.run_test(
+                    'unattended_install.import.import.default_install.aio_native',
+                    restore_image=env['restore_image'], check=False,
+                    recover=False)
+                if 'PASS' not in status:
+                    raise Exception('   ERROR: Failed to install guest \n %s' %
+                                    res.stderr)
+                virsh.destroy('virt-tests-vm1')
+                if golden is not None:
+                    golden.store(golden_key, img_path, self.image_digest)
+
+        def clone_vms():
+            golden, golden_key = env['golden'], env['golden_key']
+            for vm in self.args.add_vms.split(','):
+                if golden is not None and golden.has(golden_key):
+                    golden.linked_clone(golden_key, img_path, vm)
+                    continue
+                cmd = 'virt-clone '
+                if self.args.connect_uri:
+                    cmd += '--connect=%s ' % self.args.connect_uri
+                cmd += '--original=virt-tests-vm1 '
+                cmd += '--name=%s ' % vm
+                cmd += '--auto-clone'
+                utils.run(cmd)
+
+        steps = StepGraph()
+        steps.add('libvirtd', restart_libvirtd)
+        steps.add('nfs', restart_nfs)
+        image_deps = []
+        if shared:
+            steps.add('cfgs', rewrite_cfgs)
+            bootstrap_deps = ['cfgs']
+            if self.args.incremental_bootstrap:
+                steps.add('clean', self.clean_data_dir)
+                bootstrap_deps.append('clean')
+            steps.add('bootstrap', run_bootstrap, bootstrap_deps)
+            image_deps.append('bootstrap')
+        elif self.args.img_url:
+            # The image is downloaded already.
+            env['restore_image'] = False
+        golden = (self.args.golden_cache and not self.args.retain_vm and
+                  'lxc' not in self.args.connect_uri)
+        if self.args.img_url and shared:
+            # Bootstrap wipes or cleans the data dir the image is saved
+            # in, so download after that.
+            deps = ['bootstrap']
+            if self.args.incremental_bootstrap:
+                deps = ['clean']
+            steps.add('download', download_image, deps)
+            image_deps.append('download')
+        if (self.caching() or golden) and shared:
+            steps.add('digest', digest_image, list(image_deps))
+            image_deps.append('digest')
+        if golden:
+            steps.add('golden', check_golden,
+                      ['cfgs', 'digest'] if shared else [])
+            image_deps.append('golden')
+        if not self.args.retain_vm:
+            steps.add('remove_vms', remove_vms, ['libvirtd'])
+            steps.add('install_vm', install_vm,
+                      ['remove_vms', 'nfs'] + image_deps)
+            if self.args.add_vms:
+                steps.add('clone_vms', clone_vms, ['install_vm'])
+        steps.run()
+
+    def run_args(self, restore_image=False):
+        """
+        Get the ./run options shared by all tests.
+        """
+        img_str = '' if restore_image else 'k'
+        args = ['-v%st' % img_str, 'libvirt', '--keep-image-between-tests']
+        if not restore_image:
+            args.append('--no-downloads')
+        if self.args.connect_uri:
+            args += ['--connect-uri', self.args.connect_uri]
+        return args
+
+    def run_command(self, test, restore_image=False):
+        """
+        Get the ./run command line for a test or a comma separated
+        list of tests.
+        """
+        return ' '.join(['./run'] + self.run_args(restore_image) +
+                        ['--tests', test])
+
+    def check_states(self, recover=True):
+        """
+        Check all states for changes and return the diff lines.
+        """
+        err_msg = []
+        for state in self.states:
+            diffmsg = state.check(recover=recover)
+            for line in diffmsg:
+                err_msg.append('   DIFF|%s' % line)
+        return err_msg
+
+    def log_path(self, name):
+        """
+        Get the path of the file to save full output of a test.
+        """
+        return os.path.join(self.log_dir, '%s.log' % name)
+
+    def order_tests(self, tests):
+        """
+        Reorder tests according to --order using recorded history.
+        """
+        return history_order(tests, self.args.order, self.history)
+
+    def vm_states(self, tests):
+        """
+        Get the guest state each test requires and leaves from its
+        Cartesian params.
+
+        :return: A dict mapping tests to (start, kill) tuples. start is
+                 'on' for start_vm or restart_vm, 'off' for
+                 kill_vm_before_test and None when the test does not care.
+                 kill is True when the test kills the guest after running.
+        """
+        from virttest import cartesian_config
+
+        cfg = self.args.config or os.path.join(
+            self.root_dir, 'backends', 'libvirt', 'cfg', 'tests.cfg')
+        parser = cartesian_config.Parser()
+        parser.parse_file(cfg)
+        if self.args.connect_uri:
+            parser.assign('connect_uri', self.args.connect_uri)
+        # An only filter of all tests makes expansion quadratic, so pick
+        # the wanted ones while expanding instead.
+        wanted = set(tests)
+        states = {}
+        for params in parser.get_dicts():
+            # ./run lists tests by their name in subtests.cfg, and runs
+            # the first variant of it.
+            name = params.get('_short_name_map_file', {}).get('subtests.cfg')
+            if name not in wanted or name in states:
+                continue
+            if (params.get('start_vm') == 'yes' or
+                    params.get('restart_vm') == 'yes'):
+                start = 'on'
+            elif params.get('kill_vm_before_test') == 'yes':
+                start = 'off'
+            else:
+                start = None
+            states[name] = (start, params.get('kill_vm') == 'yes')
+            if len(states) == len(wanted):
+                break
+        return states
+
+    def read_constraints(self, tests):
+        """
+        Read ordering constraints from --order-constraints file.
 
-        logging.info('Bootstrapping')
-        sys.stdout.flush()
-        base_dir = data_dir.get_data_dir()
-        if os.path.exists(base_dir):
-            if os.path.islink(base_dir) or os.path.isfile(base_dir):
-                os.unlink(base_dir)
-            elif os.path.isdir(base_dir):
-                shutil.rmtree(base_dir)
-        os.mkdir(base_dir)
+        Each line contains two test names, full or short, meaning the
+        first one must run before the second one.
 
-        options = _Options()
-        options.vt_type = 'libvirt'
-        options.vt_selinux_setup = True
-        options.vt_no_downloads = True
-        options.vt_keep_image = True
-        options.vt_verbose = True
-        options.vt_update_providers = False
-        options.vt_update_config = True
-        options.vt_guest_os = None
-        options.vt_config = None
+        :return: A dict mapping tests to sets of tests to run before them.
+        """
+        names = {}
+        for test in tests:
+            names[test] = test
+            names[test.split('.', 2)[-1]] = test
+        before = {}
+        with open(self.args.order_constraints) as fp:
+            for line in fp:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                first, second = line.split()
+                if first in names and second in names:
+                    before.setdefault(names[second], set()).add(names[first])
+        return before
+
+    def order_by_vm_state(self, tests):
+        """
+        Reorder tests to minimize guest boots and shutdowns.
 
-        bootstrap.bootstrap(options=options, interactive=False)
-        os.chdir(data_dir.get_root_dir())
+        Tests are picked greedily: first ones which keep the guest in
+        its current state, then ones which change it by themselves, and
+        only then ones which need a transition before running. Ordering
+        constraints and the current order within each kind are kept.
+        """
+        states = self.test_vm_states = self.vm_states(tests)
+        before = {}
+        if self.args.order_constraints:
+            before = self.read_constraints(tests)
+
+        def end_state(test, state):
+            start, kill = states.get(test, (None, False))
+            if kill:
+                return 'off'
+            return start or state
+
+        def transitions(order):
+            count, state = 0, 'off'
+            for test in order:
+                start = states.get(test, (None, False))[0]
+                if start is not None and start != state:
+                    count += 1
+                state = end_state(test, start or state)
+            return count
+
+        remaining = list(tests)
+        done = set()
+        ordered = []
+        state = 'off'
+        while remaining:
+            stay, ready, eligible = None, None, None
+            for test in remaining:
+                if not before.get(test, set()) <= done:
+                    continue
+                if eligible is None:
+                    eligible = test
+                if states.get(test, (None, False))[0] not in (None, state):
+                    continue
+                if end_state(test, state) == state:
+                    stay = test
+                    break
+                if ready is None:
+                    ready = test
+            test = stay or ready or eligible
+            if test is None:
+                print 'Warning: Cyclic ordering constraints, ignoring them'
+                before = {}
+                continue
+            start = states.get(test, (None, False))[0]
+            state = end_state(test, start or state)
+            remaining.remove(test)
+            done.add(test)
+            ordered.append(test)
 
-    def prepare_env(self):
+        print 'Ordered tests by guest state: %d -> %d transitions' % (
+            transitions(tests), transitions(ordered))
+        return ordered
+
+    def repo_sha(self, path):
         """
-        Prepare the environment before all tests.
+        Get the commit SHA of HEAD of a git repo.
         """
+        res = utils.run('git --git-dir=%s rev-parse HEAD' %
+                        os.path.join(path, '.git'), ignore_status=True)
+        return res.stdout.strip()
 
-        def replace_pattern_in_file(file, search_exp, replace_exp):
-            prog = re.compile(search_exp)
-            for line in fileinput.input(file, inplace=1):
-                match = prog.search(line)
-                if match:
-                    line = prog.sub(replace_exp, line)
-                sys.stdout.write(line)
-
-        utils_libvirtd.Libvirtd().restart()
-        service.Factory.create_service("nfs").restart()
-
-        if self.args.password:
-            replace_pattern_in_file(
-                "shared/cfg/guest-os/Linux.cfg",
-                r'password = \S*',
-                r'password = %s' % self.args.password)
-
-        if self.args.os_variant:
-            replace_pattern_in_file(
-                "shared/cfg/guest-os/Linux/JeOS/19.x86_64.cfg",
-                r'os_variant = \S*',
-                r'os_variant = %s' % self.args.os_variant)
-
-        if self.args.add_vms:
-            vms_string = "virt-tests-vm1 " + " ".join(self.args.add_vms.split(','))
-            replace_pattern_in_file(
-                "shared/cfg/base.cfg",
-                r'^\s*vms = .*\n',
-                r'vms = %s\n' % vms_string)
-
-        print 'Running bootstrap'
-        sys.stdout.flush()
-        self.bootstrap()
-
-        restore_image = True
-        if self.args.img_url:
-            def progress_callback(count, block_size, total_size):
-                #percent = count * block_size * 100 / total_size
-                #sys.stdout.write("\rDownloaded %2.2f%%" % percent)
-                #sys.stdout.flush()
-                pass
-            print 'Downloading image from %s.' % self.args.img_url
-            sys.stdout.flush()
-            img_dir = os.path.join(
-                os.path.realpath(data_dir.get_data_dir()), 'images/jeos-19-64.qcow2')
-            urllib.urlretrieve(self.args.img_url, img_dir, progress_callback)
-            restore_image = False
-
-        if self.args.retain_vm:
-            return
+    def test_timeout(self, test):
+        """
+        Get the timeout of a test.
 
-        print 'Removing VM\n',  # TODO: use virt-test api remove VM
-        sys.stdout.flush()
-        if self.args.connect_uri:
-            virsh.destroy('virt-tests-vm1',
-                          ignore_status=True,
-                          uri=self.args.connect_uri)
-            virsh.undefine('virt-tests-vm1',
-                           '--snapshots-metadata --managed-save',
-                           ignore_status=True,
-                           uri=self.args.connect_uri)
-        else:
-            virsh.destroy('virt-tests-vm1', ignore_status=True)
-            virsh.undefine('virt-tests-vm1', '--snapshots-metadata', ignore_status=True)
-        if self.args.add_vms:
-            for vm in self.args.add_vms.split(','):
-                virsh.destroy(vm, ignore_status=True)
-                virsh.undefine(vm, '--snapshots-metadata', ignore_status=True)
+        With --adaptive-timeout, the 99th percentile of recorded durations
+        multiplied by --timeout-factor is used, bounded by --timeout-floor
+        and --timeout-ceiling.
+        """
+        adaptive = None
+        if self.args.adaptive_timeout:
+            adaptive = (float(self.args.timeout_factor),
+                        int(self.args.timeout_floor),
+                        int(self.args.timeout_ceiling))
+        return history_timeout(test, int(self.args.timeout), self.history,
+                               adaptive)
+
+    def watchdog(self):
+        """
+        Create a watchdog over virt-test debug and guest console logs.
 
-        print 'Installing VM',
-        sys.stdout.flush()
-        if 'lxc' in self.args.connect_uri:
-            cmd = 'virt-install --connect=lxc:/// --name virt-tests-vm1 --ram 500 --noautoconsole'
-            try:
-                utils.run(cmd)
-            except error.CmdError, e:
-                raise Exception('   ERROR: Failed to install guest \n %s' % e)
-        else:
-            status, res, err_msg = self.run_test(
-                'unattended_install.import.import.default_install.aio_native',
-                restore_image=restore_image, check=False, recover=False)
-            if 'PASS' not in status:
-                raise Exception('   ERROR: Failed to install guest \n %s' %
-                                res.stderr)
-            virsh.destroy('virt-tests-vm1')
-        if self.args.add_vms:
-            for vm in self.args.add_vms.split(','):
-                cmd = 'virt-clone '
-                if self.args.connect_uri:
-                    cmd += '--connect=%s ' % self.args.connect_uri
-                cmd += '--original=virt-tests-vm1 '
-                cmd += '--name=%s ' % vm
-                cmd += '--auto-clone'
-                utils.run(cmd)
+        Concurrent matrix children share logs/latest with each other, so
+        their watchdog is disabled.
+        """
+        if self.args.matrix_concurrent:
+            return Watchdog(0)
+        log_dir = os.path.join(self.root_dir, 'logs', 'latest')
+        patterns = [os.path.join(log_dir, 'debug.log'),
+                    os.path.join(log_dir, '*', 'debug.log'),
+                    os.path.join(log_dir, '*', 'serial-*.log'),
+                    os.path.join(log_dir, '*', '*console*.log')]
+        return Watchdog(int(self.args.idle_timeout), patterns)
+
+    def error_lines(self, status, res):
+        """
+        Collect error messages of a finished test from its output.
+        """
+        err_msg = []
+        if getattr(res, 'hung', False):
+            err_msg.append('  hung: no output or guest activity for %d s' %
+                           res.idle_timeout)
+        if 'FAIL' in status or 'ERROR' in status:
+            errors = getattr(res, 'errors', None)
+            if errors is None:
+                errors = [l for l in res.stderr.splitlines() if 'ERROR' in l]
+            for line in errors:
+                err_msg.append('  %s' % line[9:])
+        if status == 'INVALID' or status == 'TIMEOUT':
+            for line in res.stdout.splitlines():
+                err_msg.append(line)
+        if err_msg and getattr(res, 'log_path', None):
+            err_msg.append('  Full output in %s' % res.log_path)
+        return err_msg
 
     def run_test(self, test, restore_image=False, check=True, recover=True):
         """
         Run a specific test.
         """
-        img_str = '' if restore_image else 'k'
-        down_str = '' if restore_image else '--no-downloads'
-        cmd = './run -v%st libvirt --keep-image-between-tests %s --tests %s' % (
-            img_str, down_str, test)
-        if self.args.connect_uri:
-            cmd += ' --connect-uri %s' % self.args.connect_uri
+        os.chdir(self.root_dir)
+        cmd = self.run_command(test, restore_image)
         status = 'INVALID'
+        timeout = self.test_timeout(test)
+        log_path = self.log_path(test)
+        if self.sampler is not None:
+            self.sampler.start()
         try:
-            res = utils.run(cmd, timeout=int(self.args.timeout),
-                            ignore_status=True)
-            lines = res.stdout.splitlines()
-            for line in lines:
-                if line.startswith('(1/1)'):
-                    status = line.split()[2]
+            if self.warm_runner is not None and not restore_image:
+                res = self.warm_runner.run(test, timeout, log_path,
+                                           self.watchdog())
+            else:
+                executor = TestExecutor(cmd, timeout, log_path,
+                                        self.watchdog())
+                res = executor.run()
+                if executor.timed_out:
+                    raise error.CmdError(cmd, res)
+            for match in res.statuses:
+                status = match.group(4)
+            if res.hung:
+                status = 'TIMEOUT'
         except error.CmdError, e:
             res = e.result_obj
             status = 'TIMEOUT'
-            res.duration = int(self.args.timeout)
+            if not getattr(res, 'hung', False):
+                res.duration = timeout
         except Exception, e:
             print "Exception when parsing stdout.\n%s" % res
+            if self.sampler is not None:
+                self.sampler.stop()
             raise e
+        if self.sampler is not None:
+            res.resources = self.sampler.stop()
 
-        os.chdir(data_dir.get_root_dir())  # Check PWD
+        os.chdir(self.root_dir)  # Check PWD
 
         err_msg = []
 
         if check:
-            diff = False
-            for state in self.states:
-                diffmsg = state.check(recover=recover)
-                if diffmsg:
-                    if not diff:
-                        diff = True
-                        status += ' DIFF'
-                    for line in diffmsg:
-                        err_msg.append('   DIFF|%s' % line)
+            err_msg = self.check_states(recover=recover)
+            if err_msg:
+                status += ' DIFF'
 
         print 'Result: %s %.2f s' % (status, res.duration)
 
-        if 'FAIL' in status or 'ERROR' in status:
-            for line in res.stderr.splitlines():
-                if 'ERROR' in line:
-                    err_msg.append('  %s' % line[9:])
-        if status == 'INVALID' or status == 'TIMEOUT':
-            for line in res.stdout.splitlines():
-                err_msg.append(line)
+        err_msg += self.error_lines(status, res)
         if err_msg:
             for line in err_msg:
                 print line
         sys.stdout.flush()
         return status, res, err_msg
 
+    def run_batch(self, tests, check=True, recover=True):
+        """
+        Run a group of tests in a single ./run invocation.
+
+        Results are attributed to tests by parsing the '(i/N)' status lines
+        streamed on stdout. Lines received on stderr before a status line
+        are attributed to the test it reports. States are only checked once
+        at the end of the batch and any difference is reported on the last
+        finished test.
+
+        When the batch times out or hangs, the first test without a
+        result is the one which was running and is reported as TIMEOUT
+        with the output since the last status line.
+
+        :return: A list of (test, status, res, err_msg) tuples for finished
+                 tests and a list of tests which never started because
+                 the batch was interrupted.
+        """
+        def handle_line(source, line, match):
+            if match is None:
+                return
+            name, status = match.group(3), match.group(4)
+            test = None
+            for t in pending:
+                if t == name or t.endswith('.' + name):
+                    test = t
+                    break
+            if test is None:
+                return
+            pending.remove(test)
+            now = time.time()
+            if match.group(5):
+                duration = float(match.group(5))
+            else:
+                duration = now - executor.last_progress
+            executor.progress()
+            if pending:
+                executor.timeout = max(timeouts[t] for t in pending)
+            res = executor.result(0, duration, executor.new_segment())
+            if self.sampler is not None:
+                res.resources = self.sampler.split()
+            results.append((test, status, res, self.error_lines(status, res)))
+
+        os.chdir(self.root_dir)
+        cmd = self.run_command(','.join(tests))
+        pending = list(tests)
+        results = []
+        timeouts = dict((test, self.test_timeout(test)) for test in tests)
+        executor = TestExecutor(cmd, max(timeouts.values()),
+                                self.log_path('%s.batch' % tests[0]),
+                                self.watchdog())
+        # Status lines reset the countdown, so bound the whole batch too.
+        executor.deadline = executor.start_time + sum(timeouts.values())
+        start_time = time.time()
+        resources = None
+        if self.sampler is not None:
+            self.sampler.start()
+        try:
+            res = executor.run(handle_line)
+        finally:
+            if self.sampler is not None:
+                resources = self.sampler.stop()
+        if executor.timed_out and pending:
+            res.duration = time.time() - executor.last_progress
+            if resources is not None:
+                res.resources = resources
+            results.append((pending.pop(0), 'TIMEOUT', res,
+                            self.error_lines('TIMEOUT', res)))
+        if executor.hung:
+            print 'Batch hung without output or guest activity for %s s' % (
+                self.args.idle_timeout)
+        elif executor.timed_out and time.time() > executor.deadline:
+            print 'Batch timed out after %.0f s' % (
+                executor.deadline - executor.start_time)
+        elif executor.timed_out:
+            print 'Batch timed out after %s s without a result' % executor.timeout
+
+        os.chdir(self.root_dir)  # Check PWD
+
+        if check and results:
+            diff_msg = self.check_states(recover=recover)
+            if diff_msg:
+                test, status, res, err_msg = results[-1]
+                diff_msg.insert(0, '   DIFF|Checked after batch of %d tests '
+                                'taking %.2f s' % (len(results),
+                                                   time.time() - start_time))
+                results[-1] = (test, status + ' DIFF', res, diff_msg + err_msg)
+        return results, pending
+
     def prepare_repos(self):
         """
         Prepare repos for the tests.
         """
         def merge_pulls(repo_name, pull_nos):
             branch_name = ','.join(pull_nos)
+            if self.args.resume:
+                cmd = 'git checkout %s' % branch_name
+                if not utils.run(cmd, ignore_status=True).exit_status:
+                    print 'Resuming on existing branch %s' % branch_name
+                    return branch_name
             cmd = 'git checkout -b %s' % branch_name
             res = utils.run(cmd, ignore_status=True)
             if res.exit_status:
                 print res
                 raise Exception('Failed to create branch %s' % branch_name)
 
-            for pull_no in pull_nos:
-                if pr_open(repo_name, pull_no):
-                    patch_url = ('https://github.com/autotest'
-                                 '/%s/pull/%s.patch' % (repo_name, pull_no))
-                    patch_file = "/tmp/%s.patch" % pull_no
-                    with open(patch_file, 'w') as pf:
-                        pf.write(urllib2.urlopen(patch_url).read())
-                    with open(patch_file, 'r') as pf:
-                        if not pf.read().strip():
-                            print 'WARING: empty content for PR #%s' % pull_no
-                    try:
-                        print 'Patching %s PR #%s' % (repo_name, pull_no)
-                        cmd = 'git am -3 %s' % patch_file
-                        res = utils.run(cmd)
-                    except error.CmdError, e:
-                        print e
-                        raise Exception('Failed applying patch %s.' % pull_no)
-                    finally:
-                        os.remove(patch_file)
+            self.apply_pulls(repo_name, pull_nos)
             return branch_name
 
         def file_changed(repo_name):
@@ -1214,83 +4779,168 @@ class LibvirtCI():
 
             return res.stdout.strip().splitlines()
 
-        def search_dep(line):
-            pattern1 = r'autotest/virt-test#([0-9]*)'
-            pattern2 = (r'https?://github.com/autotest/virt-test/(?:pull|issues)/([0-9]*)')
-            res = set()
-            match = re.findall(pattern1, line)
-            res |= set(match)
-            match = re.findall(pattern2, line)
-            res |= set(match)
-            return res
-
-        def pr_open(repo_name, pr_number):
-            oauth = ('?client_id=b6578298435c3eaa1e3d&client_secret'
-                     '=59a1c828c6002ed4e8a9205486cf3fa86467a609')
-            issues_url = 'https://api.github.com/repos/autotest/%s/issues/' % repo_name
-            issue_url = issues_url + pr_number + oauth
-            issue_u = urllib2.urlopen(issue_url)
-            issue = json.load(issue_u)
-            return issue['state'] == 'open'
-
-        def libvirt_pr_dep(pr_numbers):
-            oauth = ('?client_id=b6578298435c3eaa1e3d&client_secret'
-                     '=59a1c828c6002ed4e8a9205486cf3fa86467a609')
-            dep = set()
-            for pr_number in pr_numbers:
-                # Find PR's first comment for dependencies.
-                issues_url = 'https://api.github.com/repos/autotest/tp-libvirt/issues/'
-                issue_url = issues_url + pr_number + oauth
-                issue_u = urllib2.urlopen(issue_url)
-                issue = json.load(issue_u)
-                for line in issue['body'].splitlines():
-                    dep |= search_dep(line)
-
-                # Find PR's other comments for dependencies.
-                comments_url = issues_url + '%s/comments' % pr_number + oauth
-                comments_u = urllib2.urlopen(comments_url)
-                comments = json.load(comments_u)
-                for comment in comments:
-                    for line in comment['body'].splitlines():
-                        dep |= search_dep(line)
-
-            # Remove closed dependences:
-            pruned_dep = set()
-            for pr_number in dep:
-                if pr_open('virt-test', pr_number):
-                    pruned_dep.add(pr_number)
-
-            return pruned_dep
-
         self.virt_branch_name, self.libvirt_branch_name = None, None
+        self.merged_pulls = []
+        self.pull_patches, self.pull_heads = {}, {}
 
-        libvirt_pulls = set()
-        virt_test_pulls = set()
-
+        requested = []
         if self.args.libvirt_pull:
-            libvirt_pulls = set(self.args.libvirt_pull.split(','))
-
-        if self.args.with_dependence:
-            virt_test_pulls = libvirt_pr_dep(libvirt_pulls)
-
+            requested += [('tp-libvirt', pull_no) for pull_no in
+                          sorted(set(self.args.libvirt_pull.split(',')))]
         if self.args.virt_test_pull:
-            virt_test_pulls |= set(self.args.virt_test_pull.split(','))
+            requested += [('virt-test', pull_no) for pull_no in
+                          sorted(set(self.args.virt_test_pull.split(',')))]
+
+        pulls = {}
+        if requested:
+            cache_dir = ''
+            if self.args.github_cache:
+                cache_dir = os.path.abspath(self.args.github_cache)
+            client = GithubClient(cache_dir, int(self.args.github_workers))
+            resolver = PullResolver(client, self.args.github_api,
+                                    self.args.github_url)
+            try:
+                pulls = resolver.resolve(requested,
+                                         follow=self.args.with_dependence)
+                self.merged_pulls = [pull for pull in resolver.order
+                                     if resolver.is_open(*pull)]
+                self.pull_patches = dict(zip(
+                    self.merged_pulls,
+                    client.map(resolver.patch, self.merged_pulls)))
+                if self.args.worktrees:
+                    self.pull_heads = dict(zip(
+                        self.merged_pulls,
+                        client.map(resolver.head_sha, self.merged_pulls)))
+            finally:
+                client.close()
+
+        if self.args.worktrees and requested:
+            self.worktrees = WorktreeCache(os.path.abspath(self.args.worktrees),
+                                           int(self.args.worktree_keep))
+            self.build_worktrees(self.merged_pulls)
+            if self.args.only_change:
+                os.chdir(self.root_dir)
+                self.virt_file_changed = file_changed("virt-test")
+                os.chdir(self.provider_dir)
+                self.libvirt_file_changed = file_changed("tp-libvirt")
+            os.chdir(self.root_dir)
+            return
 
-        if virt_test_pulls:
+        if pulls.get('virt-test'):
             os.chdir(data_dir.get_root_dir())
-            self.virt_branch_name = merge_pulls("virt-test", virt_test_pulls)
+            self.virt_branch_name = merge_pulls("virt-test", pulls['virt-test'])
             if self.args.only_change:
                 self.virt_file_changed = file_changed("virt-test")
 
-        if libvirt_pulls:
+        if pulls.get('tp-libvirt'):
             os.chdir(data_dir.get_test_provider_dir(
                 'io-github-autotest-libvirt'))
-            self.libvirt_branch_name = merge_pulls("tp-libvirt", libvirt_pulls)
+            self.libvirt_branch_name = merge_pulls("tp-libvirt",
+                                                   pulls['tp-libvirt'])
             if self.args.only_change:
                 self.libvirt_file_changed = file_changed("tp-libvirt")
 
         os.chdir(data_dir.get_root_dir())
 
+    def apply_pulls(self, repo_name, pull_nos):
+        """
+        Apply patches of open pull requests to the repo in current directory.
+        """
+        for pull_no in pull_nos:
+            patch = self.pull_patches.get((repo_name, pull_no))
+            if patch is None:
+                continue
+            if not patch.strip():
+                print 'WARING: empty content for PR #%s' % pull_no
+            fd, patch_file = tempfile.mkstemp(suffix='.patch')
+            with os.fdopen(fd, 'w') as pf:
+                pf.write(patch)
+            try:
+                print 'Patching %s PR #%s' % (repo_name, pull_no)
+                cmd = 'git am -3 %s' % patch_file
+                utils.run(cmd)
+            except error.CmdError, e:
+                print e
+                utils.run('git am --abort', ignore_status=True)
+                raise Exception('Failed applying patch %s.' % pull_no)
+            finally:
+                os.remove(patch_file)
+
+    def build_worktrees(self, pulls):
+        """
+        Get worktrees with given pull requests merged and run tests in them.
+
+        :param pulls: List of (repo, number) of open pull requests in
+                      merge order.
+        """
+        def build_tree(repo_name, repo_dir, extra=''):
+            res = utils.run('git -C %s rev-parse master' % repo_dir)
+            base_sha = res.stdout.strip()
+            pull_nos = [n for repo, n in pulls if repo == repo_name]
+            key = self.worktrees.key(
+                base_sha, [self.pull_heads[(repo_name, n)] for n in pull_nos],
+                extra)
+            path = self.worktrees.get(
+                repo_dir, repo_name, key, base_sha,
+                [('%s PR #%s' % (repo_name, n),
+                  self.pull_patches[(repo_name, n)]) for n in pull_nos])
+            return path, key
+
+        live_root = data_dir.get_root_dir()
+        live_provider = data_dir.get_test_provider_dir(
+            'io-github-autotest-libvirt')
+        provider_tree, provider_key = live_provider, ''
+        if [repo for repo, _ in pulls if repo == 'tp-libvirt']:
+            provider_tree, provider_key = build_tree('tp-libvirt',
+                                                     live_provider)
+        # The virt-test tree links to the tp-libvirt tree, so it is
+        # keyed by both.
+        self.root_dir, _ = build_tree('virt-test', live_root, provider_key)
+        self.provider_dir = os.path.join(
+            self.root_dir, os.path.relpath(live_provider, live_root))
+        self.provider_tree = provider_tree
+        self.link_worktree()
+        os.chdir(self.root_dir)
+
+    def link_worktree(self):
+        """
+        Link untracked files of the virt-test checkout, like generated cfgs,
+        data and test providers, into the worktree tests run in.
+        """
+        live_root = data_dir.get_root_dir()
+        live_provider = data_dir.get_test_provider_dir(
+            'io-github-autotest-libvirt')
+        provider_rel = os.path.relpath(live_provider, live_root)
+        providers_rel = os.path.dirname(provider_rel)
+        res = utils.run("git -C %s ls-files --others --directory "
+                        "-x '*.pyc' -x '*.pyo'" % live_root)
+        for rel in res.stdout.splitlines():
+            rel = rel.rstrip('/')
+            if rel == 'logs' or (provider_rel + '/').startswith(rel + '/'):
+                continue
+            src = os.path.join(live_root, rel)
+            dst = os.path.join(self.root_dir, rel)
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            if rel.endswith('.py'):
+                # Copied, so the warm worker imports virttest of the tree.
+                shutil.copy2(src, dst)
+            elif not os.path.lexists(dst):
+                os.symlink(src, dst)
+
+        providers_dir = os.path.join(self.root_dir, providers_rel)
+        if not os.path.isdir(providers_dir):
+            os.makedirs(providers_dir)
+        for entry in os.listdir(os.path.dirname(live_provider)):
+            src = os.path.join(os.path.dirname(live_provider), entry)
+            if src == live_provider:
+                src = self.provider_tree
+            dst = os.path.join(providers_dir, entry)
+            if os.path.islink(dst) and os.readlink(dst) != src:
+                os.remove(dst)
+            if not os.path.lexists(dst):
+                os.symlink(src, dst)
+
     def restore_repos(self):
         """
         Checkout master branch and remove test branch.
@@ -1319,59 +4969,561 @@ class LibvirtCI():
         """
         Action to perform before a test
         """
-        from virttest import virsh
-        res = virsh.dumpxml('virt-tests-vm1',
-                            ignore_status=True,
-                            uri=self.args.connect_uri)
-        if not res.exit_status:
-            domxml = res.stdout
-            fname = '/var/lib/libvirt/qemu/nvram/virt-tests-vm1_VARS.fd'
-            if not os.path.exists(fname) and fname in domxml:
-                logging.warning(
-                    'nvram in XML, but file %s do not exists. '
-                    'Removing nvram line. XML:\n%s' % (fname, domxml))
-                domxml = re.sub('<nvram>.*</nvram>', '', domxml)
-                virsh.destroy('virt-tests-vm1',
-                              ignore_status=True,
-                              uri=self.args.connect_uri)
-                virsh.undefine('virt-tests-vm1',
-                               '--snapshots-metadata --managed-save',
-                               ignore_status=True,
-                               uri=self.args.connect_uri)
+        if self.health_gate is not None:
+            self.health_gate.run()
 
-                xml_path = '/tmp/virt-test-ci.xml'
-                with open(xml_path, 'w') as fp:
-                    fp.write(domxml)
-                res = virsh.define(xml_path)
-                if res.exit_status:
-                    logging.error('Define command result:\n%s', res)
-                    raise Exception('Failed to define domain for XML:\n%s' % domxml)
-                try:
-                    os.remove(xml_path)
-                except OSError:
-                    pass
-        else:
-            logging.warning('Failed to dumpxml from virt-tests-vm1\n%s', res)
+        if self.snapshot is not None:
+            self.restore_guest(test)
+
+    def restore_guest(self, test):
+        """
+        Restore the saved guest if the test requires a running guest
+        which is not running yet.
+        """
+        start = self.test_vm_states.get(test, (None, False))[0]
+        if start != 'on':
+            return
+        if virsh.is_alive('virt-tests-vm1', uri=self.args.connect_uri):
+            return
+        if not self.snapshot.valid():
+            logging.info('Guest snapshot is invalid, creating a new one')
+            if not self.snapshot.create():
+                return
+        if not self.snapshot.restore():
+            self.snapshot.discard()
+
+    def is_failure(self, status):
+        """
+        Check whether a status means the test did not pass.
+        """
+        return status.split()[0] in ('FAIL', 'ERROR', 'TIMEOUT', 'INVALID')
+
+    def record_result(self, report, test, status, res, err_msg):
+        """
+        Insert the result of a finished test into report and save it.
+
+        :return: The recorded status, marked QUARANTINED for failures of
+                 quarantined tests.
+        """
+        if test in self.quarantine and self.is_failure(status):
+            status += ' QUARANTINED'
+        class_name, test_name = self.split_name(test)
+        if self.journal is not None:
+            self.journal.write('result', test=test, test_name=test_name,
+                               class_name=class_name, status=status,
+                               log=res.stderr, err_msg=err_msg,
+                               duration=res.duration)
+        report.update(test_name, class_name, status,
+                      res.stderr, err_msg, res.duration)
+        resources = getattr(res, 'resources', None)
+        if resources:
+            for name in sorted(resources):
+                report.set_property(test_name, class_name, name,
+                                    resources[name])
+            self.write_resources(test, status, res.duration, resources)
+        report.save(self.args.report)
+        if self.progress is not None:
+            self.progress.finish(test, status, res.duration)
+        if self.history is not None:
+            self.history.add(test, class_name, status, res.duration)
+            if self.is_failure(status) or 'DIFF' in status:
+                self.history.add_failures(
+                    test, FailureSignature.extract(status, err_msg))
+            if status == 'PASS' and test in self.cache_keys:
+                self.history.add_pass(self.cache_keys[test], test)
+        return status
+
+    def write_resources(self, test, status, duration, resources):
+        """
+        Append resource usage of a test to --resource-csv.
+        """
+        names = sorted(resources)
+        new = not os.path.exists(self.resource_csv)
+        with open(self.resource_csv, 'a') as fp:
+            writer = csv.writer(fp)
+            if new:
+                writer.writerow(['test', 'status', 'duration'] + names)
+            writer.writerow([test, status, '%.2f' % duration] +
+                            [resources[name] for name in names])
+
+    def caching(self):
+        """
+        Check whether cache keys of tests are needed by this run.
+        """
+        return self.history is not None and (self.args.cache or
+                                             self.args.record_cache)
+
+    def skip_cached(self, tests, report):
+        """
+        Get cache keys of tests so their clean passes are recorded.
+
+        With --cache, tests with a cached clean pass are reported and only
+        the other ones are returned.
+        """
+        cache = ResultCache(
+            self.history, self.root_dir, self.provider_dir, self.image_digest,
+            self.run_args(), self.args.config)
+        remaining = []
+        for test in tests:
+            if self.args.cache:
+                key, cached = cache.lookup(test)
+            else:
+                key, cached = cache.key(test), None
+            if cached is None:
+                self.cache_keys[test] = key
+                remaining.append(test)
+                continue
+            run_id, timestamp = cached
+            log = 'Cached PASS of run %s at %s, test not run.' % (
+                run_id, time.strftime('%Y-%m-%d %X', time.localtime(timestamp)))
+            res = utils.CmdResult('cache:%s' % test, '', log, 0, 0)
+            print '%s %s Result: PASS CACHED' % (time.strftime('%X'),
+                                                 test.split('.', 2)[2])
+            self.record_result(report, test, 'PASS CACHED', res, [])
+            class_name, test_name = self.split_name(test)
+            report.set_property(test_name, class_name, 'cached_from_run',
+                                run_id)
+            report.save(self.args.report)
+        if self.args.cache:
+            print '%d of %d tests skipped by cached passes' % (
+                len(tests) - len(remaining), len(tests))
+            sys.stdout.flush()
+        return remaining
+
+    def run_tests(self, tests, report, failed=None):
+        """
+        Run tests one by one or in batches and record their results.
+
+        :param failed: List of (test, status, err_msg) of failures recorded
+                       before resuming, to retry and bisect with new ones.
+        """
+        if self.caching():
+            tests = self.skip_cached(tests, report)
+        batch_size = int(self.args.batch_size)
+        failed = list(failed or [])
+        idx = 0
+        solo_until = 0
+        while idx < len(tests):
+            if batch_size > 1 and idx >= solo_until:
+                batch = tests[idx:idx + batch_size]
+                print '%s (%d-%d/%d) Running batch of %d tests' % (
+                    time.strftime('%X'), idx + 1, idx + len(batch),
+                    len(tests), len(batch))
+                sys.stdout.flush()
+                if self.progress is not None:
+                    self.progress.begin(batch)
+                self.prepare_test(batch[0])
+                results, pending = self.run_batch(
+                    batch,
+                    check=not self.args.no_check,
+                    recover=not self.args.no_recover)
+                for test, status, res, err_msg in results:
+                    short_name = test.split('.', 2)[2]
+                    print '    %s Result: %s %.2f s' % (
+                        short_name, status, res.duration)
+                    for line in err_msg:
+                        print line
+                    status = self.record_result(report, test, status, res,
+                                                err_msg)
+                    if self.is_failure(status) and 'QUARANTINED' not in status:
+                        failed.append((test, status, err_msg))
+                sys.stdout.flush()
+                # Tests which never started are run one by one.
+                tests[idx:idx + len(batch)] = (
+                    [result[0] for result in results] + pending)
+                idx += len(results)
+                solo_until = idx + len(pending)
+                if not pending:
+                    continue
+
+            test = tests[idx]
+            short_name = test.split('.', 2)[2]
+            print '%s (%d/%d) %s ' % (time.strftime('%X'), idx + 1,
+                                      len(tests), short_name),
+            sys.stdout.flush()
+            if self.progress is not None:
+                self.progress.begin([test])
+
+            self.prepare_test(test)
+
+            status, res, err_msg = self.run_test(
+                test,
+                check=not self.args.no_check,
+                recover=not self.args.no_recover)
+
+            status = self.record_result(report, test, status, res, err_msg)
+            if self.is_failure(status) and 'QUARANTINED' not in status:
+                failed.append((test, status, err_msg))
+            idx += 1
+
+        failed = self.retry_failed(failed, report)
+        if self.args.bisect_prs:
+            self.bisect_pulls(failed, report)
+
+    def retry_failed(self, failed, report):
+        """
+        Re-run failed tests one by one within --retry-budget.
+
+        Tests passing on retry are reported as flaky along with messages
+        of their first failure.
+
+        :return: List of tests which still failed.
+        """
+        budget = int(self.args.retry_budget)
+        if not failed or budget <= 0:
+            return [test for test, _, _ in failed]
+        failures = []
+        retries = failed[:budget]
+        print 'Retrying %d of %d failed tests' % (len(retries), len(failed))
+        for idx, (test, first_status, first_err_msg) in enumerate(retries):
+            short_name = test.split('.', 2)[2]
+            print '%s (retry %d/%d) %s ' % (time.strftime('%X'), idx + 1,
+                                            len(retries), short_name),
+            sys.stdout.flush()
+            if self.progress is not None:
+                self.progress.begin([test])
+
+            self.prepare_test(test)
+
+            status, res, err_msg = self.run_test(
+                test,
+                check=not self.args.no_check,
+                recover=not self.args.no_recover)
+            if status.split()[0] == 'PASS':
+                status += ' FLAKY'
+                err_msg = (['First attempt: %s' % first_status] +
+                           first_err_msg + err_msg)
+            status = self.record_result(report, test, status, res, err_msg)
+            if self.is_failure(status):
+                failures.append(test)
+        return failures + [test for test, _, _ in failed[budget:]]
+
+    def checkout_pulls(self, pulls):
+        """
+        Switch tests to a tree with only given pull requests merged.
+
+        :param pulls: List of (repo, number) in merge order.
+        """
+        if self.worktrees is not None:
+            self.build_worktrees(pulls)
+            return
+        repos = [('virt-test', data_dir.get_root_dir(),
+                  self.virt_branch_name),
+                 ('tp-libvirt', data_dir.get_test_provider_dir(
+                     'io-github-autotest-libvirt'), self.libvirt_branch_name)]
+        for repo_name, repo_dir, branch_name in repos:
+            if branch_name is None:
+                continue
+            os.chdir(repo_dir)
+            if pulls == self.merged_pulls:
+                utils.run('git checkout %s' % branch_name)
+                utils.run('git branch -D ci-bisect', ignore_status=True)
+            else:
+                utils.run('git checkout -B ci-bisect master')
+                self.apply_pulls(repo_name,
+                                 [n for repo, n in pulls if repo == repo_name])
+        os.chdir(self.root_dir)
+
+    def bisect_pulls(self, failed, report):
+        """
+        Find pull requests causing failures of tests which pass on master.
+
+        Failed tests are run again on master, then with prefixes of the
+        merged pull requests in merge order, halving the candidates of
+        each test every round.
+        """
+        pulls = self.merged_pulls
+        if not failed or not pulls:
+            return
+        if self.warm_runner is not None:
+            # The worker keeps the code of the tree it was started in.
+            self.warm_runner.close()
+            self.warm_runner = None
+        log_dir = self.log_dir
+
+        def run_with(count, tests):
+            print 'Running %d tests with %d of %d pull requests' % (
+                len(tests), count, len(pulls))
+            self.checkout_pulls(pulls[:count])
+            self.log_dir = os.path.join(log_dir, 'bisect-%d' % count)
+            statuses = {}
+            for test in tests:
+                print '    %s' % test.split('.', 2)[2],
+                sys.stdout.flush()
+                self.prepare_test(test)
+                # Recover states so one test can not affect the next.
+                status, res, err_msg = self.run_test(
+                    test, check=not self.args.no_check,
+                    recover=not self.args.no_recover)
+                statuses[test] = status
+            return statuses
+
+        try:
+            baseline = run_with(0, failed)
+            good, bad = {}, {}
+            for test in failed:
+                class_name, test_name = self.split_name(test)
+                report.set_property(test_name, class_name, 'master_status',
+                                    baseline[test])
+                if not self.is_failure(baseline[test]):
+                    good[test], bad[test] = 0, len(pulls)
+            if not good:
+                print 'All failures also happen on master'
+                return
+            while True:
+                rounds = {}
+                for test in good:
+                    if bad[test] - good[test] > 1:
+                        count = (good[test] + bad[test]) // 2
+                        rounds.setdefault(count, []).append(test)
+                if not rounds:
+                    break
+                for count in sorted(rounds):
+                    statuses = run_with(count, rounds[count])
+                    for test in rounds[count]:
+                        if self.is_failure(statuses[test]):
+                            bad[test] = count
+                        else:
+                            good[test] = count
+            print 'Pull requests causing new failures:'
+            for test in failed:
+                if test not in good:
+                    continue
+                culprit = '%s#%s' % pulls[bad[test] - 1]
+                class_name, test_name = self.split_name(test)
+                report.set_property(test_name, class_name, 'culprit_pr',
+                                    culprit)
+                print '    %s: %s' % (test.split('.', 2)[2], culprit)
+        finally:
+            self.log_dir = log_dir
+            self.checkout_pulls(pulls)
+            report.save(self.args.report)
+
+    def run_hook(self, cmd):
+        """
+        Run a command line given by --pre-cmd or --post-cmd.
+        """
+        res = utils.run(cmd, ignore_status=True)
+        print 'Result:'
+        for line in str(res).splitlines():
+            print line
+
+    def uri_conflict(self, uri1, uri2):
+        """
+        Check whether tests with two connect URIs can not run at the same
+        time.
+
+        Guests of the same driver share the guest image, and URIs served
+        by the same libvirtd, system or session, share the networks, pools
+        and secrets checked by each child and the daemon which tests may
+        restart.
+        """
+        def driver(uri):
+            return uri.split(':', 1)[0].split('+')[0]
+
+        def system(uri):
+            return not uri.rstrip('/').endswith('/session')
+
+        return driver(uri1) == driver(uri2) or system(uri1) == system(uri2)
+
+    def child_args(self, drop):
+        """
+        Get command line options of this run for a child run.
+
+        :param drop: Dests of options to leave out.
+        """
+        args = []
+        argv = sys.argv[1:]
+        idx = 0
+        while idx < len(argv):
+            arg = argv[idx]
+            idx += 1
+            option = None
+            if arg.startswith('-'):
+                option = self.parser.get_option(arg.split('=', 1)[0])
+            if option is None:
+                args.append(arg)
+                continue
+            value = []
+            if option.takes_value() and '=' not in arg:
+                value = argv[idx:idx + 1]
+                idx += 1
+            if option.dest not in drop:
+                args += [arg] + value
+        return args
+
+    def run_matrix(self, tests, report):
+        """
+        Run tests with each connect URI of --uri-matrix.
+
+        Guests are prepared for each URI in this process, then a child run
+        for each URI runs the listed tests. Results of the children are
+        read from their journals into report, with the URI in suite names.
+        """
+        uris = [uri for uri in self.args.uri_matrix.split(',') if uri]
+        for idx, uri in enumerate(uris):
+            print 'Preparing environment for %s' % uri
+            self.args.connect_uri = uri
+            self.prepare_env(shared=(idx == 0))
+
+        groups = []
+        for uri in uris:
+            for group in groups:
+                if not [u for u in group if self.uri_conflict(u, uri)]:
+                    group.append(uri)
+                    break
+            else:
+                groups.append([uri])
+
+        script = os.path.join(self.root_dir, os.path.basename(__file__))
+        if not os.path.exists(script):
+            script = os.path.abspath(__file__)
+        base_args = self.child_args(set([
+            'uri_matrix', 'matrix_child', 'matrix_concurrent', 'connect_uri',
+            'report', 'journal', 'log_dir', 'snapshot_dir', 'resource_csv',
+            'image_digest', 'quarantine', 'status_address', 'resume', 'list',
+            'pre_cmd', 'post_cmd', 'virt_test_pull', 'libvirt_pull',
+            'with_dependence', 'bisect_prs', 'worktrees', 'worktree_keep']))
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        fd, tests_file = tempfile.mkstemp(prefix='virt-test-ci-tests-')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(''.join(test + '\n' for test in tests))
+        report_base, report_ext = os.path.splitext(
+            os.path.abspath(self.args.report))
+        host_states = [state for state in self.states
+                       if not isinstance(state, LIBVIRT_STATES)]
+        try:
+            for group in groups:
+                concurrent = len(group) > 1 and not self.args.no_check
+                if concurrent:
+                    for state in host_states:
+                        state.backup()
+                children = []
+                for uri in group:
+                    label = re.sub(r'\W+', '_', uri).strip('_')
+                    journal_path = '%s.%s' % (self.journal.path, label)
+                    log_path = os.path.join(self.log_dir,
+                                            'matrix-%s.log' % label)
+                    cmd = [sys.executable, script] + base_args + [
+                        '--connect-uri', uri,
+                        '--matrix-child', tests_file,
+                        '--report', '%s.%s%s' % (report_base, label,
+                                                 report_ext),
+                        '--journal', journal_path,
+                        '--log-dir', os.path.join(self.log_dir, label),
+                        '--snapshot-dir', os.path.join(self.snapshot_dir,
+                                                       label),
+                        '--resource-csv', '%s.%s' % (self.resource_csv, label)]
+                    if self.image_digest:
+                        cmd += ['--image-digest', self.image_digest]
+                    if self.quarantine_path:
+                        cmd += ['--quarantine', self.quarantine_path]
+                    if concurrent:
+                        cmd.append('--matrix-concurrent')
+                    print '%s Running %d tests with %s, output in %s' % (
+                        time.strftime('%X'), len(tests), uri, log_path)
+                    sys.stdout.flush()
+                    with open(log_path, 'w') as log:
+                        proc = subprocess.Popen(cmd, stdout=log,
+                                                stderr=subprocess.STDOUT,
+                                                cwd=self.root_dir)
+                    children.append((uri, proc, journal_path))
+                for uri, proc, journal_path in children:
+                    proc.wait()
+                    results = Journal(journal_path).load()['results']
+                    for result in results:
+                        report.update(result['test_name'],
+                                      '%s(%s)' % (result['class_name'], uri),
+                                      result['status'], result['log'],
+                                      result['err_msg'], result['duration'])
+                    report.save(self.args.report)
+                    print '%s Finished %d tests with %s, exit status %s' % (
+                        time.strftime('%X'), len(results), uri, proc.returncode)
+                    sys.stdout.flush()
+                if concurrent:
+                    diff = []
+                    for state in host_states:
+                        diff += state.check(recover=not self.args.no_recover)
+                    if diff:
+                        print 'Host state changed by tests with %s:' % (
+                            ', '.join(group))
+                        for line in diff:
+                            print '   DIFF|%s' % line
+        finally:
+            os.remove(tests_file)
 
     def run(self):
         """
         Run continuous integrate for virt-test test cases.
         """
         self.parse_args()
+        self.log_dir = os.path.abspath(self.args.log_dir)
+        self.snapshot_dir = os.path.abspath(self.args.snapshot_dir)
+        self.download_dir = os.path.abspath(self.args.download_dir)
+        self.quarantine_path = ''
+        if self.args.quarantine:
+            self.quarantine_path = os.path.abspath(self.args.quarantine)
         report = Report(self.args.fail_diff)
+        self.warm_runner = None
+        # Matrix children get the digest of the image their parent prepared.
+        self.image_digest = self.args.image_digest or None
+        self.cache_keys = {}
+        self.quarantine = set()
+        self.snapshot = None
+        self.test_vm_states = {}
+        self.history = None
+        if self.args.history:
+            self.history = History(os.path.abspath(self.args.history))
+        self.journal = Journal(os.path.abspath(self.args.journal))
+        self.root_dir = data_dir.get_root_dir()
+        self.provider_dir = data_dir.get_test_provider_dir(
+            'io-github-autotest-libvirt')
+        self.worktrees = None
+        self.progress = None
+        self.status_server = None
+        self.sampler = None
+        self.resource_csv = os.path.abspath(self.args.resource_csv)
+        if float(self.args.sample_interval) > 0:
+            self.sampler = ResourceSampler(float(self.args.sample_interval))
+        self.health_gate = None
+        if self.args.health_checks:
+            self.health_gate = HealthGate(
+                'virt-tests-vm1', self.args.connect_uri,
+                self.args.health_checks.split(','))
         try:
             self.prepare_repos()
             if self.args.pre_cmd:
                 print 'Running command line "%s" before test.' % self.args.pre_cmd
-                res = utils.run(self.args.pre_cmd, ignore_status=True)
-                print 'Result:'
-                for line in str(res).splitlines():
-                    print line
+                self.run_hook(self.args.pre_cmd)
             # service must put at first, or the result will be wrong.
             self.states = [FileState(), ServiceState(), DirState(),
                            DomainState(), NetworkState(), PoolState(),
                            SecretState(), MountState()]
-            tests = self.prepare_tests()
+            for state in self.states:
+                if isinstance(state, LIBVIRT_STATES):
+                    state.uri = self.args.connect_uri
+            if self.args.matrix_concurrent:
+                # Host wide states are checked by the parent run.
+                self.states = [state for state in self.states
+                               if isinstance(state, LIBVIRT_STATES)]
+            resume = None
+            failed = []
+            if self.args.resume:
+                resume = self.journal.load()
+                if resume['tests'] is None or resume['states'] is None:
+                    print 'No run to resume in %s' % self.journal.path
+                    resume = None
+
+            if resume is not None:
+                tests = resume['tests']
+                self.read_quarantine()
+            elif self.args.matrix_child:
+                with open(self.args.matrix_child) as fp:
+                    tests = [line.strip() for line in fp if line.strip()]
+                self.read_quarantine()
+            else:
+                tests = self.prepare_tests()
 
             if self.args.list:
                 for test in tests:
@@ -1384,37 +5536,107 @@ class LibvirtCI():
                 print "No test to run!"
                 return
 
-            self.prepare_env()
-            for state in self.states:
-                state.backup()
-
-            for idx, test in enumerate(tests):
-                short_name = test.split('.', 2)[2]
-                print '%s (%d/%d) %s ' % (time.strftime('%X'), idx + 1,
-                                          len(tests), short_name),
-                sys.stdout.flush()
-
-                self.prepare_test(test)
-
-                status, res, err_msg = self.run_test(
-                    test,
-                    check=not self.args.no_check,
-                    recover=not self.args.no_recover)
-
-                class_name, test_name = self.split_name(test)
+            if self.args.uri_matrix:
+                self.run_matrix(tests, report)
+                self.update_quarantine()
+                if self.args.post_cmd:
+                    print 'Running command line "%s" after test.' % self.args.post_cmd
+                    self.run_hook(self.args.post_cmd)
+                return
 
-                report.update(test_name, class_name, status,
-                              res.stderr, err_msg, res.duration)
+            if resume is not None:
+                if self.history is not None:
+                    self.history.run_id = resume['run_id']
+                self.image_digest = resume.get('image_digest')
+                for state in self.states:
+                    state.backup_state = resume['states'][state.name]
+                finished = collections.OrderedDict()
+                for result in resume['results']:
+                    report.update(result['test_name'], result['class_name'],
+                                  result['status'], result['log'],
+                                  result['err_msg'], result['duration'])
+                    finished[result['test']] = result
+                failed = [(test, result['status'], result['err_msg'])
+                          for test, result in finished.items()
+                          if self.is_failure(result['status']) and
+                          'QUARANTINED' not in result['status']]
                 report.save(self.args.report)
+                print 'Resuming run with %d of %d tests finished, %d failed' % (
+                    len(finished), len(tests), len(failed))
+                tests = [t for t in tests if t not in finished]
+            else:
+                run_id = None
+                if self.history is not None:
+                    run_id = self.history.start_run(
+                        socket.gethostname(),
+                        self.repo_sha(self.root_dir),
+                        self.repo_sha(self.provider_dir))
+                tests = self.order_tests(tests)
+                if self.args.order_vm_state:
+                    tests = self.order_by_vm_state(tests)
+                elif self.args.guest_snapshot:
+                    self.test_vm_states = self.vm_states(tests)
+                self.journal.start()
+                self.journal.write('tests', tests=tests)
+                self.journal.write('run_id', run_id=run_id)
+
+                if not self.args.matrix_child:
+                    self.prepare_env()
+                if self.args.guest_snapshot:
+                    self.snapshot = GuestSnapshot(
+                        'virt-tests-vm1', self.snapshot_dir,
+                        self.args.connect_uri,
+                        int(self.args.snapshot_boot_timeout))
+                    if not self.snapshot.create():
+                        self.snapshot = None
+                for state in self.states:
+                    state.backup()
+                self.journal.write('states', states=dict(
+                    (state.name, state.backup_state) for state in self.states))
+                self.journal.write('image_digest',
+                                   image_digest=self.image_digest)
+
+            if self.args.warm:
+                script = os.path.join(self.root_dir,
+                                      os.path.basename(__file__))
+                if not os.path.exists(script):
+                    script = None
+                self.warm_runner = WarmRunner(
+                    self.run_args(), int(self.args.warm_max_tests), script)
+
+            if self.args.status_address:
+                expected = {}
+                if self.history is not None:
+                    expected = self.history.average_durations()
+                self.progress = Progress(tests, expected)
+                self.status_server = StatusServer(self.args.status_address,
+                                                  self.progress)
+                self.status_server.start()
+
+            self.run_tests(tests, report, failed)
+            # Children share the quarantine file, their parent updates it.
+            if not self.args.matrix_child:
+                self.update_quarantine()
+            if self.history is not None:
+                print_clusters(self.history.clusters(runs=1),
+                               'Top failure signatures of this run:')
             if self.args.post_cmd:
                 print 'Running command line "%s" after test.' % self.args.post_cmd
-                res = utils.run(self.args.post_cmd, ignore_status=True)
-                print 'Result:'
-                for line in str(res).splitlines():
-                    print line
+                self.run_hook(self.args.post_cmd)
         except Exception:
             traceback.print_exc()
         finally:
+            if self.warm_runner is not None:
+                self.warm_runner.close()
+            if self.snapshot is not None:
+                self.snapshot.discard()
+            if self.history is not None:
+                self.history.close()
+            self.journal.close()
+            if self.worktrees is not None:
+                self.worktrees.close()
+            if self.status_server is not None:
+                self.status_server.close()
             if not self.args.no_restore_pull:
                 self.restore_repos()
             report.save(self.args.report)
@@ -1439,7 +5661,223 @@ def state_test():
             print line
 
 
+def warm_worker(resp_fd, run_args):
+    """
+    Main loop of a WarmRunner worker process.
+
+    Options and the Cartesian parser are processed once by virt-test's
+    run script. Each request runs one test on a copy of the parser.
+    """
+    import copy
+    import imp
+    from virttest import standalone_test
+
+    os.chdir(data_dir.get_root_dir())
+    run_module = imp.load_source('virt_test_run', 'run')
+    app = run_module.VirtTestApp()
+    sys.argv = ['./run'] + run_args
+    app.options, app.args = app.option_parser.parse_args()
+    app._process_options()
+    base_parser = app.cartesian_parser
+
+    resp = os.fdopen(resp_fd, 'w')
+    for line in iter(sys.stdin.readline, ''):
+        request = json.loads(line)
+        parser = copy.deepcopy(base_parser)
+        parser.only_filter(request['test'])
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_fds = os.dup(1), os.dup(2)
+        for fd, path in ((1, request['stdout']), (2, request['stderr'])):
+            out_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            os.dup2(out_fd, fd)
+            os.close(out_fd)
+        try:
+            if standalone_test.run_tests(parser, app.options):
+                exit_status = 0
+            else:
+                exit_status = 1
+        except Exception:
+            traceback.print_exc()
+            exit_status = 2
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, saved_fd in zip((1, 2), saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+            os.chdir(data_dir.get_root_dir())
+
+        resp.write(json.dumps({'exit_status': exit_status}) + '\n')
+        resp.flush()
+
+
+def print_clusters(clusters, title):
+    """
+    Print failure signature clusters from History.clusters().
+    """
+    if not clusters:
+        return
+    print title
+    for signature, pattern, tests, failures, example in clusters:
+        print '    %s %4d tests %4d failures  %s' % (signature, tests,
+                                                     failures, pattern)
+        print '        e.g. %s' % example
+
+
+def signatures_main(argv):
+    """
+    Query failure signatures recorded in the history database.
+    """
+    parser = optparse.OptionParser(
+        usage='%prog signatures [options] [signature or message]',
+        description='List the most common failure signatures, or tests '
+        'failing with signatures matching an ID prefix or a message.')
+    parser.add_option('--history', dest='history', action='store',
+                      default='ci_history.db',
+                      help='SQLite database of test history.')
+    parser.add_option('--runs', dest='runs', action='store', default='10',
+                      help='Number of latest runs to search.')
+    parser.add_option('--limit', dest='limit', action='store', default='20',
+                      help='Number of signatures to list.')
+    args, queries = parser.parse_args(argv)
+    history = History(args.history)
+    try:
+        if not queries:
+            print_clusters(history.clusters(int(args.runs), int(args.limit)),
+                           'Top failure signatures of last %s runs:' %
+                           args.runs)
+            return
+        for signature, pattern in history.find_signatures(' '.join(queries)):
+            tests = history.signature_tests(signature, int(args.runs))
+            if not tests:
+                continue
+            print '%s %s' % (signature, pattern)
+            for test, runs, timestamp in tests:
+                print '    %-80s %3d runs, last %s' % (
+                    test, runs, time.strftime('%Y-%m-%d %H:%M',
+                                              time.localtime(timestamp)))
+    finally:
+        history.close()
+
+
+def simulate_main(argv):
+    """
+    Replay a recorded run offline under different scheduling policies.
+    """
+    parser = optparse.OptionParser(
+        usage='%prog simulate [options] [xunit report ...]',
+        description='Predict wall time, idle time of workers and time '
+        'wasted on timeouts of the last recorded run with each combination '
+        'of given orders, shard counts and worker counts. Runs are loaded '
+        'from xunit reports, oldest first, or from the history database.')
+    parser.add_option('--history', dest='history', action='store',
+                      default='ci_history.db', help='SQLite database of '
+                      'test history, used when no report is given.')
+    parser.add_option('--runs', dest='runs', action='store', default='10',
+                      help='Number of latest runs to load from history.')
+    parser.add_option('--order', dest='order', action='store',
+                      default='listing', help='Orders separated by ",": '
+                      'listing, failed-first, shortest-first or '
+                      'changed-first.')
+    parser.add_option('--shards', dest='shards', action='store',
+                      default='1', help='Numbers of hosts to split tests '
+                      'to, separated by ",".')
+    parser.add_option('--shard-by', dest='shard_by', action='store',
+                      type='choice', default='round-robin',
+                      choices=['round-robin', 'contiguous', 'balanced'],
+                      help='Split tests round-robin, in contiguous slices '
+                      'or balanced by recorded duration.')
+    parser.add_option('--workers', dest='workers', action='store',
+                      default='1', help='Numbers of concurrent workers '
+                      'on each host, separated by ",".')
+    parser.add_option('--timeout', dest='timeout', action='store',
+                      default='1200',
+                      help='Maximum run time for one test case')
+    parser.add_option('--adaptive-timeout', dest='adaptive_timeout',
+                      action='store_true', help='Compute timeouts from '
+                      'durations in earlier runs like ci.py does.')
+    parser.add_option('--timeout-factor', dest='timeout_factor',
+                      action='store', default='3',
+                      help='Multiply recorded duration percentile by '
+                      'specified factor for adaptive timeouts.')
+    parser.add_option('--timeout-floor', dest='timeout_floor',
+                      action='store', default='60',
+                      help='Minimum adaptive timeout for one test case')
+    parser.add_option('--timeout-ceiling', dest='timeout_ceiling',
+                      action='store', default='7200',
+                      help='Maximum adaptive timeout for one test case')
+    parser.add_option('--check-every', dest='check_every', action='store',
+                      default='1', help='Check states after specified '
+                      'number of tests, like --batch-size.')
+    parser.add_option('--check-cost', dest='check_cost', action='store',
+                      default='0', help='Seconds to check states once.')
+    args, reports = parser.parse_args(argv)
+
+    if reports:
+        runs = [Simulator.load_report(path) for path in reports]
+    elif os.path.exists(args.history):
+        history = History(args.history)
+        try:
+            runs = history.run_results(int(args.runs))
+        finally:
+            history.close()
+    else:
+        parser.error('No report given and no history in %s' % args.history)
+    runs = [run for run in runs if run]
+    if not runs:
+        parser.error('No recorded test to replay')
+    for order in args.order.split(','):
+        if order not in ORDERS:
+            parser.error('Unknown order %s' % order)
+    if int(args.check_every) < 1:
+        parser.error('--check-every must be at least 1')
+
+    simulator = Simulator(runs)
+    adaptive = None
+    if args.adaptive_timeout:
+        adaptive = (float(args.timeout_factor), int(args.timeout_floor),
+                    int(args.timeout_ceiling))
+    print 'Replaying %d tests recorded in %.1f s, %d earlier runs' % (
+        len(simulator.results),
+        sum(duration for _, duration in simulator.results.values()),
+        len(runs) - 1)
+    for order in args.order.split(','):
+        for shards in [int(n) for n in args.shards.split(',')]:
+            for workers in [int(n) for n in args.workers.split(',')]:
+                res = simulator.simulate(
+                    order, shards, args.shard_by, workers,
+                    int(args.timeout), adaptive, int(args.check_every),
+                    float(args.check_cost))
+                first_failure = 'none'
+                if res['first_failure'] is not None:
+                    first_failure = '%.1f s' % res['first_failure']
+                print ('order=%s shards=%d workers=%d: wall %.1f s, '
+                       '%d timeouts (%d new) wasting %.1f s, '
+                       'first failure %s' % (
+                           order, shards, workers, res['wall'],
+                           res['timeouts'], res['new_timeouts'],
+                           res['wasted'], first_failure))
+                for shard_idx, shard in enumerate(res['shards']):
+                    print '    shard %d: wall %.1f s' % (shard_idx + 1,
+                                                         shard['wall'])
+                    for idx, (count, busy, idle) in enumerate(
+                            shard['workers']):
+                        print ('        worker %d: %d tests, busy %.1f s, '
+                               'idle %.1f s' % (idx + 1, count, busy, idle))
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['--warm-worker']:
+        warm_worker(int(sys.argv[2]), sys.argv[3:])
+        sys.exit(0)
+    if sys.argv[1:2] == ['signatures']:
+        signatures_main(sys.argv[2:])
+        sys.exit(0)
+    if sys.argv[1:2] == ['simulate']:
+        simulate_main(sys.argv[2:])
+        sys.exit(0)
     ci = LibvirtCI()
     ci.run()
 
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+"""
+Time Report, State and test listing code of ci.py on synthetic inputs,
+with fakes of virsh and the host instead of a libvirt host.
+
+Run as: python tests/benchmark.py [options]
+"""
+import os
+import re
+import sys
+import time
+import json
+import shutil
+import socket
+import optparse
+import tempfile
+import itertools
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import ci
+from autotest.client import utils
+
+
+class FakeVirsh():
+
+    """
+    Stand-in for virttest.virsh keeping domains, networks, pools and
+    secrets in memory.
+
+    Only the calls made by State classes are implemented. Objects are
+    dicts which can be changed directly to script a test.
+    """
+
+    def __init__(self):
+        self.domains = {}
+        self.networks = {}
+        self.pools = {}
+        self.volumes = {}
+        self.secrets = {}
+        self.calls = collections.defaultdict(int)
+
+    def result(self, call, stdout='', exit_status=0):
+        self.calls[call] += 1
+        return utils.CmdResult('virsh %s' % call, stdout, '', exit_status, 0)
+
+    def table(self, call, header, rows):
+        lines = [' ' + header, '-' * 60]
+        lines += [' ' + '   '.join(row) for row in rows]
+        return self.result(call, '\n'.join(lines) + '\n')
+
+    def xml_name(self, path, tag='name'):
+        with open(path) as fp:
+            return re.search(r'<%s>([^<]*)</%s>' % (tag, tag),
+                             fp.read()).group(1)
+
+    def add_domain(self, name, state='running', persistent='yes',
+                   autostart='disable', lines=60):
+        xml = ['<domain type="kvm">', '  <name>%s</name>' % name]
+        xml += ['  <!-- %s device %d -->' % (name, idx)
+                for idx in range(lines)]
+        xml.append('</domain>')
+        self.domains[name] = {'state': state, 'persistent': persistent,
+                              'autostart': autostart, 'xml': xml}
+
+    def add_network(self, name, active='yes', persistent='yes',
+                    autostart='yes'):
+        self.networks[name] = {
+            'active': active, 'persistent': persistent,
+            'autostart': autostart,
+            'xml': ['<network>', '  <name>%s</name>' % name, '</network>']}
+
+    def add_pool(self, name, volumes=0, state='running', persistent='yes',
+                 autostart='yes'):
+        self.pools[name] = {
+            'state': state, 'persistent': persistent, 'autostart': autostart,
+            'xml': ['<pool type="dir">', '  <name>%s</name>' % name,
+                    '  <capacity>1000</capacity>', '</pool>']}
+        # Volumes are kept when the pool is undefined.
+        self.volumes.setdefault(name, [])
+        self.volumes[name] += ['%s-vol%d.img' % (name, idx)
+                               for idx in range(volumes)]
+
+    def add_secret(self, uuid):
+        self.secrets[uuid] = ['<secret ephemeral="no">',
+                              '  <uuid>%s</uuid>' % uuid, '</secret>']
+
+    def dom_list(self, options='', **dargs):
+        return self.result('list', '\n'.join(sorted(self.domains)) + '\n')
+
+    def dominfo(self, name, **dargs):
+        dom = self.domains[name]
+        return self.result('dominfo', (
+            'Id:             %s\nName:           %s\nState:          %s\n'
+            'CPU time:       %.1fs\nPersistent:     %s\n'
+            'Autostart:      %s\n' % (
+                '1' if dom['state'] == 'running' else '-', name,
+                dom['state'], time.time(), dom['persistent'],
+                dom['autostart'])))
+
+    def dumpxml(self, name, extra='', **dargs):
+        return self.result('dumpxml', '\n'.join(self.domains[name]['xml']))
+
+    def destroy(self, name, **dargs):
+        dom = self.domains[name]
+        dom['state'] = 'shut off'
+        if dom['persistent'] != 'yes':
+            del self.domains[name]
+        return self.result('destroy')
+
+    def undefine(self, name, options='', **dargs):
+        if self.domains[name]['state'] == 'shut off':
+            del self.domains[name]
+        else:
+            self.domains[name]['persistent'] = 'no'
+        return self.result('undefine')
+
+    def define(self, path, **dargs):
+        self.add_domain(self.xml_name(path), state='shut off', lines=0)
+        # Like libvirt, format the XML with an element on each line.
+        with open(path) as fp:
+            self.domains[self.xml_name(path)]['xml'] = re.findall(
+                r'\s*<.*?>(?:[^<\s][^<]*</[^>]*>)?', fp.read())
+        return self.result('define')
+
+    def start(self, name, **dargs):
+        self.domains[name]['state'] = 'running'
+        return self.result('start')
+
+    def create(self, path, **dargs):
+        self.define(path)
+        self.domains[self.xml_name(path)].update(state='running',
+                                                 persistent='no')
+        return self.result('create')
+
+    def autostart(self, name, options, **dargs):
+        self.domains[name]['autostart'] = 'enable'
+        return self.result('autostart')
+
+    def net_list(self, options='', **dargs):
+        return self.table('net-list', 'Name   State   Autostart   Persistent',
+                          [(name, net['active'], net['autostart'],
+                            net['persistent'])
+                           for name, net in sorted(self.networks.items())])
+
+    def net_info(self, name, **dargs):
+        net = self.networks[name]
+        return self.result('net-info', (
+            'Name:           %s\nActive:         %s\n'
+            'Persistent:     %s\nAutostart:      %s\n' % (
+                name, net['active'], net['persistent'], net['autostart'])))
+
+    def net_dumpxml(self, name, options='', **dargs):
+        return self.result('net-dumpxml',
+                           '\n'.join(self.networks[name]['xml']))
+
+    def net_destroy(self, name, **dargs):
+        self.networks[name]['active'] = 'no'
+        if self.networks[name]['persistent'] != 'yes':
+            del self.networks[name]
+        return self.result('net-destroy')
+
+    def net_undefine(self, name, **dargs):
+        del self.networks[name]
+        return self.result('net-undefine')
+
+    def net_define(self, path, **dargs):
+        self.add_network(self.xml_name(path), active='no', autostart='no')
+        return self.result('net-define')
+
+    def net_start(self, name, **dargs):
+        self.networks[name]['active'] = 'yes'
+        return self.result('net-start')
+
+    def net_create(self, path, **dargs):
+        self.add_network(self.xml_name(path), persistent='no', autostart='no')
+        return self.result('net-create')
+
+    def net_autostart(self, name, options='', **dargs):
+        self.networks[name]['autostart'] = (
+            'no' if '--disable' in options else 'yes')
+        return self.result('net-autostart')
+
+    def pool_list(self, options='', **dargs):
+        return self.table('pool-list', 'Name   State   Autostart',
+                          [(name, pool['state'], pool['autostart'])
+                           for name, pool in sorted(self.pools.items())])
+
+    def pool_info(self, name, **dargs):
+        pool = self.pools[name]
+        return self.result('pool-info', (
+            'Name:           %s\nState:          %s\n'
+            'Persistent:     %s\nAutostart:      %s\n'
+            'Allocation:     %d\n' % (name, pool['state'],
+                                       pool['persistent'], pool['autostart'],
+                                       len(self.volumes[name]))))
+
+    def pool_dumpxml(self, name, options='', **dargs):
+        self.calls['pool-dumpxml'] += 1
+        return '\n'.join(self.pools[name]['xml'])
+
+    def vol_list(self, name, **dargs):
+        return self.table('vol-list', 'Name   Path',
+                          [(vol, '/var/lib/libvirt/images/%s' % vol)
+                           for vol in self.volumes[name]])
+
+    def pool_destroy(self, name, **dargs):
+        self.calls['pool-destroy'] += 1
+        self.pools[name]['state'] = 'inactive'
+        if self.pools[name]['persistent'] != 'yes':
+            del self.pools[name]
+        return True
+
+    def pool_undefine(self, name, **dargs):
+        del self.pools[name]
+        return self.result('pool-undefine')
+
+    def pool_define(self, path, **dargs):
+        self.add_pool(self.xml_name(path), state='inactive', autostart='no')
+        return self.result('pool-define')
+
+    def pool_start(self, name, **dargs):
+        self.pools[name]['state'] = 'running'
+        return self.result('pool-start')
+
+    def pool_create(self, path, **dargs):
+        self.add_pool(self.xml_name(path), persistent='no', autostart='no')
+        return self.result('pool-create')
+
+    def pool_autostart(self, name, **dargs):
+        self.pools[name]['autostart'] = 'yes'
+        return self.result('pool-autostart')
+
+    def secret_list(self, **dargs):
+        return self.table('secret-list', 'UUID   Usage',
+                          [(uuid, 'none') for uuid in sorted(self.secrets)])
+
+    def secret_dumpxml(self, uuid, **dargs):
+        return self.result('secret-dumpxml', '\n'.join(self.secrets[uuid]))
+
+    def secret_undefine(self, uuid, **dargs):
+        del self.secrets[uuid]
+        return self.result('secret-undefine')
+
+    def secret_define(self, path, **dargs):
+        self.add_secret(self.xml_name(path, 'uuid'))
+        return self.result('secret-define')
+
+
+class FakeHost():
+
+    """
+    Point State classes at a FakeVirsh and at a fake libvirtd, SELinux and
+    mount while in a with block, so states can be changed and recovered
+    without touching the host.
+    """
+
+    def __init__(self, fake_virsh, mtab):
+        self.virsh = fake_virsh
+        self.mtab = mtab
+        self.running = True
+        self.selinux = 'enforcing'
+
+    def __enter__(self):
+        module = vars(ci)
+        self.saved = dict((name, module[name]) for name in
+                          ('virsh', 'utils_selinux', 'mount', 'umount'))
+        self.saved_libvirtd = ci.ServiceState.libvirtd
+        module.update(virsh=self.virsh, utils_selinux=self,
+                      mount=self.mount, umount=self.umount)
+        ci.ServiceState.libvirtd = self
+        return self
+
+    def __exit__(self, *exc_info):
+        vars(ci).update(self.saved)
+        ci.ServiceState.libvirtd = self.saved_libvirtd
+
+    def is_running(self):
+        return self.running
+
+    def start(self):
+        self.running = True
+        return True
+
+    def stop(self):
+        self.running = False
+        return True
+
+    def get_status(self):
+        return self.selinux
+
+    def set_status(self, status):
+        self.selinux = status
+
+    def mount(self, src, mount_point, fstype, options, verbose=False):
+        with open(self.mtab, 'a') as fp:
+            fp.write('%s %s %s %s 0 0\n' % (src, mount_point, fstype,
+                                             options))
+        return True
+
+    def umount(self, src, mount_point, fstype, verbose=False):
+        with open(self.mtab) as fp:
+            lines = fp.readlines()
+        with open(self.mtab, 'w') as fp:
+            fp.writelines(line for line in lines
+                          if line.split()[1] != mount_point)
+        return True
+
+
+class Benchmark():
+
+    """
+    Time ci.Report, State and test listing code of ci.py on synthetic inputs
+    with a FakeHost and files in a temporary directory.
+    """
+
+    def __init__(self, work_dir, repeat=1):
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.results = []
+
+    def time(self, name, func, items=0, setup=None):
+        """
+        Time func, calling setup untimed before each repeat.
+        """
+        durations = []
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.time()
+            func()
+            durations.append(time.time() - start)
+        self.results.append({'name': name, 'items': items,
+                             'best': min(durations),
+                             'durations': durations})
+        print '%-32s %10.3f s %10d items' % (name, min(durations), items)
+        sys.stdout.flush()
+
+    def path(self, *names):
+        return os.path.join(self.work_dir, *names)
+
+    def test_names(self, count):
+        return ['type_specific.io-github-autotest-libvirt.suite%d.case%d' %
+                (idx % 200, idx) for idx in range(count)]
+
+    def report(self, tests, stderr_mb):
+        """
+        Update a ci.Report with results of tests and one huge log and save it.
+        """
+        report = ci.Report(fail_diff=True)
+        statuses = ['PASS', 'FAIL', 'ERROR', 'SKIP', 'TIMEOUT', 'PASS DIFF',
+                    'PASS FLAKY', 'FAIL QUARANTINED']
+        names = [name.split('.', 2)[2].split('.', 1)
+                 for name in self.test_names(tests)]
+
+        def update():
+            for idx, (class_name, test_name) in enumerate(names):
+                report.update(test_name, class_name,
+                              statuses[idx % len(statuses)],
+                              'output of %s\n' % test_name * 5,
+                              ['error %d' % idx], 1.0)
+
+        line = 'DEBUG| qemu-kvm: some output \\x1b[0m\t%s\n' % ('x' * 60)
+        log = line * (stderr_mb * 1024 * 1024 / len(line))
+        self.time('report.update', update, tests)
+        self.time('report.update_huge_log',
+                  lambda: report.update('huge', 'log', 'FAIL', log, [], 1.0),
+                  len(log))
+        self.time('report.save',
+                  lambda: report.save(self.path('report.xml')), tests + 1)
+
+    def states(self, domains, volumes, churn):
+        """
+        Back up, check and recover every State after churn changes.
+        """
+        fake = FakeVirsh()
+        for idx in range(domains):
+            fake.add_domain('vm%d' % idx,
+                            state='running' if idx % 2 else 'shut off')
+        for idx in range(max(domains / 10, churn)):
+            fake.add_network('net%d' % idx)
+            fake.add_secret('00000000-0000-0000-0000-%012d' % idx)
+        pools = 20
+        for idx in range(pools):
+            fake.add_pool('pool%d' % idx, volumes / pools)
+
+        dirs = [self.path('dir%d' % idx) for idx in range(5)]
+        for dirname in dirs:
+            os.mkdir(dirname)
+            for idx in range(volumes / len(dirs)):
+                open(os.path.join(dirname, 'file%d' % idx), 'w').close()
+        files = [self.path('file%d.conf' % idx) for idx in range(3)]
+        for path in files:
+            with open(path, 'w') as fp:
+                fp.write('option = value\n' * 1000)
+        mtab = self.path('mtab')
+        with open(mtab, 'w') as fp:
+            for idx in range(domains):
+                fp.write('server:/export%d /mnt/%d nfs rw 0 0\n' % (idx, idx))
+
+        file_state = ci.FileState()
+        file_state.get_names = lambda: files
+        dir_state = ci.DirState()
+        dir_state.get_names = lambda: dirs
+        mount_state = ci.MountState()
+        mount_state.mtab = mtab
+        host = FakeHost(fake, mtab)
+        counter = itertools.count()
+
+        def change_files():
+            with open(files[0], 'a') as fp:
+                fp.write('changed = yes\n')
+
+        def change_services():
+            host.stop()
+            host.set_status('permissive')
+
+        def change_dirs():
+            for _ in range(churn):
+                idx = counter.next()
+                open(os.path.join(dirs[idx % len(dirs)], 'new%d' % idx),
+                     'w').close()
+            os.remove(os.path.join(dirs[0], 'file%d' % counter.next()))
+
+        def change_domains():
+            for _ in range(churn):
+                idx = counter.next()
+                fake.add_domain('new-vm%d' % idx)
+                fake.domains['vm%d' % (idx % domains)]['xml'][2] = 'changed'
+            fake.undefine(fake.dom_list().stdout.split()[0])
+
+        def change_networks():
+            for _ in range(churn):
+                fake.add_network('new-net%d' % counter.next())
+            fake.net_autostart('net0', '--disable')
+
+        def change_pools():
+            for _ in range(churn):
+                idx = counter.next()
+                fake.volumes['pool%d' % (idx % pools)].append(
+                    'new-vol%d' % idx)
+            fake.pool_destroy('pool0')
+
+        def change_secrets():
+            for _ in range(churn):
+                fake.add_secret('ffffffff-0000-0000-0000-%012d' %
+                                counter.next())
+
+        def change_mounts():
+            with open(mtab, 'a') as fp:
+                for _ in range(churn):
+                    fp.write('server:/new /mnt/new%d nfs rw 0 0\n' %
+                             counter.next())
+
+        states = [(file_state, change_files, len(files)),
+                  (ci.ServiceState(), change_services, 2),
+                  (dir_state, change_dirs, volumes),
+                  (ci.DomainState(), change_domains, domains),
+                  (ci.NetworkState(), change_networks, len(fake.networks)),
+                  (ci.PoolState(), change_pools, volumes),
+                  (ci.SecretState(), change_secrets, len(fake.secrets)),
+                  (mount_state, change_mounts, domains)]
+        with host:
+            for state, change, items in states:
+                self.time('%s.get_state' % state.name, state.backup, items)
+            for state, change, items in states:
+                self.time('%s.check' % state.name, state.check, items,
+                          setup=change)
+                # Recovering also recovers changes made for check.
+                self.time('%s.restore' % state.name,
+                          lambda: state.check(recover=True), items,
+                          setup=change)
+
+    def prepare_tests(self, tests):
+        """
+        List tests from a fake ./run and filter them.
+        """
+        names = self.test_names(tests)
+        with open(self.path('list.out'), 'w') as fp:
+            for idx, name in enumerate(names):
+                fp.write('%d %s (requires root)\n' % (idx + 1, name))
+        with open(self.path('run'), 'w') as fp:
+            fp.write('#!/bin/sh\ncat "$(dirname "$0")/list.out"\n')
+        os.chmod(self.path('run'), 0755)
+        with open(self.path('blacklist.test'), 'w') as fp:
+            fp.write('# Tests known to fail\n')
+            for name in names[::10]:
+                fp.write(name + '\n')
+
+        cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        try:
+            for name, argv in [('prepare_tests', ['--black', 'yes']),
+                               ('prepare_tests.smoke', ['--smoke'])]:
+                libvirt_ci = ci.LibvirtCI()
+                libvirt_ci.parse_args(argv)
+                libvirt_ci.quarantine_path = ''
+                self.time(name, libvirt_ci.prepare_tests, tests)
+        finally:
+            os.chdir(cwd)
+
+
+def main(argv):
+    """
+    Time ci.py on synthetic inputs without a libvirt host.
+    """
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Time ci.Report updates and saving, backing up, checking '
+        'and recovering every State and test listing against a fake virsh '
+        'and a temporary directory, and save timings as JSON.')
+    parser.add_option('--output', dest='output', action='store',
+                      default='ci_benchmark.json',
+                      help='File to save timings to as JSON.')
+    parser.add_option('--repeat', dest='repeat', action='store',
+                      default='1', help='Times to run each benchmark. The '
+                      'best time is reported.')
+    parser.add_option('--tests', dest='tests', action='store',
+                      default='20000', help='Number of tests to report and '
+                      'list.')
+    parser.add_option('--stderr-mb', dest='stderr_mb', action='store',
+                      default='100', help='Size of the huge test log.')
+    parser.add_option('--domains', dest='domains', action='store',
+                      default='1000', help='Number of domains.')
+    parser.add_option('--volumes', dest='volumes', action='store',
+                      default='10000', help='Number of volumes, and of '
+                      'files in checked directories.')
+    parser.add_option('--churn', dest='churn', action='store',
+                      default='10', help='Number of objects of each kind '
+                      'changed before checking states.')
+    args, _ = parser.parse_args(argv)
+
+    sizes = dict((name, int(getattr(args, name))) for name in
+                 ('tests', 'stderr_mb', 'domains', 'volumes', 'churn'))
+    work_dir = tempfile.mkdtemp(prefix='virt-test-ci-benchmark-')
+    bench = Benchmark(work_dir, int(args.repeat))
+    try:
+        bench.report(sizes['tests'], sizes['stderr_mb'])
+        bench.states(sizes['domains'], sizes['volumes'], sizes['churn'])
+        bench.prepare_tests(sizes['tests'])
+    finally:
+        shutil.rmtree(work_dir)
+    with open(args.output, 'w') as fp:
+        json.dump({'timestamp': time.time(), 'host': socket.gethostname(),
+                   'python': sys.version.split()[0], 'sizes': sizes,
+                   'repeat': int(args.repeat), 'results': bench.results},
+                  fp, indent=2, sort_keys=True)
+    print 'Timings saved to %s' % args.output
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,49 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import ci
+
+
+class BootstrapManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.base_dir = os.path.join(self.work_dir, 'data')
+        for path in ('images/jeos-19-64.qcow2', 'images/vm2.qcow2',
+                     'bootstrapped', 'stale/dir/file'):
+            self.touch(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def touch(self, path):
+        path = os.path.join(self.base_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+    def layout(self):
+        return ci.BootstrapManifest(self.work_dir, self.base_dir).layout()
+
+    def test_no_manifest(self):
+        before = self.layout()
+        manifest = ci.BootstrapManifest(self.work_dir, self.base_dir)
+        self.assertEqual(manifest.clean(), 0)
+        self.assertEqual(self.layout(), before)
+
+    def test_clean(self):
+        manifest = ci.BootstrapManifest(self.work_dir, self.base_dir)
+        manifest.data = {'layout': ['bootstrapped']}
+        self.assertEqual(manifest.clean(), 4)
+        self.assertEqual(self.layout(), ['bootstrapped', 'images',
+                                         'images/jeos-19-64.qcow2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
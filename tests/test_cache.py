@@ -0,0 +1,59 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import ci
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.root_dir = os.path.join(self.work_dir, 'virt-test')
+        self.provider_dir = os.path.join(self.work_dir, 'tp-libvirt')
+        self.files = {
+            'virt-test/virttest/utils_misc.py': 'pass\n',
+            'virt-test/backends/libvirt/cfg/base.cfg': 'vms = vm1\n',
+            'virt-test/custom.cfg': 'include tests.cfg\n',
+            'tp-libvirt/provider/libvirt_version.py': 'pass\n',
+            'tp-libvirt/libvirt/tests/cfg/virsh/start.cfg':
+                '- virsh.start:\n',
+            'tp-libvirt/libvirt/tests/src/virsh/start.py': 'pass\n'}
+        for path, content in self.files.items():
+            self.write(path, content)
+        self.test = 'type_specific.io-github-autotest-libvirt.virsh.start'
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, path, content):
+        path = os.path.join(self.work_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fp:
+            fp.write(content)
+
+    def key(self, run_args=('--connect-uri', 'qemu:///system'),
+            config='custom.cfg'):
+        cache = ci.ResultCache(None, self.root_dir, self.provider_dir,
+                               'digest', run_args, config)
+        return cache.key(self.test)
+
+    def test_inputs(self):
+        key = self.key()
+        self.assertEqual(self.key(), key)
+        self.assertNotEqual(self.key(('--connect-uri', 'lxc:///')), key)
+        self.assertNotEqual(self.key(config=''), key)
+        for path in sorted(self.files):
+            self.write(path, self.files[path] + '# changed\n')
+            self.assertNotEqual(self.key(), key, path)
+            key = self.key()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import re
+import sys
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import ci
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', len(self.server.data))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.server.data
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2) or len(data) - 1) + 1
+            self.server.ranges.append((start, end))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, end - 1, len(data)))
+        else:
+            start, end = 0, len(data)
+            self.send_response(200)
+        self.send_header('Content-Length', end - start)
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        # Drop the connection in the middle of the broken range.
+        if start == self.server.broken:
+            end = start + 4096
+        self.wfile.write(data[start:end])
+
+
+class RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ImageDownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RangeServer(('127.0.0.1', 0), RangeHandler)
+        self.server.data = os.urandom(64 * 1024)
+        self.server.ranges = []
+        self.server.broken = None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/image.qcow2' % (
+            self.server.server_address[1])
+        self.work_dir = tempfile.mkdtemp()
+        self.target = os.path.join(self.work_dir, 'image.qcow2')
+        self.part_dir = os.path.join(self.work_dir, 'downloads')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def downloader(self, checksum=''):
+        downloader = ci.ImageDownloader(self.url, checksum=checksum,
+                                        chunks=4, part_dir=self.part_dir)
+        downloader.block_size = 1024
+        return downloader
+
+    def read_target(self):
+        with open(self.target, 'rb') as fp:
+            return fp.read()
+
+    def test_parallel_chunks(self):
+        self.downloader().fetch(self.target)
+        self.assertEqual(self.read_target(), self.server.data)
+        self.assertEqual(sorted(self.server.ranges),
+                         [(0, 16384), (16384, 32768), (32768, 49152),
+                          (49152, 65536)])
+
+    def test_resume(self):
+        self.server.broken = 32768
+        self.assertRaises(Exception, self.downloader().fetch, self.target)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertEqual(len(os.listdir(self.part_dir)), 2)
+
+        self.server.broken = None
+        self.server.ranges = []
+        self.downloader().fetch(self.target)
+        self.assertEqual(self.read_target(), self.server.data)
+        self.assertEqual(self.server.ranges, [(32768 + 4096, 49152)])
+        self.assertEqual(os.listdir(self.part_dir), [])
+
+    def test_checksum(self):
+        digest = hashlib.sha256(self.server.data).hexdigest()
+        self.downloader('sha256:' + digest).fetch(self.target)
+        self.assertEqual(self.read_target(), self.server.data)
+
+        os.remove(self.target)
+        downloader = self.downloader('sha256:' + '0' * 64)
+        self.assertRaises(Exception, downloader.fetch, self.target)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertEqual(os.listdir(self.part_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
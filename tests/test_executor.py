@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import ci
+
+
+class TestExecutorTest(unittest.TestCase):
+
+    def test_timeout_with_output(self):
+        executor = ci.TestExecutor(
+            'while true; do echo running; sleep 0.1; done', 2)
+        start = time.time()
+        res = executor.run()
+        self.assertTrue(executor.timed_out)
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(res.stdout.startswith('running\n'))
+
+    def test_deadline(self):
+        executor = ci.TestExecutor(
+            'while true; do echo "(1/2) a.b.c: PASS"; sleep 0.1; done', 100)
+        executor.deadline = executor.start_time + 2
+        start = time.time()
+        executor.run(lambda source, line, match: executor.progress())
+        self.assertTrue(executor.timed_out)
+        self.assertTrue(time.time() - start < 5)
+
+    def test_exit(self):
+        executor = ci.TestExecutor('echo "(1/1) a.b.c: PASS (1.00 s)"', 10)
+        res = executor.run()
+        self.assertFalse(executor.timed_out)
+        self.assertEqual(res.exit_status, 0)
+        self.assertEqual(len(res.statuses), 1)
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.ci = ci.LibvirtCI()
+        self.ci.parse_args(['--timeout', '2', '--no-check',
+                            '--log-dir', self.work_dir])
+        self.ci.root_dir = self.ci.log_dir = self.work_dir
+        self.ci.history = None
+        self.ci.sampler = None
+        self.tests = ['type_specific.io-github-autotest-libvirt.%s' % name
+                      for name in ('a', 'b', 'c')]
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_hung_test(self):
+        self.ci.run_command = lambda test: (
+            'echo "(1/3) a: PASS (1.00 s)"; echo waiting; sleep 60')
+        start = time.time()
+        results, pending = self.ci.run_batch(self.tests, check=False)
+        self.assertTrue(time.time() - start < 10)
+        self.assertEqual([(test, status) for test, status, _, _ in results],
+                         [(self.tests[0], 'PASS'), (self.tests[1], 'TIMEOUT')])
+        self.assertEqual(results[1][2].stdout, 'waiting\n')
+        self.assertEqual(pending, [self.tests[2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import StringIO
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import ci
+
+
+class GithubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        match = re.match(r'/repos/autotest/([\w-]+)/issues/(\d+)(/comments)?',
+                         self.path)
+        if match is None:
+            self.send_error(404)
+            return
+        issue = self.server.issues[(match.group(1), match.group(2))]
+        if match.group(3):
+            body = json.dumps([{'body': text}
+                               for text in issue.get('comments', [])])
+        else:
+            body = json.dumps(issue)
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(body))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class GithubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class PullResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = GithubServer(('127.0.0.1', 0), GithubHandler)
+        self.server.connections = 0
+        self.server.requests = 0
+        self.server.not_modified = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        pull = {'state': 'open', 'pull_request': {}}
+        self.server.issues = {
+            ('tp-libvirt', '1'): dict(
+                pull, body='Depends on autotest/virt-test#2\n'
+                'and autotest/virt-test#5'),
+            ('virt-test', '2'): dict(
+                pull, body='', comments=[
+                    'Needs %s/autotest/tp-libvirt/pull/3' % self.url]),
+            ('tp-libvirt', '3'): dict(
+                pull, body='autotest/virt-test#2 autotest/virt-test#4'),
+            ('virt-test', '4'): dict(pull, state='closed', body=''),
+            ('virt-test', '5'): {'state': 'open', 'body': ''}}
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def resolve(self):
+        client = ci.GithubClient(self.cache_dir, workers=1)
+        resolver = ci.PullResolver(client, self.url, self.url)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            result = resolver.resolve([('tp-libvirt', '1')])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            client.close()
+        return resolver, result, output
+
+    def test_resolve(self):
+        resolver, result, output = self.resolve()
+        self.assertEqual(result, {'virt-test': ['2'],
+                                  'tp-libvirt': ['3', '1']})
+        self.assertEqual(resolver.order, [('tp-libvirt', '3'),
+                                          ('virt-test', '2'),
+                                          ('tp-libvirt', '1')])
+        self.assertEqual(output, 'WARNING: dependency cycle virt-test#2 -> '
+                         'tp-libvirt#3 -> virt-test#2\n')
+
+    def test_keep_alive(self):
+        self.resolve()
+        self.assertTrue(self.server.requests > 1)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_revalidate(self):
+        _, first, _ = self.resolve()
+        requests = self.server.requests
+        self.assertEqual(self.server.not_modified, 0)
+        _, second, _ = self.resolve()
+        self.assertEqual(second, first)
+        self.assertEqual(self.server.not_modified, requests)
+
+        self.server.issues[('tp-libvirt', '1')]['body'] = ''
+        _, third, _ = self.resolve()
+        self.assertEqual(third, {'virt-test': [], 'tp-libvirt': ['1']})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import ci
+
+
+class GoldenImageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.golden = ci.GoldenImageCache(self.cache_dir, 'virt-tests-vm1')
+        self.entry = self.golden.entry('key')
+        os.makedirs(self.entry)
+        with open(os.path.join(self.entry, 'image.digest'), 'w') as fp:
+            fp.write('abc\n')
+        self.backing = {}
+        self.golden.backing_file = self.backing.get
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_image_digest(self):
+        self.backing['overlay'] = os.path.join(self.entry, 'image.qcow2')
+        self.backing['other'] = '/var/lib/libvirt/images/base.qcow2'
+        self.assertEqual(self.golden.image_digest('overlay'), 'abc')
+        self.assertEqual(self.golden.image_digest('other'), None)
+        self.assertEqual(self.golden.image_digest('image'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import ci
+
+CFG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cfg')
+
+
+class OrderByVMStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ci = ci.LibvirtCI()
+        self.ci.parse_args(['--config', os.path.join(CFG_DIR, 'tests.cfg'),
+                            '--order-vm-state'])
+        self.ci.root_dir = CFG_DIR
+        self.tests = ['io-github-autotest-libvirt.%s' % name for name in
+                      ('boot_a', 'shutdown_a', 'boot_b', 'shutdown_b')]
+
+    def test_vm_states(self):
+        states = self.ci.vm_states(self.tests)
+        self.assertEqual(sorted(states), sorted(self.tests))
+        self.assertEqual(states[self.tests[0]], ('on', False))
+        self.assertEqual(states[self.tests[1]], ('off', False))
+
+    def test_reorder(self):
+        ordered = self.ci.order_by_vm_state(list(self.tests))
+        self.assertEqual(ordered, [self.tests[1], self.tests[3],
+                                   self.tests[0], self.tests[2]])
+
+
+class HistoryOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        runs = [[('a', 'PASS', 9.0), ('b', 'PASS', 25.0), ('c', 'FAIL', 4.0)],
+                [('a', 'PASS', 10.0), ('b', 'PASS', 20.0), ('c', 'FAIL', 5.0)],
+                [('a', 'PASS', 12.0), ('b', 'FAIL', 30.0), ('c', 'FAIL', 6.0)],
+                [('a', 'PASS', 11.0), ('b', 'PASS', 25.0), ('c', 'PASS', 7.0),
+                 ('d', 'PASS', 1.0)]]
+        self.simulator = ci.Simulator(runs)
+        self.tests = ['a', 'b', 'c', 'd']
+
+    def test_orders(self):
+        expected = {'listing': ['a', 'b', 'c', 'd'],
+                    'failed-first': ['b', 'c', 'd', 'a'],
+                    'shortest-first': ['d', 'c', 'a', 'b'],
+                    'changed-first': ['b', 'd', 'a', 'c']}
+        for order in ci.ORDERS:
+            self.assertEqual(ci.history_order(self.tests, order,
+                                              self.simulator),
+                             expected[order])
+
+    def test_run_with_simulator_history(self):
+        libvirt_ci = ci.LibvirtCI()
+        libvirt_ci.parse_args(['--order', 'changed-first',
+                               '--adaptive-timeout', '--timeout-factor', '2',
+                               '--timeout-floor', '1'])
+        libvirt_ci.history = self.simulator
+        self.assertEqual(libvirt_ci.order_tests(self.tests),
+                         ['b', 'd', 'a', 'c'])
+        self.assertEqual(libvirt_ci.test_timeout('b'), 60)
+        self.assertEqual(libvirt_ci.test_timeout('d'), 1200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import ci
+
+
+class ReportTest(unittest.TestCase):
+
+    def find(self, report, name):
+        return [tc for tc in report.ts_dict['virsh'].testcase
+                if tc.name == name][0]
+
+    def test_fail_diff(self):
+        for fail_diff in (False, True):
+            report = ci.Report(fail_diff)
+            report.update('start', 'virsh', 'PASS DIFF FLAKY', '', [], 1)
+            report.update('stop', 'virsh', 'PASS FLAKY', '', [], 1)
+            diff_tc = self.find(report, 'start')
+            flaky_tc = self.find(report, 'stop')
+            self.assertEqual(diff_tc.failure is not None, fail_diff)
+            self.assertEqual(diff_tc.flaky is not None, not fail_diff)
+            self.assertTrue(flaky_tc.failure is None)
+            self.assertTrue(flaky_tc.flaky is not None)
+            self.assertEqual(report.ts_dict['virsh'].failures,
+                             int(fail_diff))
+
+
+if __name__ == '__main__':
+    unittest.main()